@@ -0,0 +1,188 @@
+"""Offline end-to-end harness of main.py. The full main() pipeline runs in this process on
+synthetic bundles (see benchmarks.synthetic) or on an existing directory, read from disk
+(local_disk) or from a LocalFhirServer stand-in of the github urls (get_folder_url,
+get_file_url), and stores into a SQLite database (StoreFhir with --database-url) or a
+parquet/csv FileSink, so that neither network nor PostgreSQL is needed. The stored rows of
+every resourceType table are checked against the resources of the input files, and the
+throughput of the run is reported and saved as JSON with the commit.
+Extra main.py options are given after --, e.g. -- --workers 2 --flush-rows 20000. Options
+dropping resources (resource filters) make the row count check fail.
+Usage: python -m benchmarks.bench_e2e [--patients 50] [--resources 300] [--source-dir DIR]
+       [--mode get_folder_url] [--sink sqlite] [-o results.json] [-- main.py options]"""
+import asyncio
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser, REMAINDER
+from collections import Counter
+from benchmarks.synthetic import generate_dataset, DATA_DIR
+from benchmarks.bench_pipeline import _commit, _peak_rss_mb
+from benchmarks.fhir_server import LocalFhirServer
+
+MODES = ('local_disk', 'get_folder_url', 'get_file_url')
+SINKS = ('sqlite', 'parquet', 'csv')
+
+def expected_counts(data_dir: str, names: list) -> Counter:
+    """Counts the resources per resourceType of bundle files
+    Input: data_dir=Directory of the bundle files
+           names=File names read by the run
+    Returns: Counter of resourceType -> number of resources"""
+    counts = Counter()
+    for name in names:
+        with open(os.path.join(data_dir, name), encoding='UTF-8') as fp:
+            bundle = json.load(fp)
+        counts.update(entry["resource"]["resourceType"] for entry in bundle.get("entry", ())
+                      if entry.get("resource"))
+    return counts
+
+def stored_counts(sink: str, output_dir: str, resource_types) -> Counter:
+    """Counts the stored rows of the resourceType tables
+    Input: sink=One of SINKS
+           output_dir=Directory of the SQLite database or of the file datasets
+           resource_types=Tables counted
+    Returns: Counter of resourceType -> number of rows"""
+    counts = Counter()
+    if sink == 'sqlite':
+        from sqlalchemy import create_engine, inspect, text
+        engine = create_engine(f"sqlite:///{os.path.join(output_dir, 'fhir.db')}")
+        with engine.connect() as con:
+            tables = set(inspect(con).get_table_names())
+            for resource_type in resource_types:
+                if resource_type in tables:
+                    counts[resource_type] = con.execute(
+                        text(f'SELECT count(*) FROM "{resource_type}"')).scalar()
+        engine.dispose()
+        return counts
+    import pandas as pd
+    import pyarrow.parquet as pq
+    for resource_type in resource_types:
+        for root, _, files in os.walk(os.path.join(output_dir, resource_type)):
+            for name in files:
+                path = os.path.join(root, name)
+                if name.endswith('.parquet'):
+                    counts[resource_type] += pq.ParquetFile(path).metadata.num_rows
+                elif name.endswith('.csv'):
+                    counts[resource_type] += len(pd.read_csv(path, usecols=[0]))
+    return counts
+
+def check(expected: Counter, stored: Counter) -> list:
+    """Compares the stored rows with the input resources
+    Returns: List of mismatch lines, empty when every resourceType matches"""
+    return [f"{resource_type}: {stored.get(resource_type, 0)} rows stored, {count} expected"
+            for resource_type, count in sorted(expected.items())
+            if stored.get(resource_type, 0) != count]
+
+def main_args(mode: str, sink: str, source: str, output_dir: str, extra_args=()) -> list:
+    """Returns the main.py arguments of a run
+    Input: mode=One of MODES
+           sink=One of SINKS
+           source=Directory of local_disk mode, url of the url modes
+           output_dir=Directory of the database, datasets and dead letters
+           extra_args=Further main.py options"""
+    args = ['-m', mode, '-d' if mode == 'local_disk' else '-u', source,
+            '--dead-letters', os.path.join(output_dir, 'dead_letters.db')]
+    if sink == 'sqlite':
+        args += ['--database-url', f"sqlite:///{os.path.join(output_dir, 'fhir.db')}"]
+    else:
+        args += ['--sink', sink, '-o', output_dir]
+    return args + list(extra_args)
+
+def run(data_dir: str, mode: str = 'get_folder_url', sink: str = 'sqlite',
+        output_dir: str = None, extra_args=()) -> dict:
+    """Runs main.main() on the files of data_dir and checks the stored row counts
+    Input: data_dir=Directory of the bundle files
+           mode=One of MODES, get_file_url reads the first file only
+           sink=One of SINKS
+           output_dir=Directory of the outputs, a temporary directory by default
+           extra_args=Further main.py options
+    Returns: Dictionary of the run figures, with the mismatches of the row count check"""
+    # main.py configures the logging when imported
+    import main as etl
+    if mode not in MODES:
+        raise ValueError(f"Unknown mode {mode}")
+    if sink not in SINKS:
+        raise ValueError(f"Unknown sink {sink}")
+    server = LocalFhirServer(data_dir)
+    names = server.file_names()
+    if mode == 'get_file_url':
+        names = names[:1]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output_dir = output_dir or tmp_dir
+        os.makedirs(output_dir, exist_ok=True)
+        source = data_dir
+        if mode != 'local_disk':
+            server.start_thread()
+            source = server.folder_url if mode == 'get_folder_url' else server.file_url(names[0])
+        argv = sys.argv
+        sys.argv = ['main.py'] + main_args(mode, sink, source, output_dir, extra_args)
+        try:
+            start = time.perf_counter()
+            asyncio.run(etl.main())
+            secs = time.perf_counter() - start
+        finally:
+            sys.argv = argv
+            server.stop_thread()
+        expected = expected_counts(data_dir, names)
+        stored = stored_counts(sink, output_dir, expected)
+    resources = sum(expected.values())
+    size = sum(os.path.getsize(os.path.join(data_dir, name)) for name in names)
+    return {"mode": mode, "sink": sink, "files": len(names), "resources": resources,
+            "bytes": size, "seconds": round(secs, 3),
+            "files_per_s": round(len(names) / secs, 2),
+            "resources_per_s": round(resources / secs, 1),
+            "mb_per_s": round(size / secs / 1e6, 2), "peak_rss_mb": _peak_rss_mb(),
+            "http_requests": server.requests, "stored": dict(stored),
+            "mismatches": check(expected, stored)}
+
+def main():
+    """Parses the arguments, generates the dataset and runs the harness"""
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument("--patients", type=int, default=50)
+    arg_parser.add_argument("--resources", type=int, default=300,
+                            help="Resources per patient bundle besides the Patient")
+    arg_parser.add_argument("--template-dir", default=DATA_DIR)
+    arg_parser.add_argument("--source-dir", default=None,
+                            help="Directory of bundle files used as they are instead of \
+                            a synthetic dataset, e.g. ../data")
+    arg_parser.add_argument("--mode", choices=MODES, default='get_folder_url')
+    arg_parser.add_argument("--sink", choices=SINKS, default='sqlite')
+    arg_parser.add_argument("--output-dir", default=None,
+                            help="Directory of the outputs, kept for inspection. \
+                            A temporary directory by default")
+    arg_parser.add_argument("-o", "--output", default=None, help="JSON file of the results")
+    arg_parser.add_argument("main_args", nargs=REMAINDER,
+                            help="main.py options, after --")
+    args = arg_parser.parse_args()
+    extra_args = args.main_args[1:] if args.main_args[:1] == ['--'] else args.main_args
+    if not any(arg.startswith('--validation') for arg in extra_args):
+        # Synthetic bundles are trusted, as in the other benchmarks
+        extra_args = ['--validation', 'none'] + extra_args
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = args.source_dir
+        if data_dir is None:
+            data_dir = os.path.join(tmp_dir, 'data')
+            generate_dataset(data_dir, args.patients, args.resources, args.template_dir)
+        figures = run(data_dir, args.mode, args.sink, args.output_dir, extra_args)
+    results = {"commit": _commit(), "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S'),
+               "python": platform.python_version(),
+               "params": {k: v for k, v in vars(args).items() if k != 'output'},
+               "run": figures}
+    print(f"{figures['mode']} -> {figures['sink']}: {figures['files']} files, "
+          f"{figures['resources']} resources in {figures['seconds']:.2f}s, "
+          f"{figures['files_per_s']:.1f} files/s {figures['resources_per_s']:.1f} resources/s "
+          f"{figures['mb_per_s']:.2f} MB/s {figures['peak_rss_mb']:.1f} MB peak RSS")
+    for line in figures["mismatches"]:
+        print("MISMATCH " + line)
+    if args.output:
+        with open(args.output, 'w', encoding='UTF-8') as fp:
+            json.dump(results, fp, indent=2)
+    if figures["mismatches"]:
+        sys.exit(1)
+    print(f"Row counts of {len(figures['stored'])} resourceTypes match")
+
+if __name__ == '__main__':
+    main()
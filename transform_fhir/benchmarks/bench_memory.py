@@ -0,0 +1,102 @@
+"""Memory benchmark of the transform stage on synthetic bundles (see benchmarks.synthetic).
+All the bundles are transformed by ProcessFihr into one ColumnarBatchBuilder, with and
+without dictionary encoding, i.e. with the coded strings (system, code, display, status...)
+interned and stored as categorical columns, or with one string object per row. The traced
+memory of the accumulated batch, the deep size of the dataframes built from it and the size
+of the parquet files written from them are reported per mode, with the encoded/plain ratio.
+Usage: python -m benchmarks.bench_memory [--patients 50] [--resources 300] [-o results.json]"""
+import gc
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from benchmarks.synthetic import generate_dataset, DATA_DIR
+from benchmarks.bench_pipeline import _commit
+from transform_fhir_records.columnar_batch import ColumnarBatchBuilder
+from transform_fhir_records.process_fhir import ProcessFihr
+from store_fhir_records.file_sink import _to_arrow
+
+MODES = {"plain": False, "dictionary": True}
+
+def _parquet_bytes(df_dict: dict, output_dir: str) -> int:
+    """Writes one parquet file per table and returns their total size"""
+    import pyarrow.parquet as pq
+    total = 0
+    for table, df in df_dict.items():
+        path = os.path.join(output_dir, f"{table}.parquet")
+        pq.write_table(_to_arrow(df), path, use_dictionary=True, compression='snappy')
+        total += os.path.getsize(path)
+    return total
+
+def run(data_dir: str, dictionary_encoding: bool) -> dict:
+    """Transforms every bundle of data_dir into one batch and measures it
+    Input: data_dir=Directory of the bundle files
+           dictionary_encoding=ProcessFihr and ColumnarBatchBuilder setting
+    Returns: Dictionary of the measured figures"""
+    process = ProcessFihr(validation='none', dictionary_encoding=dictionary_encoding)
+    builder = ColumnarBatchBuilder(dictionary_encoding=dictionary_encoding)
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    for name in sorted(os.listdir(data_dir)):
+        with open(os.path.join(data_dir, name), encoding='UTF-8') as fp:
+            bundle = json.load(fp)
+        builder.extend(process.transform_bundle(bundle))
+        del bundle
+    transform_secs = time.perf_counter() - start
+    gc.collect()
+    batch_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    rows = builder.num_rows
+    df_dict = builder.flush()
+    flush_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    frame_bytes = sum(int(df.memory_usage(index=False, deep=True).sum())
+                      for df in df_dict.values())
+    with tempfile.TemporaryDirectory() as output_dir:
+        parquet_bytes = _parquet_bytes(df_dict, output_dir)
+    return {"rows": rows, "transform_seconds": round(transform_secs, 3),
+            "batch_mb": round(batch_bytes / 1e6, 2),
+            "flush_peak_mb": round(flush_peak / 1e6, 2),
+            "dataframe_mb": round(frame_bytes / 1e6, 2),
+            "parquet_mb": round(parquet_bytes / 1e6, 3)}
+
+def main():
+    """Parses the arguments, generates the dataset and runs the benchmark"""
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument("--patients", type=int, default=50)
+    arg_parser.add_argument("--resources", type=int, default=300,
+                            help="Resources per patient bundle besides the Patient")
+    arg_parser.add_argument("--template-dir", default=DATA_DIR)
+    arg_parser.add_argument("--data-dir", default=None,
+                            help="Directory of the generated bundles, kept for later runs. \
+                            A temporary directory by default")
+    arg_parser.add_argument("-o", "--output", default=None, help="JSON file of the results")
+    args = arg_parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = args.data_dir or tmp_dir
+        dataset = generate_dataset(data_dir, args.patients, args.resources, args.template_dir)
+        modes = {mode: run(data_dir, encoding) for mode, encoding in MODES.items()}
+    ratios = {figure: round(modes["plain"][figure] / modes["dictionary"][figure], 2)
+              for figure in ("batch_mb", "flush_peak_mb", "dataframe_mb", "parquet_mb")
+              if modes["dictionary"][figure]}
+    results = {"commit": _commit(), "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S'),
+               "python": platform.python_version(),
+               "params": {k: v for k, v in vars(args).items() if k != 'output'},
+               "dataset": dataset, "modes": modes, "plain_to_dictionary": ratios}
+    for mode, figures in modes.items():
+        print(f"{mode:10s} {figures['rows']:8d} rows {figures['transform_seconds']:7.2f}s "
+              f"{figures['batch_mb']:8.2f} MB batch {figures['flush_peak_mb']:8.2f} MB flush "
+              f"{figures['dataframe_mb']:8.2f} MB dataframes "
+              f"{figures['parquet_mb']:7.3f} MB parquet")
+    print("plain/dictionary " + " ".join(f"{k}={v}x" for k, v in ratios.items()))
+    if args.output:
+        with open(args.output, 'w', encoding='UTF-8') as fp:
+            json.dump(results, fp, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+"""End-to-end benchmark of the pipeline on synthetic bundles (see benchmarks.synthetic).
+Every stage runs on its own first: FhirReader fills the fhir queue, ProcessFihr drains it
+into the storage queue and the store stage (parquet/csv FileSink or StoreFhir on a SQLite
+file) drains that. Then the three stages run concurrently as in main.py. Files/s,
+resources/s, MB/s and the peak RSS are reported per stage and saved as JSON, with the
+commit, so that runs of different commits can be compared with --baseline.
+Usage: python -m benchmarks.bench_pipeline [--patients 50] [--resources 300] [--sink parquet]
+       [--workers 0] [--validation none] [-o results.json] [--baseline previous.json]"""
+import asyncio
+import json
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+from argparse import ArgumentParser
+from benchmarks.synthetic import generate_dataset, DATA_DIR
+from common.fhir_queue import FhirQueue
+from common.storage_queue import StorageQueue
+from ingest_fhir_records.fhir_reader import FhirReader
+from transform_fhir_records.process_fhir import ProcessFihr
+from store_fhir_records.file_sink import FileSink
+from store_fhir_records.store_fhir import StoreFhir
+
+SINKS = ('parquet', 'csv', 'sqlite')
+
+def _reset_peak_rss() -> bool:
+    """Resets the peak RSS of the process (Linux only), so that it is measured per stage
+    Returns: True when the reset is supported"""
+    try:
+        with open('/proc/self/clear_refs', 'w', encoding='ascii') as fp:
+            fp.write('5')
+        return True
+    except OSError:
+        return False
+
+def _peak_rss_mb() -> float:
+    """Returns the peak RSS of the process in MB, and of its finished worker processes"""
+    try:
+        with open('/proc/self/status', encoding='ascii') as fp:
+            peak = next(int(line.split()[1]) for line in fp if line.startswith('VmHWM'))
+    except (OSError, StopIteration):
+        # ru_maxrss is in KB on Linux and in bytes on macOS, and is not reset per stage
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if platform.system() == 'Darwin':
+            peak //= 1024
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(max(peak, children) / 1024, 1)
+
+def _commit() -> str:
+    """Returns the current git commit, None outside of a git checkout"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _storage(sink: str, output_dir: str):
+    """Creates the store stage object of a sink"""
+    if sink == 'sqlite':
+        os.makedirs(output_dir, exist_ok=True)
+        storage = StoreFhir()
+        storage.connection_str = f"sqlite:///{os.path.join(output_dir, 'fhir.db')}"
+        return storage
+    return FileSink(output_dir=output_dir, file_format=sink)
+
+async def _timed(coro_factory, dataset: dict) -> dict:
+    """Runs one stage and returns its throughput figures"""
+    _reset_peak_rss()
+    start = time.perf_counter()
+    result = await coro_factory()
+    secs = time.perf_counter() - start
+    return {"seconds": round(secs, 3), "ok": bool(result),
+            "files_per_s": round(dataset["files"] / secs, 2),
+            "resources_per_s": round(dataset["resources"] / secs, 1),
+            "mb_per_s": round(dataset["bytes"] / secs / 1e6, 2),
+            "peak_rss_mb": _peak_rss_mb()}
+
+async def run(data_dir: str, dataset: dict, sink: str, workers: int = 0,
+              validation: str = 'none', flush_rows: int = 0) -> dict:
+    """Benchmarks the stages one by one and the whole pipeline
+    Input: data_dir=Directory of the bundle files
+           dataset=Files, resources and bytes of data_dir
+           sink=One of SINKS
+           workers, validation, flush_rows=ProcessFihr settings
+    Returns: Dictionary of stage name -> figures"""
+    def reader():
+        return FhirReader(parse_bundles=workers == 0 and validation == 'full')
+
+    def transform():
+        return ProcessFihr(workers=workers, validation=validation, flush_rows=flush_rows)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as output_dir:
+        FhirQueue().configure()
+        StorageQueue().configure()
+        results["reader"] = await _timed(lambda: reader().local_dir_reader(data_dir), dataset)
+        results["transform"] = await _timed(lambda: transform().process_bundle(), dataset)
+        results["store"] = await _timed(
+            lambda: _storage(sink, os.path.join(output_dir, "staged")).process_storage_queue_df(),
+            dataset)
+
+        async def pipeline():
+            FhirQueue().configure()
+            StorageQueue().configure()
+            return all(await asyncio.gather(
+                reader().local_dir_reader(data_dir), transform().process_bundle(),
+                _storage(sink, os.path.join(output_dir, "pipeline")).process_storage_queue_df()))
+        results["end_to_end"] = await _timed(pipeline, dataset)
+    return results
+
+def compare(results: dict, baseline: dict) -> list:
+    """Compares the resources/s of every stage with a baseline result file
+    Returns: List of report lines"""
+    lines = []
+    for stage, figures in results["stages"].items():
+        base = baseline.get("stages", {}).get(stage)
+        if base:
+            change = figures["resources_per_s"] / base["resources_per_s"] - 1
+            lines.append(f"{stage:11s} {change:+7.1%} resources/s vs {baseline.get('commit')}")
+    return lines
+
+def main():
+    """Parses the arguments, generates the dataset and runs the benchmark"""
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument("--patients", type=int, default=50)
+    arg_parser.add_argument("--resources", type=int, default=300,
+                            help="Resources per patient bundle besides the Patient")
+    arg_parser.add_argument("--template-dir", default=DATA_DIR)
+    arg_parser.add_argument("--data-dir", default=None,
+                            help="Directory of the generated bundles, kept for later runs. \
+                            A temporary directory by default")
+    arg_parser.add_argument("--sink", choices=SINKS, default='parquet')
+    arg_parser.add_argument("--workers", type=int, default=0)
+    arg_parser.add_argument("--validation", choices=['full', 'sample', 'none'], default='none')
+    arg_parser.add_argument("--flush-rows", type=int, default=0)
+    arg_parser.add_argument("-o", "--output", default=None, help="JSON file of the results")
+    arg_parser.add_argument("--baseline", default=None,
+                            help="JSON results of an earlier run to compare with")
+    args = arg_parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = args.data_dir or tmp_dir
+        dataset = generate_dataset(data_dir, args.patients, args.resources, args.template_dir)
+        stages = asyncio.run(run(data_dir, dataset, args.sink, args.workers, args.validation,
+                                 args.flush_rows))
+    results = {"commit": _commit(), "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S'),
+               "python": platform.python_version(),
+               "params": {k: v for k, v in vars(args).items()
+                          if k not in ('output', 'baseline')},
+               "dataset": dataset, "stages": stages}
+    for stage, figures in stages.items():
+        print(f"{stage:11s} {figures['seconds']:8.2f}s {figures['files_per_s']:9.1f} files/s "
+              f"{figures['resources_per_s']:10.1f} resources/s {figures['mb_per_s']:7.2f} MB/s "
+              f"{figures['peak_rss_mb']:8.1f} MB peak RSS")
+    if args.baseline:
+        with open(args.baseline, encoding='UTF-8') as fp:
+            print("\n".join(compare(results, json.load(fp))))
+    if args.output:
+        with open(args.output, 'w', encoding='UTF-8') as fp:
+            json.dump(results, fp, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""Cold-start benchmark of the main.py CLI. Every scenario runs main.py in a new interpreter
+with -X importtime, several times, and reports the median wall time, the time spent in
+imports and which heavy packages were loaded. --repo-dir runs the main.py of another checkout
+(e.g. a git worktree of an older commit), so that start-up times before and after a change
+can be compared, or saved with -o and compared later with --baseline.
+Usage: python -m benchmarks.bench_startup [--repeat 5] [--repo-dir DIR] [-o results.json]
+       [--baseline previous.json]"""
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from benchmarks.synthetic import generate_dataset, DATA_DIR
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+HEAVY_PACKAGES = ('pandas', 'pyarrow', 'sqlalchemy', 'psycopg2', 'aiohttp', 'aiofiles',
+                  'fhir.resources')
+
+def scenarios(data_dir: str, output_dir: str) -> dict:
+    """Returns the main.py arguments of every scenario
+    Input: data_dir=Directory of a small bundle dataset
+           output_dir=Output directory of the file sinks"""
+    local = ['-m', 'local_disk', '-d', data_dir, '--sink', 'parquet', '-o', output_dir]
+    return {"help": ['--help'],
+            "local_parquet": local + ['--validation', 'none'],
+            "local_parquet_validated": local + ['--validation', 'full']}
+
+def _import_profile(stderr: str) -> tuple:
+    """Parses the -X importtime output
+    Returns: Tuple of the import time in ms and the set of imported module names"""
+    total_us = 0
+    modules = set()
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split('|')
+        modules.add(name.strip())
+        # Top level imports are indented by one space, nested ones by more
+        if len(name) - len(name.lstrip()) == 1:
+            total_us += int(cumulative)
+    return total_us / 1000, modules
+
+def run_scenario(repo_dir: str, args: list, repeat: int, cwd: str) -> dict:
+    """Runs main.py repeat times in new interpreters
+    Returns: Dictionary of the median wall and import times and the loaded heavy packages"""
+    script = os.path.join(os.path.abspath(repo_dir), 'main.py')
+    walls, imports, loaded = [], [], set()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        proc = subprocess.run([sys.executable, '-X', 'importtime', script] + args, cwd=cwd,
+                              capture_output=True, text=True, check=False)
+        walls.append(time.perf_counter() - start)
+        import_ms, modules = _import_profile(proc.stderr)
+        imports.append(import_ms)
+        loaded = {p for p in HEAVY_PACKAGES if p in modules}
+    return {"wall_ms": round(statistics.median(walls) * 1000, 1),
+            "import_ms": round(statistics.median(imports), 1),
+            "exit_code": proc.returncode, "heavy_imports": sorted(loaded)}
+
+def _commit(repo_dir: str) -> str:
+    """Returns the git commit of repo_dir, None outside of a git checkout"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_dir,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results: dict, baseline: dict) -> list:
+    """Compares the wall time of every scenario with a baseline result file
+    Returns: List of report lines"""
+    lines = []
+    for name, figures in results["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(name)
+        if base:
+            change = figures["wall_ms"] / base["wall_ms"] - 1
+            lines.append(f"{name:24s} {change:+7.1%} wall time vs {baseline.get('commit')}")
+    return lines
+
+def main():
+    """Parses the arguments, generates a small dataset and runs the scenarios"""
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument("--repo-dir", default=REPO_DIR,
+                            help="Directory of the main.py to benchmark")
+    arg_parser.add_argument("--repeat", type=int, default=5)
+    arg_parser.add_argument("--template-dir", default=DATA_DIR)
+    arg_parser.add_argument("-o", "--output", default=None, help="JSON file of the results")
+    arg_parser.add_argument("--baseline", default=None,
+                            help="JSON results of an earlier run to compare with")
+    args = arg_parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = os.path.join(tmp_dir, "data")
+        generate_dataset(data_dir, 1, 20, args.template_dir)
+        runs = {name: run_scenario(args.repo_dir, main_args, args.repeat, tmp_dir)
+                for name, main_args in scenarios(data_dir,
+                                                 os.path.join(tmp_dir, "output")).items()}
+    results = {"commit": _commit(args.repo_dir),
+               "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S'),
+               "python": platform.python_version(), "repeat": args.repeat,
+               "scenarios": runs}
+    for name, figures in runs.items():
+        print(f"{name:24s} {figures['wall_ms']:8.1f} ms wall {figures['import_ms']:8.1f} ms "
+              f"imports  exit {figures['exit_code']}  {', '.join(figures['heavy_imports'])}")
+    if args.baseline:
+        with open(args.baseline, encoding='UTF-8') as fp:
+            print("\n".join(compare(results, json.load(fp))))
+    if args.output:
+        with open(args.output, 'w', encoding='UTF-8') as fp:
+            json.dump(results, fp, indent=2)
+
+if __name__ == '__main__':
+    main()
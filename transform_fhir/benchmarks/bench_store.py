@@ -0,0 +1,67 @@
+"""Benchmark of the storage stage. The StoreFhir load methods run against the database
+configured with the POSTGRES_* environment variables (see .env), each loading the same
+synthetic batches into its own table. The parquet and csv FileSink formats write to a
+temporary directory. Rows per second are printed for every method.
+Usage: python -m benchmarks.bench_store [--batches 20] [--rows 2000] [--columns 30] [--no-db]"""
+import tempfile
+import time
+from argparse import ArgumentParser
+import pandas as pd
+from sqlalchemy import create_engine, text
+from store_fhir_records.store_fhir import StoreFhir, LOAD_METHODS
+from store_fhir_records.file_sink import FileSink, FILE_FORMATS
+
+def _make_batch(batch_no: int, rows: int, columns: int) -> pd.DataFrame:
+    """Synthetic dataframe shaped like a flattened Observation batch"""
+    data = {"id": [f"{batch_no}-{i}" for i in range(rows)]}
+    for c in range(columns):
+        data[f"col{c}"] = [f'{{"system": "http://loinc.org", "code": "{i % 97}-{c}"}}'
+                           for i in range(rows)]
+    return pd.DataFrame(data)
+
+def _run_db(method: str, frames: list) -> float:
+    """Loads the frames with a StoreFhir load method, returns elapsed seconds"""
+    store = StoreFhir(load_method=method)
+    table = f"bench_{method}"
+    engine = create_engine(store.connection_str)
+    with engine.begin() as con:
+        con.execute(text(f'DROP TABLE IF EXISTS "{table}"'))
+    start = time.perf_counter()
+    for df in frames:
+        if method == 'copy':
+            store.copy_batch(engine, {table: df})
+        else:
+            store.to_sql_batch(engine, {table: df})
+    elapsed = time.perf_counter() - start
+    engine.dispose()
+    return elapsed
+
+def _run_file(file_format: str, frames: list) -> float:
+    """Writes the frames with a FileSink format, returns elapsed seconds"""
+    with tempfile.TemporaryDirectory() as output_dir:
+        sink = FileSink(output_dir=output_dir, file_format=file_format)
+        start = time.perf_counter()
+        for df in frames:
+            sink.write_table("Observation", df)
+        return time.perf_counter() - start
+
+def run(batches: int, rows: int, columns: int, use_db=True) -> dict:
+    """Stores the batches with every method and returns rows per second by method"""
+    frames = [_make_batch(b, rows, columns) for b in range(batches)]
+    elapsed = {}
+    if use_db:
+        for method in LOAD_METHODS:
+            elapsed[method] = _run_db(method, frames)
+    for file_format in FILE_FORMATS:
+        elapsed[file_format] = _run_file(file_format, frames)
+    return {name: round(batches * rows / secs, 1) for name, secs in elapsed.items()}
+
+if __name__ == '__main__':
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument("--batches", type=int, default=20)
+    arg_parser.add_argument("--rows", type=int, default=2000)
+    arg_parser.add_argument("--columns", type=int, default=30)
+    arg_parser.add_argument("--no-db", action='store_true', help="Benchmark the file sinks only")
+    args = arg_parser.parse_args()
+    for name, rows_per_sec in run(args.batches, args.rows, args.columns, not args.no_db).items():
+        print(f"{name:8s} {rows_per_sec:12.1f} rows/s")
@@ -0,0 +1,136 @@
+"""Local stand-in of the github urls read by the get_folder_url and get_file_url modes, so
+that the url readers run offline. The json files of a directory are listed at
+<base>/repo/tree/main/data/ in the github tree format ({"payload": {"tree": {"items":
+[{"name": ...}]}}}) and served at <base>/repo/raw/main/data/<name>, the url the reader
+derives from the folder url. Files are streamed from disk with ETag and Last-Modified,
+and conditional requests matching them are answered with 304. The first failures file
+requests can be answered with 503 to exercise the retries of the reader.
+Usage: python -m benchmarks.fhir_server [-d ../data] [--port 8080]"""
+import asyncio
+import os
+import threading
+from argparse import ArgumentParser
+from aiohttp import web
+from benchmarks.synthetic import DATA_DIR
+
+FOLDER_PATH = '/repo/tree/main/data'
+RAW_PATH = '/repo/raw/main/data'
+
+class LocalFhirServer:
+    """aiohttp server of the json files of data_dir. port=0 picks a free port."""
+    def __init__(self, data_dir: str, host: str = '127.0.0.1', port: int = 0,
+                 failures: int = 0) -> None:
+        self.data_dir = data_dir
+        self.host = host
+        self.port = port
+        self.failures = failures
+        self.requests = 0
+        # (file name, status) of every file request
+        self.log = []
+        self._runner = None
+        self._thread_loop = None
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        """Root url of the server"""
+        return f"http://{self.host}:{self.port}"
+
+    @property
+    def folder_url(self) -> str:
+        """Url of the get_folder_url mode"""
+        return self.base_url + FOLDER_PATH
+
+    def file_url(self, name: str) -> str:
+        """Url of the get_file_url mode for one file of data_dir"""
+        return f"{self.base_url}{RAW_PATH}/{name}"
+
+    def file_names(self) -> list:
+        """Returns the json file names of data_dir, sorted"""
+        return sorted(entry.name for entry in os.scandir(self.data_dir)
+                      if entry.is_file() and entry.name.endswith('.json'))
+
+    async def _listing(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        items = [{"name": name, "path": f"data/{name}", "contentType": "file"}
+                 for name in self.file_names()]
+        return web.json_response({"payload": {"tree": {"items": items}}})
+
+    async def _raw_file(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        name = request.match_info["name"]
+        path = os.path.join(self.data_dir, name)
+        if self.failures > 0:
+            self.failures -= 1
+            return web.Response(status=503)
+        if os.path.basename(name) != name or not os.path.isfile(path):
+            raise web.HTTPNotFound()
+        return web.FileResponse(path, headers={"Content-Type": "application/json"})
+
+    async def _log_response(self, request: web.Request, response: web.StreamResponse):
+        """Records the status of the file requests, 304 included, once it is known"""
+        if "name" in request.match_info:
+            self.log.append((request.match_info["name"], response.status))
+
+    async def start(self) -> 'LocalFhirServer':
+        """Starts serving, the port is known once started
+        Returns: The server object"""
+        app = web.Application()
+        app.router.add_get(FOLDER_PATH + '/', self._listing)
+        app.router.add_get(FOLDER_PATH, self._listing)
+        app.router.add_get(RAW_PATH + '/{name}', self._raw_file)
+        app.on_response_prepare.append(self._log_response)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self
+
+    async def close(self):
+        """Stops the server"""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def start_thread(self) -> 'LocalFhirServer':
+        """Starts serving on the event loop of a daemon thread, so that the server does not
+        share the event loop of the pipeline it feeds
+        Returns: The server object"""
+        self._thread_loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._thread_loop.run_forever,
+                                        name="fhir_server", daemon=True)
+        self._thread.start()
+        return asyncio.run_coroutine_threadsafe(self.start(), self._thread_loop).result()
+
+    def stop_thread(self):
+        """Stops the server and the event loop started by start_thread()"""
+        if self._thread_loop is not None:
+            asyncio.run_coroutine_threadsafe(self.close(), self._thread_loop).result()
+            self._thread_loop.call_soon_threadsafe(self._thread_loop.stop)
+            self._thread.join()
+            self._thread_loop.close()
+            self._thread_loop = self._thread = None
+
+    async def __aenter__(self) -> 'LocalFhirServer':
+        return await self.start()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+async def _serve(data_dir: str, port: int):
+    """Serves data_dir until interrupted"""
+    async with LocalFhirServer(data_dir, port=port) as server:
+        print(f"Serving {len(server.file_names())} files of {data_dir}")
+        print(f"get_folder_url: {server.folder_url}")
+        await asyncio.Event().wait()
+
+if __name__ == '__main__':
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument("-d", "--directory", default=DATA_DIR)
+    arg_parser.add_argument("--port", type=int, default=8080)
+    args = arg_parser.parse_args()
+    try:
+        asyncio.run(_serve(os.path.abspath(args.directory), args.port))
+    except KeyboardInterrupt:
+        pass
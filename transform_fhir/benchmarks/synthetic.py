@@ -0,0 +1,97 @@
+"""Synthetic Synthea-like bundle generator for the benchmarks. Bundles are built from the
+entries of template bundles (the files of data/): every bundle holds one Patient and
+resources_per_patient resources copied from the templates in their original mix and order,
+with all uuids (ids, fullUrls and references) replaced by new ones, so that every generated
+resource is distinct while keeping real shapes.
+Usage: python -m benchmarks.synthetic -o /tmp/synthetic [--patients 100] [--resources 500]"""
+import json
+import os
+import random
+import re
+import uuid
+from argparse import ArgumentParser
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'data')
+
+_UUID_RE = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+
+def load_templates(template_dir: str = DATA_DIR, count: int = 1) -> tuple:
+    """Reads the Patient entry and the other entries of the first count template bundles
+    Input: template_dir=Directory of the template bundles
+           count=Number of template files
+    Returns: Tuple of the Patient entry json and the list of other entry jsons"""
+    files = sorted(f for f in os.listdir(template_dir) if f.endswith('.json'))[:count]
+    patient, others = None, []
+    for name in files:
+        with open(os.path.join(template_dir, name), encoding='UTF-8') as fp:
+            bundle = json.load(fp)
+        for entry in bundle.get("entry", []):
+            if entry.get("resource", {}).get("resourceType") == "Patient":
+                patient = patient or json.dumps(entry)
+            else:
+                others.append(json.dumps(entry))
+    if patient is None:
+        raise ValueError(f"No Patient entry in the templates of {template_dir}")
+    return patient, others
+
+def _remap(text: str, mapping: dict, rng: random.Random) -> str:
+    """Replaces every uuid of a json text, the same uuid always by the same new one"""
+    return _UUID_RE.sub(
+        lambda m: mapping.setdefault(m.group(0), str(uuid.UUID(int=rng.getrandbits(128),
+                                                                version=4))), text)
+
+def generate_bundle(templates: tuple, resources: int, rng: random.Random,
+                    offset: int = 0) -> str:
+    """Builds one bundle json text
+    Input: templates=Output of load_templates()
+           resources=Number of resources besides the Patient
+           rng=Random generator of the new uuids
+           offset=Index of the first template entry, so that bundles get different mixes
+    Returns: Bundle json text"""
+    patient, others = templates
+    mapping = {}
+    entries = [_remap(patient, mapping, rng)]
+    patient_ids = dict(mapping)
+    for i in range(resources):
+        # Each pass over the templates gets new resource uuids, same patient uuid
+        if i and (offset + i) % len(others) == 0:
+            mapping = dict(patient_ids)
+        entries.append(_remap(others[(offset + i) % len(others)], mapping, rng))
+    return '{"resourceType": "Bundle", "type": "transaction", "entry": [' + \
+        ", ".join(entries) + ']}'
+
+def generate_dataset(output_dir: str, patients: int, resources: int,
+                     template_dir: str = DATA_DIR, templates: int = 1, seed: int = 0) -> dict:
+    """Writes one bundle file per patient to output_dir
+    Input: output_dir=Directory of the generated files
+           patients=Number of bundles
+           resources=Resources per bundle besides the Patient
+           template_dir=Directory of the template bundles
+           templates=Number of template files
+           seed=Seed of the uuids, the same arguments generate the same files
+    Returns: Dictionary of the number of files, resources and bytes"""
+    os.makedirs(output_dir, exist_ok=True)
+    template_entries = load_templates(template_dir, templates)
+    rng = random.Random(seed)
+    total_bytes = 0
+    for p in range(patients):
+        text = generate_bundle(template_entries, resources, rng, offset=p * 7)
+        path = os.path.join(output_dir, f"patient_{p:06d}.json")
+        with open(path, 'w', encoding='UTF-8') as fp:
+            fp.write(text)
+        total_bytes += len(text.encode('UTF-8'))
+    return {"files": patients, "resources": patients * (resources + 1), "bytes": total_bytes}
+
+if __name__ == '__main__':
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument("-o", "--output-dir", required=True)
+    arg_parser.add_argument("--patients", type=int, default=100)
+    arg_parser.add_argument("--resources", type=int, default=500,
+                            help="Resources per patient bundle besides the Patient")
+    arg_parser.add_argument("--template-dir", default=DATA_DIR)
+    arg_parser.add_argument("--templates", type=int, default=1,
+                            help="Number of template files taken from --template-dir")
+    arg_parser.add_argument("--seed", type=int, default=0)
+    args = arg_parser.parse_args()
+    print(generate_dataset(args.output_dir, args.patients, args.resources, args.template_dir,
+                           args.templates, args.seed))
@@ -0,0 +1,142 @@
+"""DeadLetterStore keeps the resources that failed to be transformed or stored, with their
+error, in a SQLite file, so that one bad resource does not stop the pipeline or lose the
+rest of its bundle. The failures can be fixed in place and replayed on their own with
+main.py --replay-dead-letters instead of reprocessing all the sources."""
+import json
+import logging
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from common.metrics import Metrics
+
+# Pipeline stages recording dead letters. 'transform' records hold the failed bundle entry
+# (or the whole bundle when it has no entry), 'store' records the rows of one resource
+DEAD_LETTER_STAGES = ('transform', 'store')
+
+def _json_default(value):
+    """json.dumps fallback for dates, timestamps and decimals of flattened rows"""
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value)
+
+def dead_letter(stage: str, payload: dict, error, resource_type: str = None,
+                resource_id: str = None) -> dict:
+    """Builds a dead letter record
+    Input: stage=One of DEAD_LETTER_STAGES
+           payload=json serializable failed data ({"entry": ...}, {"bundle": ...} or
+           {"tables": {table: rows}})
+           error=Exception or error message
+           resource_type, resource_id=Failed resource, when known
+    Returns: Dictionary of the record fields"""
+    if stage not in DEAD_LETTER_STAGES:
+        raise ValueError(f"Unknown dead letter stage {stage}")
+    return {"stage": stage, "payload": payload, "error": str(error),
+            "resource_type": resource_type, "resource_id": resource_id}
+
+class DeadLetterStore(object):
+    """A singleton class holding the dead letter database. Without a configured path the
+    failures are only logged. The database is created with the first failure, and is
+    shared by the writer threads of the store stage."""
+    _common_instance = None
+    def __new__(cls, *args, **kwargs):
+        if not isinstance(cls._common_instance, cls):
+            cls._common_instance = object.__new__(cls, *args, **kwargs)
+            cls._common_instance.path = None
+            cls._common_instance._con = None
+            cls._common_instance.configure()
+        return cls._common_instance
+
+    def configure(self, path: str = None):
+        """Sets the dead letter database, closing the previous one
+        Input: path=SQLite file path, None to only log the failures
+        Returns: None"""
+        self.close()
+        self.path = path
+        self._lock = threading.Lock()
+        # Ids of the records handed out for replay, marked replayed by commit_replay()
+        self.replaying = []
+        self.added = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        """Opens the database on first use"""
+        if self._con is None:
+            self._con = sqlite3.connect(self.path, timeout=60, isolation_level=None,
+                                        check_same_thread=False)
+            self._con.execute("CREATE TABLE IF NOT EXISTS dead_letters ("
+                              "id INTEGER PRIMARY KEY AUTOINCREMENT, stage TEXT NOT NULL, "
+                              "resource_type TEXT, resource_id TEXT, payload TEXT NOT NULL, "
+                              "error TEXT, created_at TEXT, replayed_at TEXT)")
+        return self._con
+
+    def add_many(self, records: list):
+        """Records failures built by dead_letter()
+        Input: records=List of dead letter records
+        Returns: None"""
+        for record in records:
+            logging.error("Dead letter (%s) %s/%s: %s", record["stage"],
+                          record["resource_type"], record["resource_id"], record["error"])
+            Metrics().inc("fhir_dead_letters_total", stage=record["stage"])
+        if not records or self.path is None:
+            return
+        now = datetime.now(timezone.utc).isoformat()
+        rows = [(r["stage"], r["resource_type"], r["resource_id"],
+                 json.dumps(r["payload"], default=_json_default), r["error"], now)
+                for r in records]
+        with self._lock:
+            self._connection().executemany(
+                "INSERT INTO dead_letters (stage, resource_type, resource_id, payload, error, "
+                "created_at) VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self.added += len(rows)
+
+    def add(self, stage: str, payload: dict, error, resource_type: str = None,
+            resource_id: str = None):
+        """Records one failure, see dead_letter() for the arguments"""
+        self.add_many([dead_letter(stage, payload, error, resource_type, resource_id)])
+
+    def pending(self, stage: str = None) -> list:
+        """Returns the records not replayed yet, oldest first, and remembers their ids for
+        commit_replay()
+        Input: stage=Only the records of this stage, all stages when None
+        Returns: List of dictionaries with id, stage, resource_type, resource_id, payload
+                 (decoded) and error"""
+        if self.path is None:
+            return []
+        query = ("SELECT id, stage, resource_type, resource_id, payload, error "
+                 "FROM dead_letters WHERE replayed_at IS NULL")
+        params = ()
+        if stage is not None:
+            query += " AND stage = ?"
+            params = (stage,)
+        with self._lock:
+            rows = self._connection().execute(query + " ORDER BY id", params).fetchall()
+        records = [{"id": row[0], "stage": row[1], "resource_type": row[2],
+                    "resource_id": row[3], "payload": json.loads(row[4]), "error": row[5]}
+                   for row in rows]
+        self.replaying.extend(r["id"] for r in records)
+        return records
+
+    def commit_replay(self):
+        """Marks the records handed out by pending() as replayed. Called after a successful
+        replay run, records failing again were added as new ones."""
+        if not self.replaying:
+            return
+        now = datetime.now(timezone.utc).isoformat()
+        with self._lock:
+            self._connection().executemany(
+                "UPDATE dead_letters SET replayed_at = ? WHERE id = ?",
+                [(now, rid) for rid in self.replaying])
+        self.replaying = []
+
+    def count(self) -> int:
+        """Returns the number of records not replayed yet"""
+        if self.path is None:
+            return 0
+        with self._lock:
+            return self._connection().execute(
+                "SELECT count(*) FROM dead_letters WHERE replayed_at IS NULL").fetchone()[0]
+
+    def close(self):
+        """Closes the database"""
+        if self._con is not None:
+            self._con.close()
+            self._con = None
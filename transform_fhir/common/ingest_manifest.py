@@ -0,0 +1,97 @@
+"""IngestManifest keeps a persistent record (SQLite file) of the ingested source files and
+urls with their size, mtime, ETag/Last-Modified and content hash. Readers consult it to skip
+unchanged sources, and the records of a run are committed only once the run succeeded,
+so a failed load is picked up again by the next run."""
+import hashlib
+import logging
+import sqlite3
+from datetime import datetime, timezone
+
+def content_hash(data) -> str:
+    """Returns the sha256 hex digest of str or bytes content"""
+    if isinstance(data, str):
+        data = data.encode('UTF-8')
+    return hashlib.sha256(data).hexdigest()
+
+class IngestManifest:
+    """Manifest of ingested sources keyed by file path or url"""
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._con = sqlite3.connect(path)
+        self._con.execute("CREATE TABLE IF NOT EXISTS manifest ("
+                          "source TEXT PRIMARY KEY, size INTEGER, mtime REAL, etag TEXT, "
+                          "last_modified TEXT, sha256 TEXT, ingested_at TEXT)")
+        self._con.commit()
+        self.pending = {}
+        self.skipped = 0
+
+    def get(self, source: str) -> dict:
+        """Returns the committed record of a source
+        Input: source=File path or url
+        Returns: Dictionary of the record columns, None for a new source"""
+        cur = self._con.execute("SELECT size, mtime, etag, last_modified, sha256 FROM manifest "
+                                "WHERE source = ?", (source,))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        return dict(zip(("size", "mtime", "etag", "last_modified", "sha256"), row))
+
+    def unchanged_stat(self, source: str, size: int, mtime: float) -> bool:
+        """Tells if a local file has the size and mtime recorded by the last run, so that it
+        can be skipped without reading it
+        Input: source=File path
+               size=File size in bytes
+               mtime=File modification time
+        Returns: Boolean value"""
+        record = self.get(source)
+        if record is not None and record["size"] == size and record["mtime"] == mtime:
+            self.skipped += 1
+            return True
+        return False
+
+    def changed_content(self, source: str, data=None, size=None, mtime=None, etag=None,
+                        last_modified=None, digest=None) -> bool:
+        """Records the new state of a source and tells if its content changed. A source
+        with new metadata but the same content hash is not processed again.
+        Input: source=File path or url
+               data=Source content as str or bytes
+               size, mtime=Stat of a local file
+               etag, last_modified=Validators of a http response
+               digest=sha256 hex digest of a content hashed while streaming, instead of data
+        Returns: True when the content is new or changed"""
+        digest = digest or content_hash(data)
+        record = self.get(source)
+        self.record(source, size=size, mtime=mtime, etag=etag, last_modified=last_modified,
+                    sha256=digest)
+        if record is not None and record["sha256"] == digest:
+            self.skipped += 1
+            return False
+        return True
+
+    def record(self, source: str, **fields):
+        """Stages the state of a source, written by commit()
+        Input: source=File path or url
+               fields=size, mtime, etag, last_modified and sha256 values
+        Returns: None"""
+        self.pending[source] = fields
+
+    def commit(self, records: dict = None):
+        """Writes the staged records in one transaction. Called after a successful run.
+        Input: records=Snapshot of pending whose sources are stored, all the staged records
+               by default. Sources staged again since the snapshot stay pending.
+        Returns: None"""
+        records = self.pending if records is None else records
+        now = datetime.now(timezone.utc).isoformat()
+        with self._con:
+            self._con.executemany(
+                "INSERT OR REPLACE INTO manifest VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(source, f.get("size"), f.get("mtime"), f.get("etag"), f.get("last_modified"),
+                  f.get("sha256"), now) for source, f in records.items()])
+        logging.info("Manifest %s: %d sources recorded, %d unchanged skipped", self.path,
+                     len(records), self.skipped)
+        self.pending = {source: f for source, f in self.pending.items()
+                        if records.get(source) != f}
+
+    def close(self):
+        """Closes the manifest database"""
+        self._con.close()
@@ -0,0 +1,170 @@
+"""Metrics holds the counters, latency histograms and gauges of the pipeline stages and
+renders them in the Prometheus text format (served on /metrics or written to a file) and as
+a summary at exit. Recording is a dictionary update under a lock, cheap enough for the hot
+paths and safe for the database writer threads."""
+import logging
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import perf_counter
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0)
+
+class Histogram:
+    """Latency histogram with fixed buckets"""
+    def __init__(self, buckets=LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        """Adds one observation"""
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """Returns the upper bound of the bucket holding the q quantile, None when empty"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+def _labels(labels: tuple, extra: str = None) -> str:
+    """Formats a label tuple as {name="value",...}"""
+    parts = [f'{k}="{v}"' for k, v in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Metrics(object):
+    """A singleton class holding the metrics of the process"""
+    _common_instance = None
+    def __new__(cls, *args, **kwargs):
+        if not isinstance(cls._common_instance, cls):
+            cls._common_instance = object.__new__(cls, *args, **kwargs)
+            cls._common_instance.reset()
+        return cls._common_instance
+
+    def reset(self):
+        """Discards all the recorded values and gauges"""
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """Increments a counter
+        Input: name=Metric name
+               value=Increment
+               labels=Label values of the series"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        """Adds a latency observation to a histogram
+        Input: name=Metric name
+               seconds=Observed latency
+               labels=Label values of the series"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """Context manager observing the time spent in its block"""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start, **labels)
+
+    def gauge(self, name: str, func, **labels):
+        """Registers a gauge read when the metrics are rendered
+        Input: name=Metric name
+               func=Callable returning the current value
+               labels=Label values of the series"""
+        self.gauges[(name, tuple(sorted(labels.items())))] = func
+
+    def render(self) -> str:
+        """Returns all the metrics in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{_labels(labels)} {value}")
+        for (name, labels), hist in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, count in zip(hist.buckets, hist.counts):
+                cumulative += count
+                bucket = _labels(labels, 'le="%s"' % bound)
+                lines.append(f"{name}_bucket{bucket} {cumulative}")
+            bucket = _labels(labels, 'le="+Inf"')
+            lines.append(f"{name}_bucket{bucket} {hist.count}")
+            lines.append(f"{name}_sum{_labels(labels)} {hist.sum:.6f}")
+            lines.append(f"{name}_count{_labels(labels)} {hist.count}")
+        for (name, labels), func in sorted(self.gauges.items(), key=lambda item: item[0]):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name}{_labels(labels)} {func()}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        """Writes the Prometheus text format to a file (node_exporter textfile collector)"""
+        with open(path, 'w', encoding='UTF-8') as fp:
+            fp.write(self.render())
+
+    async def serve(self, port: int, host: str = '0.0.0.0'):
+        """Serves the metrics on http://host:port/metrics
+        Input: port=Listening port
+               host=Listening address
+        Returns: aiohttp runner object, to be cleaned up by the caller"""
+        from aiohttp import web
+        async def handler(request):
+            return web.Response(text=self.render(), content_type='text/plain',
+                                headers={"Cache-Control": "no-cache"})
+        app = web.Application()
+        app.router.add_get('/metrics', handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        logging.info("Serving metrics on http://%s:%d/metrics", host, port)
+        return runner
+
+    def summary(self) -> str:
+        """Returns a human readable summary of the latencies, counters and gauges"""
+        lines = []
+        with self._lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+        for (name, labels), hist in histograms:
+            mean = hist.sum / hist.count if hist.count else 0
+            lines.append(f"{name}{_labels(labels)}: count={hist.count} total={hist.sum:.3f}s "
+                         f"mean={mean * 1000:.2f}ms p50<={hist.quantile(0.5)}s "
+                         f"p95<={hist.quantile(0.95)}s p99<={hist.quantile(0.99)}s")
+        for (name, labels), value in counters:
+            lines.append(f"{name}{_labels(labels)}: {value}")
+        for (name, labels), func in sorted(self.gauges.items(), key=lambda item: item[0]):
+            lines.append(f"{name}{_labels(labels)}: {func()}")
+        return "\n".join(lines)
@@ -0,0 +1,177 @@
+"""PipelineQueue is the base class of FhirQueue and StorageQueue. It holds a queue backend
+(an in-process async Queue by default, or a durable one shared by several processes) with
+optional bounds and high/low watermarks, so that a slow consumer applies backpressure to the
+producers, and counts queue depth and wait times to tell which pipeline stage is the
+bottleneck."""
+import asyncio
+from asyncio import QueueEmpty
+from time import perf_counter
+from common.queue_backend import MemoryQueueBackend
+from common.metrics import Metrics
+
+class PipelineQueue(object):
+    """A singleton (per subclass) class holding the queue backend and its counters"""
+    _common_instance = None
+    _backend = None
+    def __new__(cls, *args, **kwargs):
+        if not isinstance(cls._common_instance, cls):
+            cls._common_instance = object.__new__(cls, *args, **kwargs)
+            cls._common_instance.configure()
+        return cls._common_instance
+
+    def configure(self, maxsize=0, high_watermark=None, low_watermark=None, backend=None):
+        """(Re)creates the queue with the given bounds. Queued items (of the in-process backend)
+        and counters are discarded.
+        Input: maxsize=Hard limit of the queue, 0 for an unbounded queue
+               high_watermark=Queue depth at which producers are paused, defaults to maxsize
+               (0 disables the watermarks)
+               low_watermark=Queue depth at which paused producers resume, defaults to half
+               of the high watermark
+               backend=Queue backend object, defaults to a MemoryQueueBackend of maxsize
+        Returns: None"""
+        high_watermark = maxsize if high_watermark is None else high_watermark
+        low_watermark = high_watermark // 2 if low_watermark is None else low_watermark
+        if maxsize < 0 or high_watermark < 0 or not 0 <= low_watermark <= high_watermark:
+            raise ValueError("Invalid queue bounds: maxsize=%d, watermarks=%d/%d"
+                             % (maxsize, high_watermark, low_watermark))
+        if self.__class__._backend is not None:
+            self.__class__._backend.close()
+        self.__class__._backend = MemoryQueueBackend(maxsize) if backend is None else backend
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self._resume = asyncio.Event()
+        self._resume.set()
+        self.enqueued = 0
+        self.dequeued = 0
+        self.acked = 0
+        self.max_depth = 0
+        self.pause_count = 0
+        self.put_wait_time = 0.0
+        self.get_wait_time = 0.0
+
+    def queue_size(self):
+        """Returns queue size. For a durable backend this is the depth of its last count,
+        so that logs and metrics never wait for the database.
+        Input: None
+        Returns: Number of items in the queue"""
+        return self._backend.qsize()
+
+    def empty(self):
+        """Bool value to tell if queue is empty or not
+        Input: None
+        Returns: Boolean value to tell to the queue is empty or not"""
+        return self.queue_size() == 0
+
+    def stats(self) -> dict:
+        """Returns queue counters
+        Input: None
+        Returns: Dictionary of queue depth, item counts and total wait times in seconds"""
+        return {"depth": self.queue_size(), "max_depth": self.max_depth,
+                "enqueued": self.enqueued, "dequeued": self.dequeued, "acked": self.acked,
+                "pause_count": self.pause_count,
+                "put_wait_seconds": round(self.put_wait_time, 6),
+                "get_wait_seconds": round(self.get_wait_time, 6)}
+
+    def register_metrics(self, name: str):
+        """Exposes the queue depth and counters as gauges of the Metrics singleton
+        Input: name=Value of the queue label
+        Returns: None"""
+        metrics = Metrics()
+        metrics.gauge("fhir_queue_depth", self.queue_size, queue=name)
+        for key in ("max_depth", "enqueued", "dequeued", "pause_count", "put_wait_seconds",
+                    "get_wait_seconds"):
+            metrics.gauge(f"fhir_queue_{key}", lambda key=key: self.stats()[key], queue=name)
+
+    async def enqueue(self, item):
+        """Push an item to queue. Waits while the queue is above its high watermark
+        until consumers drain it down to the low watermark.
+        Input: item: Python object representing fhir data"""
+        start = perf_counter()
+        if not self._resume.is_set():
+            await self._wait_resume()
+        await self._backend.put(item)
+        self.put_wait_time += perf_counter() - start
+        self.enqueued += 1
+        depth = await self._backend.depth()
+        self.max_depth = max(self.max_depth, depth)
+        if self.high_watermark and depth >= self.high_watermark and self._resume.is_set():
+            self.pause_count += 1
+            self._resume.clear()
+
+    async def _wait_resume(self):
+        """Waits until the queue is drained down to the low watermark. Consumers of a durable
+        backend run in other processes, so its depth is polled."""
+        if not self._backend.durable:
+            await self._resume.wait()
+            return
+        while await self._backend.depth() > self.low_watermark:
+            await asyncio.sleep(self._backend.poll_interval)
+        self._resume.set()
+
+    async def _item_taken(self):
+        """Updates counters after an item is taken and resumes paused producers"""
+        self.dequeued += 1
+        if not self._resume.is_set() and await self._backend.depth() <= self.low_watermark:
+            self._resume.set()
+
+    async def open_producer(self, shard_id: int = 0):
+        """Registers this process as producer shard shard_id of a durable queue. Its end
+        marker of an earlier run is cleared.
+        Input: shard_id=Shard id of the producer
+        Returns: None"""
+        await self._backend.open_producer(shard_id)
+
+    async def ack(self, count: int = 1):
+        """Acknowledges the count oldest dequeued items once they are processed, so that a
+        durable queue can delete them. Unacknowledged items of a crashed consumer are
+        handed out again.
+        Input: count=Number of processed items
+        Returns: None"""
+        if count > 0:
+            await self._backend.ack(count)
+            self.acked += count
+
+    async def dequeue(self, timeout: float = None):
+        """Pops an item from the queue and returns it
+        Input: timeout=Seconds to wait for an item, None waits until one is queued
+        Returns: Poped value from the queue, raises asyncio.TimeoutError when no item was
+                 queued within timeout seconds"""
+        start = perf_counter()
+        try:
+            if timeout is None:
+                ret_val = await self._backend.get()
+            else:
+                ret_val = await asyncio.wait_for(self._backend.get(), timeout)
+        finally:
+            self.get_wait_time += perf_counter() - start
+        await self._item_taken()
+        return ret_val
+
+    async def dequeue_batch(self, max_items: int, max_wait: float = 0,
+                            timeout: float = None) -> list:
+        """Waits for the first item and then pops up to max_items items. Further items are
+        waited for at most max_wait seconds. A None sentinel ends the batch.
+        Input: max_items=Maximum number of items to return
+               max_wait=Maximum time in seconds to wait for the batch to fill up
+               timeout=Seconds to wait for the first item, None waits until one is queued
+        Returns: List of poped values, raises asyncio.TimeoutError when no item was queued
+                 within timeout seconds"""
+        items = [await self.dequeue(timeout)]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + max_wait
+        while len(items) < max_items and items[-1] is not None:
+            try:
+                items.append(await self._backend.get_nowait())
+            except QueueEmpty:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                start = perf_counter()
+                try:
+                    items.append(await asyncio.wait_for(self._backend.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+                finally:
+                    self.get_wait_time += perf_counter() - start
+            await self._item_taken()
+        return items
@@ -0,0 +1,234 @@
+"""Queue backends of FhirQueue and StorageQueue. MemoryQueueBackend keeps the items in an
+asyncio Queue of the process (default). SqliteQueueBackend keeps them in a SQLite file shared
+by the ingest, transform and store processes of a host (or hosts sharing the file system):
+items are leased to one consumer and deleted when acknowledged, leases of crashed consumers
+expire and the items are handed out again."""
+import asyncio
+import os
+import pickle
+import socket
+import sqlite3
+import threading
+from asyncio import Queue, QueueEmpty
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+QUEUE_BACKENDS = ('memory', 'sqlite')
+
+class MemoryQueueBackend:
+    """In-process backend. A None item is the end of stream sentinel and is taken by
+    one consumer. Acknowledgements are not needed."""
+    durable = False
+
+    def __init__(self, maxsize: int = 0) -> None:
+        self._queue = Queue(maxsize)
+
+    def qsize(self) -> int:
+        """Returns the number of items waiting in the queue"""
+        return self._queue.qsize()
+
+    async def depth(self) -> int:
+        """Returns the number of items waiting in the queue"""
+        return self._queue.qsize()
+
+    async def put(self, item):
+        """Puts an item, waits while the queue is full"""
+        await self._queue.put(item)
+
+    async def get(self):
+        """Waits for an item and returns it"""
+        return await self._queue.get()
+
+    async def get_nowait(self):
+        """Returns an item, raises QueueEmpty when there is none"""
+        return self._queue.get_nowait()
+
+    async def open_producer(self, shard_id: int):
+        """Registers a producer, nothing to do in process"""
+
+    async def ack(self, count: int):
+        """Acknowledges processed items, nothing to do in process"""
+
+    def close(self):
+        """Releases the backend resources"""
+
+class SqliteQueueBackend:
+    """Durable backend storing pickled items in the queue_items table of a SQLite file.
+    A producer ends the stream with a None item, recorded as a marker of its shard. get()
+    returns None once the markers of all producers are there and no item is left but the
+    ones leased by this process. Blocking SQLite calls run in a single thread, off the
+    event loop."""
+    durable = True
+
+    def __init__(self, path: str, name: str, maxsize: int = 0, producers: int = 1,
+                 lease_timeout: float = 600, poll_interval: float = 0.05) -> None:
+        self.path = path
+        self.name = name
+        self.maxsize = maxsize
+        # Number of producer shards whose end markers finish the stream
+        self.producers = producers
+        self.lease_timeout = lease_timeout
+        self.poll_interval = poll_interval
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.shard_id = 0
+        # Sequence numbers of the leased items, in the order they were taken
+        self._leased = []
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="queue_" + name)
+        # The connection is used by the backend thread and by close() on the event loop
+        self._lock = threading.Lock()
+        self._con = sqlite3.connect(path, timeout=60, isolation_level=None,
+                                    check_same_thread=False)
+        self._con.execute("PRAGMA journal_mode=WAL")
+        self._con.execute("PRAGMA synchronous=NORMAL")
+        self._con.execute("CREATE TABLE IF NOT EXISTS queue_items ("
+                          "seq INTEGER PRIMARY KEY AUTOINCREMENT, queue TEXT NOT NULL, "
+                          "payload BLOB, leased_by TEXT, leased_at REAL)")
+        self._con.execute("CREATE INDEX IF NOT EXISTS queue_items_queue "
+                          "ON queue_items (queue, leased_by, seq)")
+        self._con.execute("CREATE TABLE IF NOT EXISTS queue_producers ("
+                          "queue TEXT NOT NULL, shard INTEGER NOT NULL, PRIMARY KEY (queue, shard))")
+        # Depth of the last count of the backend thread, read by qsize() without blocking
+        # the event loop on the database
+        self._depth = 0
+        self._count()
+
+    async def _run(self, func, *args):
+        """Runs a blocking SQLite call in the backend thread"""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _execute(self, sql: str, params=()):
+        """Executes one statement under the connection lock
+        Returns: First result row, None when there is none"""
+        with self._lock:
+            return self._con.execute(sql, params).fetchone()
+
+    def _count(self) -> int:
+        """Counts the items waiting in the queue, leased items excluded"""
+        self._depth = self._execute("SELECT count(*) FROM queue_items WHERE queue = ? AND "
+                                    "(leased_by IS NULL OR leased_at < ?)",
+                                    (self.name, time() - self.lease_timeout))[0]
+        return self._depth
+
+    def qsize(self) -> int:
+        """Returns the number of waiting items of the last count, without touching the
+        database. Items put or taken by other processes since then are not seen."""
+        return self._depth
+
+    async def depth(self) -> int:
+        """Counts the items waiting in the queue in the backend thread, leased items
+        excluded"""
+        return await self._run(self._count)
+
+    def _insert(self, payload: bytes):
+        self._execute("INSERT INTO queue_items (queue, payload) VALUES (?, ?)",
+                      (self.name, payload))
+
+    def _mark_done(self, shard_id: int):
+        self._execute("INSERT OR IGNORE INTO queue_producers VALUES (?, ?)",
+                      (self.name, shard_id))
+
+    def _clear_done(self, shard_id: int):
+        self._execute("DELETE FROM queue_producers WHERE queue = ? AND shard = ?",
+                      (self.name, shard_id))
+
+    async def put(self, item):
+        """Stores an item, waits while maxsize items are waiting. A None item records the
+        end marker of the producer shard."""
+        if item is None:
+            await self._run(self._mark_done, self.shard_id)
+            return
+        while self.maxsize and await self.depth() >= self.maxsize:
+            await asyncio.sleep(self.poll_interval)
+        await self._run(self._insert, pickle.dumps(item, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def _claim(self):
+        """Leases the oldest waiting item (or one with an expired lease)
+        Returns: Tuple of the sequence number and the payload, None when the queue is empty"""
+        now = time()
+        return self._execute(
+            "UPDATE queue_items SET leased_by = ?, leased_at = ? WHERE seq = ("
+            "SELECT seq FROM queue_items WHERE queue = ? AND "
+            "(leased_by IS NULL OR leased_at < ?) ORDER BY seq LIMIT 1) RETURNING seq, payload",
+            (self.owner, now, self.name, now - self.lease_timeout))
+
+    def _finished(self) -> bool:
+        """Tells if all producers are done and no item is left but the own leased ones"""
+        done = self._execute("SELECT count(*) FROM queue_producers WHERE queue = ?",
+                             (self.name,))[0]
+        if done < self.producers:
+            return False
+        return self._execute(
+            "SELECT NOT EXISTS (SELECT 1 FROM queue_items WHERE queue = ? AND "
+            "(leased_by IS NULL OR leased_by != ? OR leased_at < ?))",
+            (self.name, self.owner, time() - self.lease_timeout))[0] == 1
+
+    def _release(self, seq: int):
+        self._execute("UPDATE queue_items SET leased_by = NULL WHERE seq = ?", (seq,))
+
+    async def get_nowait(self):
+        """Leases an item and returns it, raises QueueEmpty when there is none. Returns
+        None when the stream is finished."""
+        future = asyncio.get_running_loop().run_in_executor(self._executor, self._claim)
+        try:
+            row = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # A lease taken by a cancelled get is given back
+            future.add_done_callback(self._release_cancelled)
+            raise
+        if row is None:
+            if await self._run(self._finished):
+                return None
+            raise QueueEmpty()
+        self._leased.append(row[0])
+        return pickle.loads(row[1])
+
+    def _release_cancelled(self, future):
+        """Done callback giving back the item claimed for a cancelled get"""
+        if not future.cancelled() and future.exception() is None and future.result():
+            self._executor.submit(self._release, future.result()[0])
+
+    async def get(self):
+        """Waits for an item, polling the database, and leases it. Returns None when the
+        stream is finished."""
+        while True:
+            try:
+                return await self.get_nowait()
+            except QueueEmpty:
+                await asyncio.sleep(self.poll_interval)
+
+    async def open_producer(self, shard_id: int):
+        """Registers the producer shard of this process and clears its end marker of an
+        earlier run"""
+        self.shard_id = shard_id
+        await self._run(self._clear_done, shard_id)
+
+    def _delete(self, seqs: list):
+        with self._lock:
+            self._con.executemany("DELETE FROM queue_items WHERE seq = ?",
+                                  [(seq,) for seq in seqs])
+
+    async def ack(self, count: int):
+        """Deletes the count oldest leased items, once they are processed"""
+        seqs, self._leased = self._leased[:count], self._leased[count:]
+        if seqs:
+            await self._run(self._delete, seqs)
+
+    def close(self):
+        """Closes the database, leased items are handed out again after the lease timeout"""
+        self._executor.shutdown()
+        self._con.close()
+
+def create_backend(kind: str, name: str, maxsize: int = 0, path: str = 'queues.db',
+                   producers: int = 1):
+    """Creates a queue backend
+    Input: kind=One of QUEUE_BACKENDS
+           name=Queue name, items of the queues sharing a SQLite file are kept apart by name
+           maxsize=Maximum number of waiting items, 0 for no limit
+           path=SQLite file of the durable backend
+           producers=Number of producer shards of the durable backend
+    Returns: Backend object"""
+    if kind == 'memory':
+        return MemoryQueueBackend(maxsize)
+    if kind == 'sqlite':
+        return SqliteQueueBackend(path, name, maxsize, producers)
+    raise ValueError(f"Unknown queue backend {kind}")
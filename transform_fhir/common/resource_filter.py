@@ -0,0 +1,118 @@
+"""ResourceFilter routes the bundle entries by resourceType and projects the resources on
+the configured field paths. The reader drops the entries of unwanted resourceTypes before a
+bundle is parsed by fhir.resources or queued, the transform drops them before validation
+and removes the unwanted elements before flattening, so that skipped resources and fields
+are neither validated, flattened nor stored.
+The config is a json file with any of the keys
+    {"include_types": ["Patient", "Observation"], "exclude_types": ["Provenance"],
+     "include_fields": ["Patient.name", "Patient.birthDate"],
+     "exclude_fields": ["DiagnosticReport.presentedForm", "*.text.div"]}
+Field paths start with a resourceType or * for all resourceTypes, and follow the elements
+through lists. include_fields lists the top level elements kept for a resourceType, the
+resourceTypes not listed keep all their elements."""
+import json
+
+# Elements kept by include_fields for every resourceType
+KEY_ELEMENTS = ('resourceType', 'id')
+FILTER_KEYS = ('include_types', 'exclude_types', 'include_fields', 'exclude_fields')
+
+def entry_type(entry: dict) -> str:
+    """Returns the resourceType of a bundle entry, from its resource or for entries without
+    resource (DELETE) from its request url"""
+    resource = entry.get("resource")
+    if resource:
+        return resource.get("resourceType")
+    url = (entry.get("request") or {}).get("url") or ''
+    return url.split('?', 1)[0].split('/', 1)[0] or None
+
+def _split_path(path: str) -> tuple:
+    """Splits a field path into its resourceType and element names"""
+    parts = path.split('.')
+    if len(parts) < 2 or not all(parts):
+        raise ValueError(f"Invalid field path {path}, expected <resourceType>.<element>...")
+    return parts[0], tuple(parts[1:])
+
+def _remove_path(obj, names: tuple):
+    """Removes an element path from a dictionary, in every item of the lists on the way"""
+    if isinstance(obj, list):
+        for item in obj:
+            _remove_path(item, names)
+    elif isinstance(obj, dict):
+        if len(names) == 1:
+            obj.pop(names[0], None)
+        elif names[0] in obj:
+            _remove_path(obj[names[0]], names[1:])
+
+class ResourceFilter:
+    """Include/exclude rules for resourceTypes and field paths. An empty include list keeps
+    everything, excludes win over includes."""
+    def __init__(self, include_types=(), exclude_types=(), include_fields=(),
+                 exclude_fields=()) -> None:
+        self.include_types = frozenset(include_types)
+        self.exclude_types = frozenset(exclude_types)
+        # resourceType -> top level elements kept
+        self.include_fields = {}
+        for path in include_fields:
+            resource_type, names = _split_path(path)
+            if len(names) != 1 or resource_type == '*':
+                raise ValueError("include_fields takes <resourceType>.<element> paths, "
+                                 f"not {path}")
+            self.include_fields.setdefault(resource_type, set(KEY_ELEMENTS)).add(names[0])
+        # resourceType or * -> element paths removed
+        self.exclude_fields = {}
+        for path in exclude_fields:
+            resource_type, names = _split_path(path)
+            self.exclude_fields.setdefault(resource_type, []).append(names)
+        self.skipped = 0
+
+    @classmethod
+    def from_file(cls, path: str, **overrides) -> 'ResourceFilter':
+        """Reads a json filter config
+        Input: path=Config file path, None for overrides only
+               overrides=Lists added to the ones of the file, by FILTER_KEYS name
+        Returns: ResourceFilter object"""
+        config = {}
+        if path is not None:
+            with open(path, encoding='UTF-8') as fp:
+                config = json.load(fp)
+            unknown = set(config) - set(FILTER_KEYS)
+            if unknown:
+                raise ValueError(f"Unknown resource filter keys {sorted(unknown)}")
+        return cls(**{key: list(config.get(key, ())) + list(overrides.get(key) or ())
+                      for key in FILTER_KEYS})
+
+    @property
+    def active(self) -> bool:
+        """Tells if the filter drops anything"""
+        return bool(self.include_types or self.exclude_types or self.include_fields
+                    or self.exclude_fields)
+
+    def keep_type(self, resource_type: str) -> bool:
+        """Tells if the resources of a resourceType are loaded"""
+        if resource_type in self.exclude_types:
+            return False
+        return not self.include_types or resource_type in self.include_types
+
+    def filter_entries(self, entries: list) -> list:
+        """Returns the bundle entries of the kept resourceTypes"""
+        if not (self.include_types or self.exclude_types):
+            return entries
+        kept = [entry for entry in entries if self.keep_type(entry_type(entry))]
+        self.skipped += len(entries) - len(kept)
+        return kept
+
+    def project(self, resource_type: str, resource: dict) -> dict:
+        """Removes the excluded elements of a resource and keeps only the included ones,
+        in place
+        Input: resource_type=resourceType of the resource
+               resource=Resource dictionary
+        Returns: The resource dictionary"""
+        kept = self.include_fields.get(resource_type)
+        if kept is not None:
+            for name in [name for name in resource if name not in kept]:
+                del resource[name]
+        for names in self.exclude_fields.get('*', ()):
+            _remove_path(resource, names)
+        for names in self.exclude_fields.get(resource_type, ()):
+            _remove_path(resource, names)
+        return resource
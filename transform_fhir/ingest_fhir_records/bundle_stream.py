@@ -0,0 +1,230 @@
+"""Module BundleEntryParser incrementally parses a json FHIR Bundle document. Text is pushed
+to the parser chunk by chunk and Bundle.entry[] items are returned as soon as each one is
+decoded, so a bundle never has to be held in memory as a whole. The end of an unfinished
+value is found by a string-aware bracket scan that resumes where the previous chunk stopped,
+and the value is decoded once when it is closed, so that large entries cost linear time."""
+import json
+import re
+
+# Parser states
+_OBJECT_START = 0
+_KEY_OR_END = 1
+_COLON = 2
+_VALUE = 3
+_COMMA_OR_END = 4
+_ENTRY_START = 5
+_ENTRY_OR_END = 6
+_ENTRY_COMMA_OR_END = 7
+_DONE = 8
+
+_WHITESPACE = ' \t\n\r'
+# Tokens of the value scan outside of a string: a whole string (group 2 is missing when it
+# continues in the next chunk) or a bracket
+_TOKEN = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*(")?|[{}\[\]]')
+# End or escape inside of a string
+_STRING_END = re.compile(r'["\\]')
+# End of a number, true, false or null
+_SCALAR_END = re.compile(r'[,\]}\s]')
+
+class BundleEntryParser:
+    """Push parser for a json Bundle. Top level members other than 'entry' (resourceType, type,
+    etc.) are kept in header, the entry array is decoded one element at a time."""
+    def __init__(self) -> None:
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._state = _OBJECT_START
+        self._key = None
+        self.header = {}
+        # Text of the value being received, None between values
+        self._parts = None
+        # False while the received text of the value is not scanned yet: the value is then
+        # decoded again once with the next chunk (_retry), before falling back to the scan
+        self._scanning = False
+        self._retry = False
+        # Scan state of the value being received
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._scalar = False
+
+    def feed(self, chunk: str) -> list:
+        """Push the next chunk of the document to the parser.
+        Input: chunk=Next part of the json text
+        Returns: List of bundle entries completed by this chunk. ValueError is raised as
+                 soon as an invalid value is complete"""
+        entries = []
+        if self._parts is not None and not self._scanning:
+            # A value cut by the previous chunk, usually closed by this one
+            self._parts.append(chunk)
+            self._buffer, self._pos = ''.join(self._parts), 0
+            self._parts = None
+            self._retry = True
+        elif self._parts is not None:
+            end = self._scan(chunk, 0)
+            if end < 0:
+                self._parts.append(chunk)
+                return entries
+            self._parts.append(chunk[:end])
+            text = ''.join(self._parts)
+            self._parts = None
+            self._buffer, self._pos = chunk[end:], 0
+            self._complete(self._decode(text, 0, len(text)), entries)
+        else:
+            self._buffer = self._buffer[self._pos:] + chunk
+            self._pos = 0
+        while self._step(entries):
+            pass
+        return entries
+
+    def close(self):
+        """Validate that the whole document was received.
+        Input: None
+        Returns: None. ValueError is raised for a truncated document"""
+        if self._parts is not None or self._state != _DONE or \
+                self._buffer[self._pos:].strip(_WHITESPACE):
+            raise ValueError("Truncated or invalid json bundle document")
+
+    def bundle(self, entries: list) -> dict:
+        """Build a bundle json object holding the header members and the given entries.
+        Input: entries=List of bundle entries
+        Returns: Bundle json object"""
+        return {"resourceType": "Bundle", **self.header, "entry": entries}
+
+    def _start_value(self, text: str, start: int) -> int:
+        """Starts the scan of the value at text[start]
+        Returns: Position after the value, -1 when it continues in the next chunk"""
+        char = text[start]
+        self._depth = 0
+        self._escape = False
+        self._in_string = char == '"'
+        self._scalar = char not in '{["'
+        return self._scan(text, start + 1 if self._in_string else start)
+
+    def _scan(self, text: str, pos: int) -> int:
+        """Resumes the scan of the current value at text[pos]
+        Returns: Position after the value, -1 when it continues in the next chunk"""
+        if self._scalar:
+            match = _SCALAR_END.search(text, pos)
+            return match.start() if match else -1
+        if self._escape and pos < len(text):
+            # The character escaped by a backslash ending the previous chunk
+            self._escape = False
+            pos += 1
+        while True:
+            if self._in_string:
+                match = _STRING_END.search(text, pos)
+                if match is None:
+                    return -1
+                pos = match.end()
+                if match.group() == '\\':
+                    if pos >= len(text):
+                        self._escape = True
+                        return -1
+                    pos += 1
+                    continue
+                self._in_string = False
+                if self._depth == 0:
+                    return pos
+            else:
+                for match in _TOKEN.finditer(text, pos):
+                    char = text[match.start()]
+                    if char == '"':
+                        if match.end(1) < 0:
+                            # Unterminated string, resumed at its last backslash if any
+                            self._in_string = True
+                            pos = match.end()
+                            break
+                    elif char in '{[':
+                        self._depth += 1
+                    else:
+                        self._depth -= 1
+                        if self._depth == 0:
+                            return match.end()
+                else:
+                    return -1
+
+    def _decode(self, text: str, start: int, end: int):
+        """Decodes the complete json value text[start:end]
+        Returns: Decoded value, raises ValueError for invalid json"""
+        value, stop = self._decoder.raw_decode(text, start)
+        if stop != end:
+            raise ValueError(f"Invalid json value at position {stop}")
+        return value
+
+    def _complete(self, value, entries: list):
+        """Takes a decoded key, header value or entry and moves to the next state"""
+        if self._state == _KEY_OR_END:
+            self._key = value
+            self._state = _COLON
+        elif self._state == _VALUE:
+            self.header[self._key] = value
+            self._state = _COMMA_OR_END
+        else:
+            entries.append(value)
+            self._state = _ENTRY_COMMA_OR_END
+
+    def _step(self, entries: list) -> bool:
+        """Advance the parser by one token.
+        Input: entries=List collecting the decoded entries
+        Returns: False when more data is required to continue"""
+        buf = self._buffer
+        while self._pos < len(buf) and buf[self._pos] in _WHITESPACE:
+            self._pos += 1
+        if self._pos >= len(buf):
+            return False
+        char = buf[self._pos]
+        state = self._state
+        if state == _OBJECT_START and char == '{':
+            self._pos += 1
+            self._state = _KEY_OR_END
+        elif state in (_KEY_OR_END, _COMMA_OR_END) and char == '}':
+            self._pos += 1
+            self._state = _DONE
+        elif (state == _KEY_OR_END and char == '"') or state in (_VALUE, _ENTRY_OR_END) and \
+                not (state == _ENTRY_OR_END and char == ']'):
+            try:
+                # Values inside of the chunk are decoded without a scan
+                value, end = self._decoder.raw_decode(buf, self._pos)
+            except json.JSONDecodeError as ex:
+                if not (self._scanning or self._retry) and (
+                        ex.pos >= len(buf) or ex.msg.startswith('Unterminated string')):
+                    # Cut by the end of the chunk, decoded again with the next one
+                    self._parts = [buf[self._pos:]]
+                    self._buffer, self._pos = '', 0
+                    return False
+                end = len(buf)
+            if end >= len(buf) or (buf[self._pos] not in '{["' and
+                                   not _SCALAR_END.match(buf, end)):
+                # Incomplete, invalid or ending the chunk, or a number decoded up to a cut
+                # in its fraction or exponent (1. followed by 5), the end of the value is
+                # found by a scan from now on
+                self._scanning = True
+                end = self._start_value(buf, self._pos)
+                if end < 0:
+                    # The value continues in the next chunks, kept until it is closed
+                    self._parts = [buf[self._pos:]]
+                    self._buffer, self._pos = '', 0
+                    return False
+                value = self._decode(buf, self._pos, end)
+            self._scanning = self._retry = False
+            self._pos = end
+            self._complete(value, entries)
+        elif state == _COLON and char == ':':
+            self._pos += 1
+            self._state = _ENTRY_START if self._key == 'entry' else _VALUE
+        elif state == _COMMA_OR_END and char == ',':
+            self._pos += 1
+            self._state = _KEY_OR_END
+        elif state == _ENTRY_START and char == '[':
+            self._pos += 1
+            self._state = _ENTRY_OR_END
+        elif state in (_ENTRY_OR_END, _ENTRY_COMMA_OR_END) and char == ']':
+            self._pos += 1
+            self._state = _COMMA_OR_END
+        elif state == _ENTRY_COMMA_OR_END and char == ',':
+            self._pos += 1
+            self._state = _ENTRY_OR_END
+        else:
+            raise ValueError(f"Unexpected character {char!r} at position {self._pos}")
+        return True
@@ -1,26 +1,105 @@
 """Module FhirReader reads json fhir format files (in the given Data folder) from 
 local disk or from url as GET method. The file is parsed using fhir parser and the
-FhirModel object is stored in the queue (for transform module to pick up and process)."""
-from os import listdir
-from os.path import isfile, join
+FhirModel object is stored in the queue (for transform module to pick up and process).
+aiohttp, aiofiles and fhir.resources are imported on first use, so that local runs do not
+load the http client and unvalidated runs do not load the fhir models."""
+from __future__ import annotations
+from collections import deque
+from os import listdir, scandir, stat
+from os.path import basename, isfile, join
 import asyncio
+import codecs
+import hashlib
 import json
 import logging
-import aiofiles
-import aiohttp
-from fhir.resources.R4B import construct_fhir_element, FHIRAbstractModel
+import mmap
+import zlib
+from time import perf_counter
+from typing import TYPE_CHECKING
+from common.dead_letter import DeadLetterStore
 from common.fhir_queue import FhirQueue
+from common.storage_queue import StorageQueue
+from common.metrics import Metrics
+from ingest_fhir_records.bundle_stream import BundleEntryParser
+from ingest_fhir_records.http_cache import HttpCache
+from transform_fhir_records.flattener import SchemaRegistry
+try:
+    # orjson parses straight from a bytes buffer, without decoding the file to str
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+if TYPE_CHECKING:
+    import aiohttp
 
-logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', 
-                    filename='transform_fhir.log', encoding='utf-8', level=logging.INFO,
-                    datefmt='%Y-%m-%d %H:%M:%S')
+# Local file read modes: 'aiofiles' reads and decodes files in the aiofiles thread pool,
+# 'mmap' maps them and parses the bytes of the mapping
+READ_MODES = ('aiofiles', 'mmap')
+
+# Response statuses retried with backoff, other errors are not transient
+RETRY_STATUSES = frozenset((408, 429, 500, 502, 503, 504))
 
 class FhirReader:
     """The class ingestes FHIR records/files from local disk or from given URL as GET method"""
-    def __init__(self, timeout=1000) -> None:
-        # Hardcoding timeout for http request for now.
-        # This should be a configurable value.
+    def __init__(self, timeout=1000, parse_bundles=True, stream_entries=0,
+                 chunk_size=1 << 16, manifest=None, http_limit=100, http_limit_per_host=8,
+                 retries=3, backoff=0.5, cache_dir=None, shard_id=0, shard_count=1,
+                 read_mode='aiofiles', read_ahead=8, resource_filter=None) -> None:
+        # Total timeout of a http request in seconds
         self.timeout = timeout
+        # When False, raw json bundles are queued and parsed by the transform workers
+        self.parse_bundles = parse_bundles
+        # When > 0, local files and http responses are parsed incrementally and queued as
+        # bundles of stream_entries entries at most
+        self.stream_entries = stream_entries
+        self.chunk_size = chunk_size
+        # Optional IngestManifest, unchanged sources are skipped
+        self.manifest = manifest
+        # Open connections of the http client, in total and per host. Requests beyond the
+        # limits wait for a free connection.
+        self.http_limit = http_limit
+        self.http_limit_per_host = http_limit_per_host
+        # Failed connections and RETRY_STATUSES are retried with backoff * 2**attempt delays
+        self.retries = retries
+        self.backoff = backoff
+        # Optional on-disk cache of the http responses, revalidated with conditional GET
+        self.cache = HttpCache(cache_dir) if cache_dir else None
+        # Ingest processes split the input files by a hash of the file name, each one
+        # reads the files of its shard_id out of shard_count shards
+        self.shard_id = shard_id
+        self.shard_count = shard_count
+        # How local files are read (one of READ_MODES) and how many files are read ahead of
+        # the one being parsed and queued. 0 reads all files before queueing any.
+        self.read_mode = read_mode
+        self.read_ahead = read_ahead
+        # Optional ResourceFilter, the entries of skipped resourceTypes are dropped before
+        # the bundles are parsed and queued
+        self.resource_filter = resource_filter
+        # Set by stop() to end a watch_dir_reader()
+        self._stopping = asyncio.Event()
+        # watch_dir_reader() puts (FhirQueue().enqueued, snapshot of manifest.pending) after
+        # every ingested round, once the bundles of the staged sources are all queued, and
+        # None when it ends, so that the manifest is committed per stored micro-batch
+        self.checkpoints = asyncio.Queue()
+
+    def _in_shard(self, name: str) -> bool:
+        """Tells if a file belongs to the shard of this reader
+        Input: name=File name, without directory
+        Returns: Boolean value"""
+        return self.shard_count == 1 or \
+            zlib.crc32(name.encode('UTF-8')) % self.shard_count == self.shard_id
+
+    def _filter_entries(self, entries: list) -> list:
+        """Returns the bundle entries kept by the resource filter
+        Input: entries=List of bundle entry json objects
+        Returns: List of the kept entries"""
+        if self.resource_filter is None:
+            return entries
+        kept = self.resource_filter.filter_entries(entries)
+        if len(kept) < len(entries):
+            Metrics().inc("fhir_resources_skipped_total", len(entries) - len(kept),
+                          stage="ingest")
+        return kept
 
     async def _add_to_queue(self, item):
         """Add bundle block to queue
@@ -34,27 +113,183 @@ class FhirReader:
         Input: fil=File name with absolute/relative path to be read
         Returns: File contents as json object"""
         data_json = {}
+        start = perf_counter()
         try:
+            import aiofiles
             data = None
             async with aiofiles.open(fil, mode='r', encoding='UTF-8') as fp:
                 data = await fp.read()
+            Metrics().inc("fhir_read_bytes_total", len(data), source="local")
+            # Parsed before the manifest stages the file, so that a file failing to parse
+            # is not recorded and is read again by the next run. Files with an unchanged
+            # stat were skipped before being read.
             data_json = json.loads(data)
+            if self.manifest is not None:
+                file_stat = stat(fil)
+                if not self.manifest.changed_content(fil, data, size=file_stat.st_size,
+                                                     mtime=file_stat.st_mtime):
+                    logging.info("Skipping unchanged file %s", fil)
+                    return {}
+            Metrics().observe("fhir_read_seconds", perf_counter() - start, source="local")
         except IOError as ex:
             logging.error(str(ex))
         except Exception as ex:
             logging.error("Unhandled exception due to: %s", str(ex))
         return data_json
 
-    
-    async def _parse_add_to_queue(self, json_block: dict) -> FHIRAbstractModel:
-        """Parse json object using fhir parser and adds the created model object in the queue
+    def _mmap_fhir_file(self, fil: str, known_digest: str = None) -> tuple:
+        """Blocking reader of the 'mmap' read mode, run off the event loop. The file is
+        mapped and parsed from the bytes of the mapping, no str copy of it is made.
+        Input: fil=File name with absolute/relative path to be read
+               known_digest=sha256 recorded in the manifest, the file is not parsed when its
+               content still has this hash
+        Returns: Tuple of the json object (None when unchanged or empty), the file stat and
+                 the sha256 digest (None without manifest)"""
+        with open(fil, 'rb') as fp:
+            file_stat = stat(fp.fileno())
+            if file_stat.st_size == 0:
+                # Empty files can not be mapped
+                return None, file_stat, None
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                digest = None
+                if self.manifest is not None:
+                    digest = hashlib.sha256(buf).hexdigest()
+                    if digest == known_digest:
+                        return None, file_stat, digest
+                view = memoryview(buf)
+                try:
+                    return _loads(view), file_stat, digest
+                except TypeError:
+                    # The json fallback does not take buffers
+                    return _loads(bytes(view)), file_stat, digest
+                finally:
+                    view.release()
+
+    async def _map_fhir_file(self, fil: str):
+        """async file reader of the 'mmap' read mode for local_dir_reader()
+        Input: fil=File name with absolute/relative path to be read
+        Returns: File contents as json object"""
+        start = perf_counter()
+        try:
+            # The manifest connection belongs to the event loop thread
+            record = self.manifest.get(fil) if self.manifest is not None else None
+            data_json, file_stat, digest = await asyncio.get_running_loop().run_in_executor(
+                None, self._mmap_fhir_file, fil, record and record["sha256"])
+            Metrics().inc("fhir_read_bytes_total", file_stat.st_size, source="local")
+            if self.manifest is not None and digest is not None and \
+                    not self.manifest.changed_content(fil, size=file_stat.st_size,
+                                                      mtime=file_stat.st_mtime, digest=digest):
+                logging.info("Skipping unchanged file %s", fil)
+                return {}
+            Metrics().observe("fhir_read_seconds", perf_counter() - start, source="local")
+            return data_json or {}
+        except (IOError, ValueError) as ex:
+            logging.error("Error reading %s: %s", fil, str(ex))
+        except Exception as ex:
+            logging.error("Unhandled exception due to: %s", str(ex))
+        return {}
+
+    async def _read_window(self, file_list: list):
+        """async generator reading files with at most read_ahead reads in flight, so that
+        reading overlaps with the parsing and queueing of the files already read while the
+        number of files held in memory stays bounded
+        Input: file_list=Files to be read
+        Returns: Yields the json object of every file, in file_list order"""
+        read = self._map_fhir_file if self.read_mode == 'mmap' else self._read_fhir_file
+        window = self.read_ahead or len(file_list)
+        pending = deque()
+        try:
+            for fp in file_list:
+                pending.append(asyncio.ensure_future(read(fp)))
+                if len(pending) >= window:
+                    yield await pending.popleft()
+            while pending:
+                yield await pending.popleft()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def _hash_text_file(self, fil: str) -> str:
+        """Blocking sha256 of a file read as UTF-8 text, as the aiofiles and streaming read
+        paths hash it, run off the event loop
+        Input: fil=File name with absolute/relative path to be read
+        Returns: sha256 hex digest"""
+        digest = hashlib.sha256()
+        with open(fil, encoding='UTF-8') as fp:
+            while chunk := fp.read(self.chunk_size):
+                digest.update(chunk.encode('UTF-8'))
+        return digest.hexdigest()
+
+    async def _stream_fhir_file(self, fil: str):
+        """async generator parsing a local bundle file incrementally for local_dir_reader().
+        Only one chunk of the file and the entries of the current batch are held in memory.
+        Entries are queued before the whole file is hashed, so a file already in the
+        manifest is hashed by a first read without parsing and skipped when its content is
+        unchanged, as the whole-file read paths do.
+        Input: fil=File name with absolute/relative path to be read
+        Returns: Yields bundle json objects of at most stream_entries entries each"""
+        parser = BundleEntryParser()
+        entries = []
+        yielded = False
+        digest = hashlib.sha256()
+        try:
+            import aiofiles
+            record = self.manifest.get(fil) if self.manifest is not None else None
+            if record is not None:
+                file_stat = stat(fil)
+                known = await asyncio.get_running_loop().run_in_executor(
+                    None, self._hash_text_file, fil)
+                if known == record["sha256"]:
+                    # Records the new stat of the unchanged content
+                    self.manifest.changed_content(fil, size=file_stat.st_size,
+                                                  mtime=file_stat.st_mtime, digest=known)
+                    logging.info("Skipping unchanged file %s", fil)
+                    return
+            async with aiofiles.open(fil, mode='r', encoding='UTF-8') as fp:
+                while chunk := await fp.read(self.chunk_size):
+                    digest.update(chunk.encode('UTF-8'))
+                    entries.extend(self._filter_entries(parser.feed(chunk)))
+                    while len(entries) >= self.stream_entries:
+                        yield parser.bundle(entries[:self.stream_entries])
+                        del entries[:self.stream_entries]
+                        yielded = True
+            parser.close()
+            if entries or not yielded:
+                yield parser.bundle(entries)
+            if self.manifest is not None:
+                file_stat = stat(fil)
+                self.manifest.record(fil, size=file_stat.st_size, mtime=file_stat.st_mtime,
+                                     sha256=digest.hexdigest())
+        except IOError as ex:
+            logging.error(str(ex))
+        except ValueError as ex:
+            logging.error("Error parsing %s: %s", fil, str(ex))
+
+    async def _parse_add_to_queue(self, json_block: dict) -> bool:
+        """Parse json object using fhir parser and adds the created model object in the queue.
+        Raw json object is queued as is when bundle parsing is left to the transform workers.
         Input: json_block=json object to be parsed by fhir parser
         Returns: Boolean completion status"""
         response_val = False
-        fhil_block = construct_fhir_element('Bundle', json_block)
+        if json_block and isinstance(json_block.get("entry"), list):
+            json_block["entry"] = self._filter_entries(json_block["entry"])
+        if self.parse_bundles:
+            from fhir.resources.R4B import construct_fhir_element
+            try:
+                fhil_block = construct_fhir_element('Bundle', json_block)
+            except ValueError as ex:
+                # The raw bundle is queued, the transform stage validates its entries one
+                # by one and dead letters the invalid ones
+                logging.warning("Invalid bundle, queued for per resource validation: %s",
+                                str(ex).splitlines()[0])
+                fhil_block = json_block
+        else:
+            fhil_block = json_block
         if fhil_block:
+            Metrics().inc("fhir_bundles_read_total")
+            Metrics().inc("fhir_resources_read_total", len(json_block.get("entry") or ()))
             await self._add_to_queue(fhil_block)
-            print(f"Reader task putting next object...Queue size {FhirQueue().queue_size()}")
+            logging.debug("Reader task putting next object...")
             response_val = True
         else:
             logging.error("None Fhir block object reveived as a response")
@@ -66,98 +301,370 @@ class FhirReader:
         Returns: Result as boolean value"""
         response_val = False
         try:
-            file_list = [join(folder_path, f) for f in listdir(folder_path) if isfile(join(folder_path, f))]
+            file_list = [join(folder_path, f) for f in listdir(folder_path)
+                         if isfile(join(folder_path, f)) and self._in_shard(f)]
         except FileNotFoundError as ex:
             logging.error(str(ex))
             return response_val
-        tasks = []
         logging.info("Reading files from %s", folder_path)
-        for fp in file_list:
-            tasks.append(asyncio.ensure_future(self._read_fhir_file(fp)))
-        json_blocks = await asyncio.gather(*tasks)
-        logging.info("Parsing %d fhil bundles...wait...wait...", len(json_blocks))
-        for jblk in json_blocks:
+        response_val = await self._ingest_files(file_list)
+        logging.info("Done. Queue size after ingestion is %d", FhirQueue().queue_size())
+        await self._add_to_queue(None)
+        return response_val
+
+    async def _ingest_files(self, file_list: list) -> bool:
+        """Reads local bundle files and pushes them to the fhir queue, without the end of
+        queue sentinel
+        Input: file_list=Files to be read
+        Returns: Result as boolean value"""
+        response_val = False
+        if self.manifest is not None:
+            # Files with the recorded size and mtime are not read at all
+            changed = []
+            for fp in file_list:
+                try:
+                    file_stat = stat(fp)
+                except FileNotFoundError:
+                    # Removed since the directory was listed
+                    logging.warning("Skipping removed file %s", fp)
+                    continue
+                if not self.manifest.unchanged_stat(fp, file_stat.st_size, file_stat.st_mtime):
+                    changed.append(fp)
+            file_list = changed
+        if self.stream_entries > 0:
+            # Files are read one after the other so that the transform stage can start
+            # on the first entries while the rest of the directory is still on disk
+            for fp in file_list:
+                start = perf_counter()
+                async for jblk in self._stream_fhir_file(fp):
+                    response_val = await self._parse_add_to_queue(jblk)
+                Metrics().observe("fhir_read_seconds", perf_counter() - start, source="local")
+            return response_val
+        logging.info("Parsing %d fhil bundles...wait...wait...", len(file_list))
+        async for jblk in self._read_window(file_list):
+            if not jblk:
+                # Unreadable or unchanged file
+                continue
             response_val = await self._parse_add_to_queue(jblk)
             await asyncio.sleep(0)
+        return response_val
+
+    def _scan_dir(self, folder_path: str) -> dict:
+        """Lists the files of a directory that belong to the shard of this reader
+        Input: folder_path=Folder path on local disk
+        Returns: Dictionary of file path -> (size, mtime)"""
+        files = {}
+        with scandir(folder_path) as entries:
+            for entry in entries:
+                if entry.is_file() and self._in_shard(entry.name):
+                    entry_stat = entry.stat()
+                    files[entry.path] = (entry_stat.st_size, entry_stat.st_mtime)
+        return files
+
+    def stop(self):
+        """Asks watch_dir_reader() to stop polling. The bundles already queued are still
+        transformed and stored before the pipeline ends."""
+        logging.info("Stopping the directory watch, draining the queues")
+        self._stopping.set()
+
+    async def watch_dir_reader(self, folder_path: str, poll_interval: float = 1.0) -> bool:
+        """Long running reader of a directory where bundle files keep being dropped. The
+        directory is polled every poll_interval seconds, and new or modified files are
+        pushed to the fhir queue once their size and mtime did not change for one poll, so
+        that files still being written are not read. Runs until stop() is called, then
+        ends the fhir queue so that the transform and store stages drain and finish.
+        Input: folder_path=Folder path on local disk
+               poll_interval=Seconds between two scans of the directory
+        Returns: Result as boolean value"""
+        response_val = True
+        # (size, mtime) of the files ingested and of the files seen on the previous scan
+        ingested = {}
+        candidates = {}
+        logging.info("Watching %s for new files every %s s", folder_path, poll_interval)
+        while not self._stopping.is_set():
+            try:
+                files = self._scan_dir(folder_path)
+            except OSError as ex:
+                logging.error("Error scanning %s: %s", folder_path, str(ex))
+                files = {}
+            ready = sorted(fp for fp, sig in files.items()
+                           if ingested.get(fp) != sig and candidates.get(fp) == sig)
+            candidates = {fp: sig for fp, sig in files.items() if ingested.get(fp) != sig}
+            # Deleted files are forgotten, a new file with the same name is ingested
+            ingested = {fp: sig for fp, sig in ingested.items() if fp in files}
+            if ready:
+                logging.info("Ingesting %d new files of %s", len(ready), folder_path)
+                Metrics().inc("fhir_watch_files_total", len(ready))
+                try:
+                    await self._ingest_files(ready)
+                except OSError as ex:
+                    # File removed between the scan and the read
+                    logging.error("Error reading %s: %s", folder_path, str(ex))
+                    response_val = False
+                ingested.update((fp, files[fp]) for fp in ready)
+                if self.manifest is not None:
+                    self.checkpoints.put_nowait((FhirQueue().enqueued,
+                                                 dict(self.manifest.pending)))
+            try:
+                await asyncio.wait_for(self._stopping.wait(), poll_interval)
+            except asyncio.TimeoutError:
+                pass
         logging.info("Done. Queue size after ingestion is %d", FhirQueue().queue_size())
         await self._add_to_queue(None)
+        self.checkpoints.put_nowait(None)
+        return response_val
+
+    async def dead_letter_reader(self, bundle_entries: int = 100) -> bool:
+        """Method to replay the records of the dead letter store. Failed entries of the
+        transform stage are queued again as bundles of at most bundle_entries entries (and
+        bundles without entry as they are), failed rows of the store stage are queued to
+        the storage queue as dataframes, ahead of the end of stream of the transform stage.
+        Input: bundle_entries=Maximum number of entries per replayed bundle
+        Returns: Result as boolean value"""
+        records = DeadLetterStore().pending()
+        logging.info("Replaying %d dead letters", len(records))
+        registry = SchemaRegistry()
+        entries = []
+        response_val = True
+        for record in records:
+            payload = record["payload"]
+            if "tables" in payload:
+                frames = {}
+                for table, rows in payload["tables"].items():
+                    columns = {col: [row.get(col) for row in rows]
+                               for col in dict.fromkeys(c for row in rows for c in row)}
+                    frames[table] = registry.to_frame(table, columns)
+                await StorageQueue().enqueue(frames)
+            elif "bundle" in payload:
+                response_val = await self._parse_add_to_queue(payload["bundle"]) and response_val
+            else:
+                entries.append(payload["entry"])
+        for start in range(0, len(entries), bundle_entries):
+            bundle = {"resourceType": "Bundle", "type": "collection",
+                      "entry": entries[start:start + bundle_entries]}
+            response_val = await self._parse_add_to_queue(bundle) and response_val
+        await self._add_to_queue(None)
         return response_val
 
-    async def _get_bundle_from_url(self, url: str, client: aiohttp.ClientSession) -> dict:
-        """Internal method to call http get() method and return json response.
-        Since github url is public, no authentication is required.
+    def _client_session(self) -> aiohttp.ClientSession:
+        """Creates the http client session with the configured connection limits and timeout"""
+        import aiohttp
+        connector = aiohttp.TCPConnector(limit=self.http_limit,
+                                         limit_per_host=self.http_limit_per_host)
+        return aiohttp.ClientSession(connector=connector,
+                                     timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+    async def _request(self, url: str, client: aiohttp.ClientSession, headers: dict):
+        """Calls http get() method, retrying connection errors and RETRY_STATUSES with
+        exponential backoff. A numeric Retry-After header of the response is honoured.
+        Input: url=URL to call as GET method
+               client=client session object
+               headers=Request headers
+        Returns: Response object with unread body (to be released by the caller),
+                 None when all attempts failed to connect"""
+        import aiohttp
+        for attempt in range(self.retries + 1):
+            delay = self.backoff * 2 ** attempt
+            try:
+                # if the url is secure, use auth= parameter below
+                response = await client.get(url, headers=headers)
+                if response.status not in RETRY_STATUSES or attempt == self.retries:
+                    return response
+                retry_after = response.headers.get("Retry-After", "")
+                if retry_after.isdigit():
+                    delay = max(delay, int(retry_after))
+                response.release()
+                logging.warning("Received %d for %s, retrying in %.1fs", response.status, url,
+                                delay)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+                if attempt == self.retries:
+                    logging.error("Error calling url %s: %s", url, str(ex))
+                    return None
+                logging.warning("Error calling url %s: %s, retrying in %.1fs", url, str(ex),
+                                delay)
+            await asyncio.sleep(delay)
+        return None
+
+    async def _response_chunks(self, url: str, client: aiohttp.ClientSession, headers: dict):
+        """async generator of the body of a url, served from the cache when the cached
+        response is still valid. Bodies of 200 responses are cached while they are read.
+        Input: url=URL to call as GET method
+               client=client session object
+               headers=Conditional request headers
+        Returns: Yields a (status, etag, last_modified) tuple, then the body chunks as bytes"""
+        response = await self._request(url, client, headers)
+        if response is None:
+            return
+        try:
+            logging.debug("Response status of %s is %d", url, response.status)
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+            yield response.status, etag, last_modified
+            if response.status == 304 and self.cache is not None \
+                    and self.cache.lookup(url) is not None:
+                logging.debug("Not modified, reading %s from the cache", url)
+                async for chunk in self.cache.read(url, self.chunk_size):
+                    yield chunk
+            elif response.status == 200:
+                logging.debug("Received response code 200 for %s", url)
+                chunks = response.content.iter_chunked(self.chunk_size)
+                if self.cache is not None:
+                    chunks = self.cache.write(url, chunks, etag, last_modified)
+                async for chunk in chunks:
+                    yield chunk
+        finally:
+            response.release()
+
+    async def _get_json_from_url(self, url: str, client: aiohttp.ClientSession) -> dict:
+        """Internal method to call http get() method and return json response, used for the
+        folder listing. Since github url is public, no authentication is required.
         Input: url=URL to call as GET method
                client=client session object
-        Returns: File contents as Dict object """
+        Returns: Response contents as Dict object, empty when failed"""
         response_json = {}
+        headers = self.cache.validators(url) if self.cache is not None else {}
+        body = self._response_chunks(url, client, headers)
         try:
-            # if the url is secure, use auth= parameter below
-            async with client.get(url) as response:
-                print(f"Response status is {response.status}")
-                if response.status == 200:
-                    logging.debug("Received response code 200 for %s", url)
-                    response_text = await response.text()
-                    response_json = json.loads(response_text)
-                else:
-                    logging.error("Error calling url %s and error code is %d", url, response.status)
-        except aiohttp.ClientConnectorError as ex:
-            logging.error("Error calling url: %s", str(ex))
+            status = await anext(body, None)
+            if status is not None and status[0] not in (200, 304):
+                logging.error("Error calling url %s and error code is %d", url, status[0])
+            data = b"".join([chunk async for chunk in body])
+            if data:
+                response_json = json.loads(data)
         except Exception as ex:
             logging.error("Error calling url: %s", str(ex))
+        finally:
+            await body.aclose()
         return response_json
 
+    async def _stream_url(self, url: str, client: aiohttp.ClientSession):
+        """async generator fetching one bundle url. The response is decoded incrementally as
+        it arrives. The manifest validators are sent first, so that bundles ingested by an
+        earlier run are skipped on 304, then the ones of the response cache.
+        Input: url=URL of the bundle file
+               client=client session object
+        Returns: Yields bundle json objects, of at most stream_entries entries each when
+                 stream_entries > 0, otherwise the whole bundle"""
+        import aiohttp
+        headers = {}
+        record = self.manifest.get(url) if self.manifest is not None else None
+        if record is not None and record["etag"]:
+            headers = {"If-None-Match": record["etag"]}
+        elif record is not None and record["last_modified"]:
+            headers = {"If-Modified-Since": record["last_modified"]}
+        from_manifest = bool(headers)
+        if not headers and self.cache is not None:
+            headers = self.cache.validators(url)
+        parser = BundleEntryParser()
+        decoder = codecs.getincrementaldecoder('UTF-8')()
+        digest = hashlib.sha256()
+        entries = []
+        yielded = False
+        body = self._response_chunks(url, client, headers)
+        try:
+            response_info = await anext(body, None)
+            if response_info is None:
+                return
+            status, etag, last_modified = response_info
+            if status == 304 and from_manifest:
+                logging.info("Skipping not modified url %s", url)
+                self.manifest.skipped += 1
+                return
+            if status not in (200, 304) or (status == 304 and self.cache is None):
+                logging.error("Error calling url %s and error code is %d", url, status)
+                return
+            async for chunk in body:
+                Metrics().inc("fhir_read_bytes_total", len(chunk), source="url")
+                digest.update(chunk)
+                entries.extend(self._filter_entries(parser.feed(decoder.decode(chunk))))
+                while self.stream_entries and len(entries) >= self.stream_entries:
+                    yield parser.bundle(entries[:self.stream_entries])
+                    del entries[:self.stream_entries]
+                    yielded = True
+            parser.feed(decoder.decode(b"", final=True))
+            parser.close()
+            if self.manifest is not None:
+                if status == 304:
+                    meta = self.cache.lookup(url)
+                    etag, last_modified = meta.get("etag"), meta.get("last_modified")
+                if self.stream_entries:
+                    self.manifest.record(url, etag=etag, last_modified=last_modified,
+                                         sha256=digest.hexdigest())
+                elif not self.manifest.changed_content(url, etag=etag,
+                                                       last_modified=last_modified,
+                                                       digest=digest.hexdigest()):
+                    logging.info("Skipping unchanged url %s", url)
+                    return
+            if entries or not yielded:
+                yield parser.bundle(entries)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+            logging.error("Error reading url %s: %s", url, str(ex))
+        except ValueError as ex:
+            logging.error("Error parsing %s: %s", url, str(ex))
+        finally:
+            await body.aclose()
+
+    async def _ingest_url(self, url: str, client: aiohttp.ClientSession) -> bool:
+        """Fetches one bundle url and pushes its bundles to the fhir queue
+        Input: url=URL of the bundle file
+               client=client session object
+        Returns: Result as boolean"""
+        response_val = False
+        with Metrics().timer("fhir_read_seconds", source="url"):
+            async for bundle in self._stream_url(url, client):
+                response_val = await self._parse_add_to_queue(bundle)
+        return response_val
+
     async def url_file_reader(self, url_to_call: str)-> bool:
         """Method to GET single fhir bundle record from the given url and push to ingestion queue.
         The url should point to the file
         Input: url_to_call=GET url to call
         Returns: Result as boolean"""
-        response_val = False
-        async with aiohttp.ClientSession() as client:
-            response_json = await self._get_bundle_from_url(url_to_call, client)
-            if response_json:
+        async with self._client_session() as client:
+            response_val = False
+            if self._in_shard(basename(url_to_call)):
                 logging.info("Processing 1 fhil bundles")
-                response_val = await self._parse_add_to_queue(response_json)
-            else:
-                logging.error("No response to process for %s", url_to_call)
-            logging.info("Queue size after ingestion is %d", FhirQueue().queue_size())
-            await self._add_to_queue(None)
-            return response_val
+                response_val = await self._ingest_url(url_to_call, client)
+                if not response_val:
+                    logging.error("No response to process for %s", url_to_call)
+        logging.info("Queue size after ingestion is %d", FhirQueue().queue_size())
+        await self._add_to_queue(None)
+        return response_val
 
     async def url_directory_reader(self, base_url: str):
         """Read github public url of directory (data directry), fetch file list 
-        (assuming all are in json fhil format) and push a bundle record to fhir ingestion queue
+        (assuming all are in json fhil format) and push a bundle record to fhir ingestion queue.
+        Files are fetched concurrently within the connection limits of the client and each
+        one is queued as soon as it is decoded.
         Input: base_url=github url of the folder having fhir json files
         Returns: Result as boolean"""
-        response_val = False
-        response_jsons = {}
-        base_url = base_url + '/' if base_url[-1] != '/' else ''
-        tasks = []
-        async with aiohttp.ClientSession() as client:
-            response = await self._get_bundle_from_url(base_url, client)
+        results = []
+        base_url = base_url + '/' if base_url[-1] != '/' else base_url
+        async with self._client_session() as client:
+            response = await self._get_json_from_url(base_url, client)
+            file_list = []
             if response:
                 try:
                     logging.info("Fetching file list from the given url")
                     file_list = response["payload"]["tree"]["items"]
                 except KeyError as ex:
                     logging.error("Error while getting file names: %s", str(ex))
-                
-                #Fetch file contents in the directry in the loop
-                for fl in file_list:
-                    file_url = base_url  + fl["name"]
-                    file_url = file_url.replace("/tree/", "/raw/")
-                    tasks.append(asyncio.ensure_future(self._get_bundle_from_url(file_url, client)))
-                
-                logging.info("Fetching files from remote.....wait...wait...")
-                response_jsons = await asyncio.gather(*tasks)
-                logging.info("Done. Creating fhir objects and adding to the queue...wait...wait...")
             else:
                 logging.error("Received no response for %s", base_url)
-        for rj in response_jsons:
-            if rj:
-                response_val = await self._parse_add_to_queue(rj)
-                await asyncio.sleep(0)
-            else:
-                logging.error("No response to process")
+            #Fetch file contents in the directry
+            tasks = []
+            for fl in file_list:
+                if not self._in_shard(fl["name"]):
+                    continue
+                file_url = base_url  + fl["name"]
+                file_url = file_url.replace("/tree/", "/raw/")
+                tasks.append(asyncio.ensure_future(self._ingest_url(file_url, client)))
+            if tasks:
+                logging.info("Fetching %d files from remote.....wait...wait...", len(tasks))
+                results = await asyncio.gather(*tasks)
+        if self.cache is not None:
+            logging.info("Http cache: %d responses served from cache, %d stored",
+                         self.cache.hits, self.cache.stored)
         logging.info("Done. Queue size after extract process is %d", FhirQueue().queue_size())
         await self._add_to_queue(None)
-        return response_val
\ No newline at end of file
+        return any(results)
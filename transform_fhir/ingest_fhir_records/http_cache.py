@@ -0,0 +1,85 @@
+"""HttpCache keeps http response bodies on local disk keyed by url, with the ETag and
+Last-Modified validators of the response. FhirReader revalidates cached urls with a
+conditional GET, so repeated folder pulls only transfer the files that changed."""
+import hashlib
+import json
+import os
+
+class HttpCache:
+    """On-disk cache of http responses. Every url is stored as <sha256 of url> (body) and
+    <sha256 of url>.meta (url, ETag, Last-Modified) in cache_dir."""
+    def __init__(self, cache_dir: str) -> None:
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self.hits = 0
+        self.stored = 0
+
+    def _path(self, url: str) -> str:
+        """Returns the body file path of a url"""
+        return os.path.join(self.cache_dir, hashlib.sha256(url.encode('UTF-8')).hexdigest())
+
+    def lookup(self, url: str) -> dict:
+        """Returns the validators of a cached url
+        Input: url=Requested url
+        Returns: Dictionary with etag and last_modified, None when the url is not cached"""
+        try:
+            with open(self._path(url) + ".meta", encoding='UTF-8') as fp:
+                meta = json.load(fp)
+        except (OSError, ValueError):
+            return None
+        if meta.get("url") != url or not os.path.isfile(self._path(url)):
+            return None
+        return meta
+
+    def validators(self, url: str) -> dict:
+        """Returns the conditional request headers of a cached url, empty when not cached"""
+        meta = self.lookup(url)
+        if meta is None:
+            return {}
+        if meta.get("etag"):
+            return {"If-None-Match": meta["etag"]}
+        if meta.get("last_modified"):
+            return {"If-Modified-Since": meta["last_modified"]}
+        return {}
+
+    async def read(self, url: str, chunk_size: int = 1 << 16):
+        """async generator reading the cached body of a url (304 Not Modified response)
+        Input: url=Requested url
+               chunk_size=Bytes per chunk
+        Returns: Yields body chunks as bytes"""
+        import aiofiles
+        self.hits += 1
+        async with aiofiles.open(self._path(url), mode='rb') as fp:
+            while chunk := await fp.read(chunk_size):
+                yield chunk
+
+    async def write(self, url: str, chunks, etag: str = None, last_modified: str = None):
+        """async generator passing the body chunks of a 200 response through while they are
+        written to the cache. The entry replaces the cached one only when the body was read
+        completely. Responses without validators are not cached.
+        Input: url=Requested url
+               chunks=Async iterable of body chunks
+               etag, last_modified=Validators of the response
+        Returns: Yields the body chunks"""
+        if not etag and not last_modified:
+            async for chunk in chunks:
+                yield chunk
+            return
+        path = self._path(url)
+        tmp_path = f"{path}.{os.getpid()}.{id(chunks)}.tmp"
+        complete = False
+        import aiofiles
+        try:
+            async with aiofiles.open(tmp_path, mode='wb') as fp:
+                async for chunk in chunks:
+                    await fp.write(chunk)
+                    yield chunk
+            os.replace(tmp_path, path)
+            async with aiofiles.open(path + ".meta", mode='w', encoding='UTF-8') as fp:
+                await fp.write(json.dumps({"url": url, "etag": etag,
+                                           "last_modified": last_modified}))
+            self.stored += 1
+            complete = True
+        finally:
+            if not complete and os.path.exists(tmp_path):
+                os.remove(tmp_path)
@@ -1,11 +1,22 @@
 """Main module - Entry point for the program and validates commandline arguments.
 The module instantiates ingest, transform and storage (ETL) modules as async tasks. """
 import asyncio
+import cProfile
 import logging
+import signal
 from argparse import ArgumentParser
-from ingest_fhir_records.fhir_reader import FhirReader
-from transform_fhir_records.process_fhir import ProcessFihr
-from store_fhir_records.store_fhir import StoreFhir
+from ingest_fhir_records.fhir_reader import FhirReader, READ_MODES
+from transform_fhir_records.process_fhir import ProcessFihr, VALIDATION_MODES
+from transform_fhir_records.star_schema import OUTPUT_MODELS
+from store_fhir_records.store_fhir import StoreFhir, LOAD_METHODS, LOAD_MODES
+from store_fhir_records.file_sink import FileSink
+from common.fhir_queue import FhirQueue
+from common.storage_queue import StorageQueue
+from common.ingest_manifest import IngestManifest
+from common.queue_backend import QUEUE_BACKENDS, create_backend
+from common.metrics import Metrics
+from common.dead_letter import DeadLetterStore
+from common.resource_filter import ResourceFilter
 
 logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', 
                     filename='transform_fhir.log', encoding='utf-8', level=logging.INFO,
@@ -16,46 +27,401 @@ def _parse_args():
     Input: None
     Returns: Provided command line args after validation"""
     arg_parser = ArgumentParser()
-    arg_parser.add_argument("-m", "--mode", required=True, 
-                           choices=['local_disk', 'get_file_url', 'get_folder_url'],
-                           help="Source of fhir files to be processed")
+    arg_parser.add_argument("-m", "--mode", required=False, 
+                           choices=['local_disk', 'get_file_url', 'get_folder_url', 'watch_dir'],
+                           help="Source of fhir files to be processed. 'watch_dir' keeps \
+                            ingesting the files dropped in --directory until SIGINT/SIGTERM")
     arg_parser.add_argument("-d", "--directory", required=False,
                            help="Local directory path where fhir files are stored")
     arg_parser.add_argument("-u;", "--url", required=False,
                            help="github url of fhir file for 'get_file_url'mode or github \
                             folder url for 'get_folder_url' mode")
+    arg_parser.add_argument("-w", "--workers", required=False, type=int, default=0,
+                           help="Number of worker processes transforming bundles. 0 (default) \
+                            transforms bundles in the main process")
+    arg_parser.add_argument("-s", "--stream-entries", required=False, type=int, default=0,
+                           help="Parse local_disk files incrementally and queue bundles of at most \
+                            this many entries. 0 (default) reads whole files")
+    arg_parser.add_argument("--read-mode", required=False, choices=READ_MODES,
+                           default='aiofiles',
+                           help="How local_disk files are read: 'aiofiles' (default) or 'mmap', \
+                            which maps each file and parses its bytes with orjson")
+    arg_parser.add_argument("--read-ahead", required=False, type=int, default=8,
+                           help="Local files read ahead of the one being queued (default 8). \
+                            0 reads the whole directory before queueing")
+    arg_parser.add_argument("-q", "--queue-size", required=False, type=int, default=0,
+                           help="Maximum number of items in the fhir and storage queues. \
+                            0 (default) for unbounded queues")
+    arg_parser.add_argument("--queue-high", required=False, type=int, default=None,
+                           help="Queue depth at which producers are paused (default queue-size)")
+    arg_parser.add_argument("--queue-low", required=False, type=int, default=None,
+                           help="Queue depth at which paused producers resume (default queue-high/2)")
+    arg_parser.add_argument("--flush-rows", required=False, type=int, default=0,
+                           help="Rows accumulated across bundles before the transformed batch is \
+                            sent to storage. 0 (default) sends every bundle on its own")
+    arg_parser.add_argument("--flush-interval", required=False, type=float, default=None,
+                           help="Seconds after which a partial batch is sent to storage and \
+                            the file sink buffers are written. Default 2 in watch_dir mode, \
+                            0 (no time window) otherwise")
+    arg_parser.add_argument("--poll-interval", required=False, type=float, default=1.0,
+                           help="Seconds between two scans of the watch_dir directory")
+    arg_parser.add_argument("--flush-bytes", required=False, type=int, default=0,
+                           help="Approximate bytes accumulated before the transformed batch is \
+                            sent to storage. 0 (default) disables the byte threshold")
+    arg_parser.add_argument("--validation", required=False, choices=VALIDATION_MODES,
+                           default='full',
+                           help="fhir.resources validation of bundles: 'full' (default) validates \
+                            everything, 'sample' validates a fraction of bundles, 'none' skips \
+                            validation for trusted feeds")
+    arg_parser.add_argument("--sample-rate", required=False, type=float, default=0.1,
+                           help="Fraction of bundles validated in 'sample' mode (default 0.1)")
+    arg_parser.add_argument("--validate-types", required=False, nargs='+', default=[],
+                           help="resourceTypes always validated in 'sample' and 'none' modes")
+    arg_parser.add_argument("--load-method", required=False, choices=LOAD_METHODS,
+                           default='to_sql',
+                           help="Database load method: 'to_sql' (default) inserts with pandas, \
+                            'copy' bulk loads with PostgreSQL COPY")
+    arg_parser.add_argument("--load-mode", required=False, choices=LOAD_MODES, default='append',
+                           help="'append' (default) inserts all resources, 'upsert' merges them \
+                            on id following entry.request.method (PUT/POST update, DELETE \
+                            removes) so that resent bundles do not duplicate rows")
+    arg_parser.add_argument("--db-writers", required=False, type=int, default=1,
+                           help="Number of parallel database writer threads/connections. \
+                            1 (default) writes the batches one at a time. Each table is \
+                            committed on its own with --load-method to_sql, a whole batch \
+                            in one transaction with copy or --load-mode upsert")
+    arg_parser.add_argument("--sink", required=False, choices=['postgres', 'parquet', 'csv'],
+                           default='postgres',
+                           help="Storage of the transformed tables: 'postgres' (default) or \
+                            parquet/csv datasets written to --output-dir")
+    arg_parser.add_argument("--database-url", required=False, default=None,
+                           help="SQLAlchemy url of the database sink, e.g. sqlite:///fhir.db \
+                            for offline runs. Defaults to the POSTGRES_* environment variables")
+    arg_parser.add_argument("-o", "--output-dir", required=False, default='output',
+                           help="Output directory of the parquet and csv sinks")
+    arg_parser.add_argument("--row-group-size", required=False, type=int, default=100000,
+                           help="Rows per parquet row group/file of the file sinks")
+    arg_parser.add_argument("--plan-cache-size", required=False, type=int, default=1024,
+                           help="Maximum number of compiled flatten plans (per resourceType and \
+                            shape) cached by the transform stage. 0 disables the cache")
+    arg_parser.add_argument("--http-limit", required=False, type=int, default=100,
+                           help="Maximum number of open http connections")
+    arg_parser.add_argument("--http-limit-per-host", required=False, type=int, default=8,
+                           help="Maximum number of open http connections per host")
+    arg_parser.add_argument("--retries", required=False, type=int, default=3,
+                           help="Retries of failed http requests, with exponential backoff")
+    arg_parser.add_argument("--cache-dir", required=False, default=None,
+                           help="Directory of the on-disk http response cache. Cached urls are \
+                            revalidated with ETag/Last-Modified. Disabled by default")
+    arg_parser.add_argument("--output-model", required=False, choices=OUTPUT_MODELS,
+                           default='flat',
+                           help="'flat' (default) one table per resourceType and repeating \
+                            element, 'star' moves codings, practitioners and organizations to \
+                            DimCoding, DimPractitioner and DimOrganization tables referenced by \
+                            integer *_sk keys")
+    arg_parser.add_argument("--resolve-references", required=False, action='store_true',
+                           help="Add resolved <column>_type and <column>_id columns to every \
+                            reference column, looking up fullUrl and Type?identifier= \
+                            references across bundles")
+    arg_parser.add_argument("--reference-index", required=False, default=None,
+                           help="SQLite file keeping the reference index across runs, a \
+                            temporary spill file is used by default")
+    arg_parser.add_argument("--reference-cache-size", required=False, type=int, default=100000,
+                           help="References kept in memory, the others are spilled to disk")
+    arg_parser.add_argument("--resource-filter", required=False, default=None,
+                           help="json file of include_types, exclude_types, include_fields \
+                            and exclude_fields rules. Skipped resourceTypes are dropped by the \
+                            reader before parsing, skipped fields before flattening")
+    arg_parser.add_argument("--include-types", required=False, nargs='+', default=[],
+                           help="resourceTypes loaded, all by default")
+    arg_parser.add_argument("--exclude-types", required=False, nargs='+', default=[],
+                           help="resourceTypes skipped, e.g. Provenance DocumentReference")
+    arg_parser.add_argument("--include-fields", required=False, nargs='+', default=[],
+                           help="Top level elements loaded per resourceType, e.g. \
+                            Patient.birthDate. resourceTypes not listed keep all elements")
+    arg_parser.add_argument("--exclude-fields", required=False, nargs='+', default=[],
+                           help="Element paths skipped, e.g. DiagnosticReport.presentedForm \
+                            or *.text for all resourceTypes")
+    arg_parser.add_argument("--no-dictionary-encoding", required=False, action='store_true',
+                           help="Store coded columns (system, code, display, status...) as \
+                            plain strings instead of categorical/dictionary encoded columns")
+    arg_parser.add_argument("--role", required=False, default='all',
+                           choices=['all', 'ingest', 'transform', 'store'],
+                           help="Pipeline stage run by this process. 'all' (default) runs \
+                            ingest, transform and store; single roles need a durable queue \
+                            backend shared with the processes of the other roles")
+    arg_parser.add_argument("--queue-backend", required=False, choices=QUEUE_BACKENDS,
+                           default='memory',
+                           help="'memory' (default) in-process queues or 'sqlite' durable \
+                            queues with acknowledgements in the --queue-path file")
+    arg_parser.add_argument("--queue-path", required=False, default='queues.db',
+                           help="SQLite file of the sqlite queue backend")
+    arg_parser.add_argument("--shard-id", required=False, type=int, default=0,
+                           help="Shard of this process, ingest reads the files of its shard")
+    arg_parser.add_argument("--shard-count", required=False, type=int, default=1,
+                           help="Number of processes running each role, the input files are \
+                            split by file name hash")
+    arg_parser.add_argument("--ingest-shards", required=False, type=int, default=None,
+                           help="Number of ingest processes, whose end markers finish the fhir \
+                            queue (default shard count)")
+    arg_parser.add_argument("--transform-shards", required=False, type=int, default=None,
+                           help="Number of transform processes, whose end markers finish the \
+                            storage queue (default shard count)")
+    arg_parser.add_argument("--metrics-file", required=False, default=None,
+                           help="File the Prometheus text metrics are written to, every \
+                            --metrics-interval seconds and at exit")
+    arg_parser.add_argument("--metrics-interval", required=False, type=float, default=15,
+                           help="Seconds between two writes of --metrics-file")
+    arg_parser.add_argument("--metrics-port", required=False, type=int, default=None,
+                           help="Serve the Prometheus metrics on http://0.0.0.0:PORT/metrics \
+                            while the pipeline runs")
+    arg_parser.add_argument("--profile", required=False, default=None,
+                           help="Profile the event loop process with cProfile and write the \
+                            stats to this file (view with pstats or snakeviz)")
+    arg_parser.add_argument("--manifest", required=False, default=None,
+                           help="Path of the ingest manifest (SQLite file). Sources with \
+                            unchanged stat, ETag or content hash since the last successful run \
+                            are skipped. Disabled by default")
+    arg_parser.add_argument("--dead-letters", required=False, default='dead_letters.db',
+                           help="SQLite file of the dead letter store, where resources failing \
+                            to be transformed or stored are kept with their error (default \
+                            dead_letters.db, created on the first failure)")
+    arg_parser.add_argument("--replay-dead-letters", required=False, action='store_true',
+                           help="Reprocess only the records of the dead letter store instead \
+                            of reading a source. Replayed records are marked once stored")
     # Commandline argument validation
     args = arg_parser.parse_args()
-    if args.mode == 'local_disk' and args.directory is None:
-        arg_parser.error("Directory path is required with local_disk mode")
+    if args.role in ('all', 'ingest') and args.mode is None and not args.replay_dead_letters:
+        arg_parser.error("Mode is required with the all and ingest roles")
+    if args.role != 'all' and args.queue_backend == 'memory':
+        arg_parser.error("Single roles require a durable queue backend (--queue-backend sqlite)")
+    if not 0 <= args.shard_id < args.shard_count:
+        arg_parser.error("Shard id must be between 0 and shard count - 1")
+    if args.ingest_shards is None:
+        args.ingest_shards = args.shard_count
+    if args.transform_shards is None:
+        args.transform_shards = args.shard_count
+    if args.ingest_shards < 1 or args.transform_shards < 1:
+        arg_parser.error("Ingest and transform shards must be at least 1")
+    if args.role == 'ingest' and args.ingest_shards != args.shard_count:
+        arg_parser.error("Ingest shards must be the shard count of the ingest processes")
+    if args.role == 'transform' and args.shard_id >= args.transform_shards:
+        arg_parser.error("Shard id must be between 0 and transform shards - 1")
+    if args.mode in ('local_disk', 'watch_dir') and args.directory is None:
+        arg_parser.error("Directory path is required with local_disk and watch_dir modes")
+    if args.flush_interval is None:
+        args.flush_interval = 2.0 if args.mode == 'watch_dir' else 0
+    if args.flush_interval < 0:
+        arg_parser.error("Flush interval can not be negative")
+    if args.poll_interval <= 0:
+        arg_parser.error("Poll interval must be positive")
     if (args.mode == 'get_file_url' or args.mode == 'get_folder_url') and args.url is None:
         arg_parser.error("URL is required with get_file_url and get_folder_url")
+    if args.workers < 0:
+        arg_parser.error("Number of workers can not be negative")
+    if args.stream_entries < 0:
+        arg_parser.error("Number of streamed entries can not be negative")
+    if args.read_ahead < 0:
+        arg_parser.error("Read ahead window can not be negative")
+    if args.http_limit < 0 or args.http_limit_per_host < 0:
+        arg_parser.error("Http connection limits can not be negative")
+    if args.metrics_interval <= 0:
+        arg_parser.error("Metrics interval must be positive")
+    if args.retries < 0:
+        arg_parser.error("Number of retries can not be negative")
+    if args.row_group_size < 1:
+        arg_parser.error("Row group size must be at least 1")
+    if args.load_mode == 'upsert' and args.sink != 'postgres':
+        arg_parser.error("Upsert load mode requires the postgres sink")
+    if args.output_model == 'star' and args.sink == 'postgres' and args.load_mode != 'upsert':
+        arg_parser.error("Star output model with the postgres sink requires --load-mode upsert, \
+dimension rows of earlier runs are skipped on insert")
+    if args.database_url and not args.database_url.startswith('postgresql') and \
+            (args.load_method == 'copy' or args.load_mode == 'upsert'):
+        arg_parser.error("Copy load method and upsert load mode require a PostgreSQL database")
+    if args.db_writers < 1:
+        arg_parser.error("Number of database writers must be at least 1")
+    if not 0 <= args.sample_rate <= 1:
+        arg_parser.error("Sample rate must be between 0 and 1")
+    if args.reference_cache_size < 1:
+        arg_parser.error("Reference cache size must be at least 1")
+    if args.plan_cache_size < 0:
+        arg_parser.error("Plan cache size can not be negative")
+    if args.flush_rows < 0 or args.flush_bytes < 0:
+        arg_parser.error("Flush thresholds can not be negative")
+    try:
+        args.resource_filter = ResourceFilter.from_file(
+            args.resource_filter, include_types=args.include_types,
+            exclude_types=args.exclude_types, include_fields=args.include_fields,
+            exclude_fields=args.exclude_fields)
+    except (OSError, ValueError) as ex:
+        arg_parser.error(f"Invalid resource filter: {ex}")
+    if not args.resource_filter.active:
+        args.resource_filter = None
+    try:
+        FhirQueue().configure(args.queue_size, args.queue_high, args.queue_low,
+                              create_backend(args.queue_backend, 'fhir', args.queue_size,
+                                             args.queue_path, args.ingest_shards))
+        StorageQueue().configure(args.queue_size, args.queue_high, args.queue_low,
+                                 create_backend(args.queue_backend, 'storage', args.queue_size,
+                                                args.queue_path, args.transform_shards))
+    except ValueError as ex:
+        arg_parser.error(str(ex))
 
     return args
 
+async def _write_metrics(path: str, interval: float):
+    """Writes the metrics file every interval seconds until cancelled"""
+    while True:
+        await asyncio.sleep(interval)
+        Metrics().write(path)
+
+async def _commit_watched(manifest: IngestManifest, reader: FhirReader, storage,
+                          poll_interval: float):
+    """Commits the manifest records of every watch_dir round once its micro-batches are
+    stored, so that a long running watcher does not keep them until shutdown. The bundles
+    of a round are transformed once the fhir queue acked as many items as were queued with
+    it, and stored once the storage queue then acked the batches queued up to that point.
+    The ingest role commits a round as soon as it is in the durable queue.
+    Input: manifest=IngestManifest of the reader
+           reader=FhirReader running watch_dir_reader()
+           storage=StoreFhir or FileSink of this process, None for the ingest role
+           poll_interval=Seconds between two checks of the queue counters
+    Returns: None"""
+    while (checkpoint := await reader.checkpoints.get()) is not None:
+        fhir_mark, records = checkpoint
+        if storage is not None:
+            while FhirQueue().acked < fhir_mark:
+                await asyncio.sleep(poll_interval)
+            storage_mark = StorageQueue().enqueued
+            while StorageQueue().acked < storage_mark:
+                await asyncio.sleep(poll_interval)
+            if storage.failed:
+                # Left to the end of the run, which reports the failure
+                return
+        manifest.commit(records)
+
 async def main():
     """Main function to read command line arguments, validate them and call ETL modules.
     It is called by async event loop"""
     args =  _parse_args()
-    reader = FhirReader()
+    profiler = None
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    metrics = Metrics()
+    FhirQueue().register_metrics("fhir")
+    StorageQueue().register_metrics("storage")
+    metrics_runner = await metrics.serve(args.metrics_port) if args.metrics_port else None
+    metrics_writer = None
+    if args.metrics_file:
+        metrics_writer = asyncio.create_task(_write_metrics(args.metrics_file,
+                                                            args.metrics_interval))
+    # With a worker pool, bundle parsing is also moved off the event loop to the workers.
+    # Without full validation raw json bundles go straight to the transform stage.
+    manifest = IngestManifest(args.manifest) if args.manifest else None
+    reader = FhirReader(parse_bundles=args.workers == 0 and args.validation == 'full',
+                        stream_entries=args.stream_entries, manifest=manifest,
+                        http_limit=args.http_limit, http_limit_per_host=args.http_limit_per_host,
+                        retries=args.retries, cache_dir=args.cache_dir,
+                        shard_id=args.shard_id, shard_count=args.shard_count,
+                        read_mode=args.read_mode, read_ahead=args.read_ahead,
+                        resource_filter=args.resource_filter)
     tasks = []
     #Instantiating ingest, transform and store modules (ETL) as async tasks
-    match args.mode:
-        case 'local_disk':
-            logging.info("Mode: local_disk")
-            tasks.append(asyncio.create_task(reader.local_dir_reader(args.directory)))
-        case 'get_file_url':
-            logging.info("Mode: get_file_url")
-            tasks.append(asyncio.create_task(reader.url_file_reader(args.url)))
-        case 'get_folder_url':
-            logging.info("Mode: get_folder_url")
-            tasks.append(asyncio.create_task(reader.url_directory_reader(args.url)))
-    
-    transform = ProcessFihr()
-    tasks.append(asyncio.create_task(transform.process_bundle()))
-    storage = StoreFhir()
-    tasks.append(asyncio.create_task(storage.process_storage_queue_df()))
-    await asyncio.gather(*tasks)
+    DeadLetterStore().configure(args.dead_letters)
+    if args.role in ('all', 'ingest'):
+        await FhirQueue().open_producer(args.shard_id)
+        if args.replay_dead_letters:
+            logging.info("Mode: replay dead letters of %s", args.dead_letters)
+            tasks.append(asyncio.create_task(reader.dead_letter_reader()))
+        else:
+            match args.mode:
+                case 'local_disk':
+                    logging.info("Mode: local_disk")
+                    tasks.append(asyncio.create_task(reader.local_dir_reader(args.directory)))
+                case 'get_file_url':
+                    logging.info("Mode: get_file_url")
+                    tasks.append(asyncio.create_task(reader.url_file_reader(args.url)))
+                case 'get_folder_url':
+                    logging.info("Mode: get_folder_url")
+                    tasks.append(asyncio.create_task(reader.url_directory_reader(args.url)))
+                case 'watch_dir':
+                    logging.info("Mode: watch_dir")
+                    loop = asyncio.get_running_loop()
+                    for sig in (signal.SIGINT, signal.SIGTERM):
+                        try:
+                            loop.add_signal_handler(sig, reader.stop)
+                        except NotImplementedError:
+                            # No signal handlers on Windows event loops
+                            pass
+                    tasks.append(asyncio.create_task(
+                        reader.watch_dir_reader(args.directory, args.poll_interval)))
+
+    if args.role in ('all', 'transform'):
+        await StorageQueue().open_producer(args.shard_id)
+        transform = ProcessFihr(workers=args.workers, flush_rows=args.flush_rows,
+                                flush_bytes=args.flush_bytes, validation=args.validation,
+                                sample_rate=args.sample_rate,
+                                validate_types=args.validate_types,
+                                plan_cache_size=args.plan_cache_size,
+                                load_actions=args.load_mode == 'upsert',
+                                output_model=args.output_model,
+                                resolve_references=args.resolve_references,
+                                reference_index=args.reference_index,
+                                reference_cache_size=args.reference_cache_size,
+                                resource_filter=args.resource_filter,
+                                flush_interval=args.flush_interval,
+                                dictionary_encoding=not args.no_dictionary_encoding)
+        tasks.append(asyncio.create_task(transform.process_bundle()))
+    if args.role in ('all', 'store'):
+        if args.sink == 'postgres':
+            storage = StoreFhir(load_method=args.load_method, db_writers=args.db_writers,
+                                load_mode=args.load_mode, database_url=args.database_url)
+        else:
+            storage = FileSink(output_dir=args.output_dir, file_format=args.sink,
+                               row_group_size=args.row_group_size,
+                               flush_interval=args.flush_interval)
+        tasks.append(asyncio.create_task(storage.process_storage_queue_df()))
+    committer = None
+    if manifest is not None and args.mode == 'watch_dir' and args.role in ('all', 'ingest') \
+            and not args.replay_dead_letters:
+        committer = asyncio.create_task(_commit_watched(
+            manifest, reader, storage if args.role == 'all' else None, args.poll_interval))
+    results = await asyncio.gather(*tasks)
+    if committer is not None:
+        # Rounds not committed yet are committed below with the rest of the run
+        committer.cancel()
+    if manifest is not None and args.role in ('all', 'ingest'):
+        # Sources are recorded only when they were stored (or, for the ingest role, queued
+        # in the durable queue), failed loads are retried next run
+        if results[-1]:
+            manifest.commit()
+        else:
+            logging.error("Storage failed, manifest %s not updated", args.manifest)
+        manifest.close()
+    if args.replay_dead_letters and args.role in ('all', 'ingest'):
+        if results[-1]:
+            DeadLetterStore().commit_replay()
+        else:
+            logging.error("Storage failed, dead letters of %s kept for replay", args.dead_letters)
+    if DeadLetterStore().added:
+        print(f"{DeadLetterStore().added} failed resources written to {args.dead_letters}")
+    DeadLetterStore().close()
+    logging.info("FhirQueue stats: %s", FhirQueue().stats())
+    logging.info("StorageQueue stats: %s", StorageQueue().stats())
+    if metrics_writer is not None:
+        metrics_writer.cancel()
+        metrics.write(args.metrics_file)
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    summary = metrics.summary()
+    logging.info("Metrics summary:\n%s", summary)
+    print(summary)
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+        logging.info("Profile written to %s", args.profile)
     logging.info("ETL task is complete!")
 
 if __name__ == '__main__':
@@ -66,4 +432,25 @@ if __name__ == '__main__':
 # Command line examples:
 # python main.py -m "local_disk" -d "C:\\Users\maukt\Documents\GitHub\exa-data-eng-assessment\data"
 # python main.py -m "get_file_url" -u "https://raw.githubusercontent.com/dmauktik/exa-data-eng-assessment/main/data/Aaron697_Dickens475_8c95253e-8ee8-9ae8-6d40-021d702dc78e.json"    
-# python main.py -m "get_folder_url" -u "https://github.com/dmauktik/exa-data-eng-assessment/tree/main/data"
\ No newline at end of file
+# python main.py -m "get_folder_url" -u "https://github.com/dmauktik/exa-data-eng-assessment/tree/main/data"
+# python main.py -m "local_disk" -d "/app/data" -w 4
+# python main.py -m "local_disk" -d "/app/data" -s 100
+# python main.py -m "local_disk" -d "/app/data" --validation sample --sample-rate 0.05
+# python main.py -m "local_disk" -d "/app/data" --load-method copy
+# python main.py -m "local_disk" -d "/app/data" --sink parquet -o "/app/output"
+# python main.py -m "get_folder_url" -u "https://github.com/dmauktik/exa-data-eng-assessment/tree/main/data" --http-limit-per-host 4 --cache-dir "/app/cache"
+# python main.py -m "local_disk" -d "/app/data" --load-mode upsert
+# python main.py -m "local_disk" -d "/app/data" --role ingest --queue-backend sqlite --shard-id 0 --shard-count 2
+# python main.py --role transform --queue-backend sqlite --shard-id 1 --shard-count 2
+# python main.py --role store --queue-backend sqlite --shard-count 2
+# python main.py -m "local_disk" -d "/app/data" --metrics-port 9108 --metrics-file "/app/metrics.prom"
+# python main.py -m "local_disk" -d "/app/data" --profile "/app/pipeline.prof"
+# python main.py -m "local_disk" -d "/app/data" --manifest "/app/manifest.db"
+# python main.py --replay-dead-letters --dead-letters "/app/dead_letters.db"
+# python main.py -m "local_disk" -d "/app/data" --output-model star --load-mode upsert
+# python main.py -m "local_disk" -d "/app/data" --resolve-references --reference-index "/app/references.db"
+# python main.py -m "local_disk" -d "/app/data" --exclude-types Provenance DocumentReference --exclude-fields DiagnosticReport.presentedForm "*.text"
+# python main.py -m "local_disk" -d "/app/data" --resource-filter "/app/resource_filter.json"
+# python main.py -m "watch_dir" -d "/app/inbox" --sink parquet -o "/app/output" --flush-rows 50000 --flush-interval 5
+# python main.py -m "get_folder_url" -u "http://127.0.0.1:8080/repo/tree/main/data" --database-url "sqlite:///fhir.db"
+# python main.py --role store --queue-backend sqlite --ingest-shards 2 --transform-shards 1
@@ -0,0 +1,204 @@
+"""The module fetches transformed dataframe objects from Storage queue and writes them as
+Parquet or CSV datasets, one dataset per resourceType partitioned by ingest date. It is an
+alternative to StoreFhir which needs no database. pandas and pyarrow are imported when the
+sink starts."""
+from __future__ import annotations
+import asyncio
+import logging
+import os
+import uuid
+from datetime import date
+from time import perf_counter
+from typing import TYPE_CHECKING
+from common.storage_queue import StorageQueue
+from common.metrics import Metrics
+
+FILE_FORMATS = ('parquet', 'csv')
+# Maximum number of queued batches taken from the storage queue at once
+DEQUEUE_ITEMS = 16
+
+if TYPE_CHECKING:
+    import pandas as pd
+    import pyarrow as pa
+
+def _to_arrow(df: pd.DataFrame) -> pa.Table:
+    """Converts a dataframe to an arrow table. Columns holding only nulls are typed as
+    string and categorical columns as dictionary<int32, string>, whatever the number of
+    categories, so that the files of a dataset keep a compatible schema."""
+    import pyarrow as pa
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    dictionary = pa.dictionary(pa.int32(), pa.string())
+    for i, field in enumerate(table.schema):
+        if pa.types.is_null(field.type):
+            table = table.set_column(i, field.name, table.column(i).cast(pa.string()))
+        elif pa.types.is_dictionary(field.type) and field.type != dictionary:
+            table = table.set_column(i, field.name, table.column(i).cast(dictionary))
+    return table
+
+def _concat_frames(frames: list) -> pd.DataFrame:
+    """Concatenates the buffered dataframes of a table. The categorical columns are given
+    the union of their categories first, otherwise pandas turns them back into object
+    columns of one string per row. The values of the same column in frames where it is
+    not categorical are added to the union as strings, so that they are not lost."""
+    import pandas as pd
+    from pandas.api.types import union_categoricals
+    parts = {}
+    for df in frames:
+        for col, dtype in df.dtypes.items():
+            if isinstance(dtype, pd.CategoricalDtype):
+                parts.setdefault(col, []).append(df[col])
+    if not parts:
+        return pd.concat(frames, ignore_index=True)
+    plain = []
+    for df in frames:
+        cols = {col: df[col].where(df[col].isna(), df[col].astype(str)) for col in parts
+                if col in df and not isinstance(df[col].dtype, pd.CategoricalDtype)}
+        for col, series in cols.items():
+            parts[col].append(pd.Categorical(series.dropna().astype(str).unique()))
+        plain.append(df.assign(**cols) if cols else df)
+    dtypes = {col: pd.CategoricalDtype(union_categoricals(series).categories)
+              for col, series in parts.items()}
+    frames = [df.astype({col: dtype for col, dtype in dtypes.items() if col in df})
+              for df in plain]
+    result = pd.concat(frames, ignore_index=True)
+    # Columns missing from some of the frames come out of concat as object
+    for col, dtype in dtypes.items():
+        if result[col].dtype != dtype:
+            result[col] = result[col].astype(dtype)
+    return result
+
+class FileSink:
+    """FileSink buffers dataframes per resourceType and writes files of at least
+    row_group_size rows to <output_dir>/<resourceType>/ingest_date=<YYYY-MM-DD of the write>/.
+    Parquet files use dictionary encoding, so repeated codes are stored once per row group.
+    With flush_interval > 0 the buffers are also written flush_interval seconds after the
+    first buffered batch, so that a trickle of bundles reaches the files within seconds."""
+    def __init__(self, output_dir='output', file_format='parquet', row_group_size=100000,
+                 compression='snappy', flush_interval: float = 0) -> None:
+        if file_format not in FILE_FORMATS:
+            raise ValueError(f"Unknown file format {file_format}")
+        self.output_dir = output_dir
+        self.file_format = file_format
+        self.row_group_size = row_group_size
+        self.compression = compression
+        # Date of the partition written last, taken again for every file
+        self.ingest_date = date.today().isoformat()
+        self.files_written = 0
+        # Set once a write failed, the acked batches are then not all stored
+        self.failed = False
+        self.flush_interval = flush_interval
+        self._buffers = {}
+        self._buffered_since = None
+
+    def _partition_dir(self, table: str) -> str:
+        """Returns (and creates) the directory of the current partition of a table"""
+        self.ingest_date = date.today().isoformat()
+        path = os.path.join(self.output_dir, table, f"ingest_date={self.ingest_date}")
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def write_table(self, table: str, df: pd.DataFrame) -> str:
+        """Writes a dataframe as one new file of the table dataset.
+        Input: table=resourceType i.e. dataset name
+               df=Dataframe to be written
+        Returns: Path of the written file"""
+        name = f"part-{self.files_written:05d}-{uuid.uuid4().hex[:8]}.{self.file_format}"
+        path = os.path.join(self._partition_dir(table), name)
+        with Metrics().timer("fhir_file_write_seconds", format=self.file_format):
+            try:
+                if self.file_format == 'parquet':
+                    import pyarrow.parquet as pq
+                    pq.write_table(_to_arrow(df), path, row_group_size=self.row_group_size,
+                                   use_dictionary=True, compression=self.compression)
+                else:
+                    df.to_csv(path, index=False)
+            except Exception:
+                # A partly written file would be read as part of the dataset
+                if os.path.exists(path):
+                    os.remove(path)
+                raise
+        Metrics().inc("fhir_rows_stored_total", len(df), table=table)
+        self.files_written += 1
+        return path
+
+    async def _flush_table(self, table: str):
+        """Writes the buffered dataframes of a table in a thread, off the event loop. The
+        rows stay buffered until the file is written, so that a failed write neither loses
+        them nor lets their batches be acked."""
+        frames = self._buffers.get(table)
+        if not frames:
+            return
+        if len(frames) > 1:
+            frames[:] = [_concat_frames(frames)]
+        await asyncio.get_running_loop().run_in_executor(None, self.write_table, table,
+                                                         frames[0])
+        del self._buffers[table]
+
+    async def _flush_all(self, write_errors: tuple) -> bool:
+        """Writes the buffers of all tables
+        Input: write_errors=Exception types of a failed write
+        Returns: False when a table could not be written"""
+        return_val = True
+        for table in list(self._buffers):
+            try:
+                await self._flush_table(table)
+            except write_errors as ex:
+                logging.error("Error writing %s files: %s", table, str(ex))
+                self.failed = True
+                return_val = False
+        return return_val
+
+    async def process_storage_queue_df(self):
+        """Fetch fhir bundle as dataframe from storage queue and write to the datasets
+        Input: None
+        Returns: Method execution status as boolean"""
+        return_val = True
+        write_errors = (OSError,)
+        if self.file_format == 'parquet':
+            import pyarrow as pa
+            write_errors = (OSError, pa.ArrowException)
+        logging.info("Starting to get items from storage queue")
+        # Dequeued batches are acknowledged once none of their rows is buffered
+        unacked = 0
+        ended = False
+        while not ended:
+            timeout = None
+            if self.flush_interval and self._buffered_since is not None:
+                timeout = max(0.0, self._buffered_since + self.flush_interval - perf_counter())
+            try:
+                # The batches already queued are buffered together
+                items = await StorageQueue().dequeue_batch(DEQUEUE_ITEMS, timeout=timeout)
+            except asyncio.TimeoutError:
+                # The time window closed, all the buffers are written
+                return_val = await self._flush_all(write_errors) and return_val
+                if self._buffers:
+                    # Failed writes are retried in the next time window
+                    self._buffered_since = perf_counter()
+                items = []
+            for transact_dict in items:
+                if transact_dict is None:
+                    ended = True
+                    break
+                logging.debug("Storage task picking next object...")
+                unacked += 1
+                if self._buffered_since is None:
+                    self._buffered_since = perf_counter()
+                for table, df in transact_dict.items():
+                    frames = self._buffers.setdefault(table, [])
+                    frames.append(df)
+                    if sum(len(f) for f in frames) >= self.row_group_size:
+                        try:
+                            await self._flush_table(table)
+                        except write_errors as ex:
+                            logging.error("Error writing %s files: %s", table, str(ex))
+                            self.failed = True
+                            return_val = False
+            if not self._buffers:
+                await StorageQueue().ack(unacked)
+                unacked = 0
+                self._buffered_since = None
+        return_val = await self._flush_all(write_errors) and return_val
+        if not self._buffers:
+            await StorageQueue().ack(unacked)
+        logging.info("All records written to %s, %d files", self.output_dir, self.files_written)
+        return return_val
@@ -1,21 +1,165 @@
 """The module fetches transformed dataframe objects from Storage queue and
-inserts in a database."""
+inserts in a database. pandas, SQLAlchemy and psycopg2 are imported when the store stage
+starts, not when the module is loaded."""
+from __future__ import annotations
+import asyncio
+import io
 import os
 import logging
-import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
 from urllib.parse import quote_plus
-from  sqlalchemy import create_engine, text, exc
 from  common.storage_queue import StorageQueue
+from common.metrics import Metrics
+from common.dead_letter import DeadLetterStore, dead_letter
+from transform_fhir_records.flattener import RESOURCE_ID, ROW_KEY, SEPARATOR, LOAD_ACTION
 
-logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', 
-                    filename='transform_fhir.log', encoding='utf-8', level=logging.INFO,
-                    datefmt='%Y-%m-%d %H:%M:%S')
+LOAD_METHODS = ('to_sql', 'copy')
+LOAD_MODES = ('append', 'upsert')
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+def _pg_type(dtype) -> str:
+    """Maps a dataframe column dtype to a PostgreSQL column type
+    Input: dtype=pandas dtype
+    Returns: PostgreSQL type name"""
+    import pandas as pd
+    if pd.api.types.is_bool_dtype(dtype):
+        return "BOOLEAN"
+    if pd.api.types.is_integer_dtype(dtype):
+        return "BIGINT"
+    if pd.api.types.is_float_dtype(dtype):
+        return "DOUBLE PRECISION"
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return "TIMESTAMPTZ"
+    return "TEXT"
+
+# information_schema data types of the tables created by to_sql() or create_table_ddl(),
+# mapped to the type names of _pg_type(). Other types are compared as TEXT.
+_INFORMATION_SCHEMA_TYPES = {
+    "bigint": "BIGINT", "integer": "BIGINT", "smallint": "BIGINT",
+    "double precision": "DOUBLE PRECISION", "real": "DOUBLE PRECISION",
+    "numeric": "DOUBLE PRECISION", "boolean": "BOOLEAN",
+    "timestamp with time zone": "TIMESTAMPTZ", "timestamp without time zone": "TIMESTAMPTZ"}
+
+def widened_type(current: str, new: str):
+    """Returns the type a column is altered to for storing the values of another type:
+    DOUBLE PRECISION for the floats of a BIGINT column, TEXT for any other mismatch
+    Input: current=Type of the table column
+           new=Type of the dataframe column
+    Returns: Type name, None when the values fit the column"""
+    if current in (new, "TEXT") or (current, new) == ("DOUBLE PRECISION", "BIGINT"):
+        return None
+    if (current, new) == ("BIGINT", "DOUBLE PRECISION"):
+        return new
+    return "TEXT"
+
+def _quote(name: str) -> str:
+    """Quotes a table or column name for PostgreSQL"""
+    return '"' + name.replace('"', '""') + '"'
+
+def primary_key(df: pd.DataFrame) -> list:
+    """Returns the primary key columns of a table: resource_id and row_key for the child
+    tables of repeating elements, id for the resourceType tables
+    Input: df=Dataframe to be stored in the table
+    Returns: List of column names, empty when the table has no key"""
+    if RESOURCE_ID in df.columns and ROW_KEY in df.columns:
+        return [RESOURCE_ID, ROW_KEY]
+    return ["id"] if "id" in df.columns else []
+
+def root_table(table: str) -> str:
+    """Returns the resourceType table of a child table, the table itself for resourceTypes"""
+    return table.split(SEPARATOR, 1)[0]
+
+def _db_errors() -> tuple:
+    """Returns the exception classes of a failed database write"""
+    import psycopg2
+    from sqlalchemy import exc
+    return (exc.SQLAlchemyError, psycopg2.Error)
+
+def _data_errors() -> tuple:
+    """Returns the exception classes of a write rejected for the rows it holds (key
+    violations, invalid values), as opposed to a database outage failing any write"""
+    import psycopg2
+    from sqlalchemy import exc
+    return (exc.IntegrityError, exc.DataError, psycopg2.IntegrityError, psycopg2.DataError)
+
+def split_by_resource(transact_dict: dict) -> dict:
+    """Splits a batch into the rows of every resource: its resourceType row (by id) and its
+    child table rows (by resource_id)
+    Input: transact_dict=Dictionary of table name -> dataframe
+    Returns: Dictionary of (resourceType, id) -> {table name: dataframe}"""
+    import pandas as pd
+    resources = {}
+    for table, df in transact_dict.items():
+        key = "id" if table == root_table(table) else RESOURCE_ID
+        if key not in df.columns:
+            resources.setdefault((root_table(table), None), {})[table] = df
+            continue
+        for resource_id, rows in df.groupby(key, sort=False, dropna=False):
+            resource_id = None if pd.isna(resource_id) else str(resource_id)
+            resources.setdefault((root_table(table), resource_id), {})[table] = rows
+    return resources
+
+def frame_rows(df: pd.DataFrame) -> list:
+    """Returns the rows of a dataframe as json serializable dicts, nulls as None"""
+    return df.astype(object).where(df.notna(), None).to_dict('records')
+
+def upsert_sql(table: str, staging: str, columns: list, action: str) -> str:
+    """Builds the statement merging a staging table into its target on id. 'upsert' replaces
+    all columns of a stored row (columns missing in the staging rows become NULL), 'insert'
+    keeps the stored row. The ids of the written rows are returned.
+    Input: table=Target table name
+           staging=Staging table name, with the columns of the target
+           columns=Column names of the target table
+           action='upsert' or 'insert'
+    Returns: SQL statement"""
+    cols = ", ".join(_quote(c) for c in columns)
+    if action == "insert":
+        conflict = "DO NOTHING"
+    else:
+        conflict = "DO UPDATE SET " + ", ".join(f"{_quote(c)} = EXCLUDED.{_quote(c)}"
+                                                for c in columns if c != "id")
+    return (f"INSERT INTO {_quote(table)} ({cols}) SELECT {cols} FROM {_quote(staging)} "
+            f"ON CONFLICT (id) {conflict} RETURNING id")
+
+def create_table_ddl(table: str, df: pd.DataFrame) -> str:
+    """Builds the CREATE TABLE statement for a dataframe, with its primary key
+    Input: table=Table name
+           df=Dataframe to be stored in the table
+    Returns: DDL statement"""
+    cols = [f"{_quote(c)} {_pg_type(df[c].dtype)}" for c in df.columns]
+    pkey = primary_key(df)
+    if pkey:
+        cols.append(f"PRIMARY KEY ({', '.join(_quote(c) for c in pkey)})")
+    return f"CREATE TABLE IF NOT EXISTS {_quote(table)} ({', '.join(cols)})"
+
+def add_columns_ddl(table: str, df: pd.DataFrame, new_cols: list) -> str:
+    """Builds one ALTER TABLE statement adding all the new columns of a table
+    Input: table=Table name
+           df=Dataframe having the new columns
+           new_cols=Column names missing in the table
+    Returns: DDL statement"""
+    adds = [f"ADD COLUMN IF NOT EXISTS {_quote(c)} {_pg_type(df[c].dtype)}" for c in new_cols]
+    return f"ALTER TABLE {_quote(table)} {', '.join(adds)}"
+
+def alter_types_ddl(table: str, col_types: dict) -> str:
+    """Builds one ALTER TABLE statement changing the type of the widened columns
+    Input: table=Table name
+           col_types=Dictionary of column name -> new type
+    Returns: DDL statement"""
+    alters = [f"ALTER COLUMN {_quote(c)} TYPE {t} USING {_quote(c)}::{t}"
+              for c, t in col_types.items()]
+    return f"ALTER TABLE {_quote(table)} {', '.join(alters)}"
 
 class StoreFhir:
     """StoreFhir class constructs database connection string, reads storage queue and stores
-    transformed data in database. Tables are created dynamically. Data is in semi-structured 
-    format and jsons are stored as string."""
-    def __init__(self) -> None:
+    transformed data in database. Tables are created dynamically, one per resourceType and
+    one per repeating element (child table), with typed columns."""
+    def __init__(self, load_method='to_sql', db_writers=1, load_mode='append',
+                 database_url: str = None) -> None:
         self.database = None
         self.table_set = set()
         # Dummy values as default
@@ -26,54 +170,423 @@ class StoreFhir:
         dbhost = os.environ.get('POSTGRES_HOST', '127.0.0.1')
         dbport = os.environ.get('POSTGRES_PORT', '5432')
         dbtype = os.environ.get('DB_TYPE', 'postgresql')
-        self.connection_str = f'{dbtype}://{dbuser}:{dbpass}@{dbhost}:{dbport}/{db}'
+        # A SQLAlchemy url (e.g. sqlite:///fhir.db for offline runs) replaces the POSTGRES_*
+        # settings
+        self.connection_str = database_url or \
+            f'{dbtype}://{dbuser}:{dbpass}@{dbhost}:{dbport}/{db}'
         self.tablecols = {}
-        
+        # Column types of the tables, read when a table is first written
+        self.tabletypes = {}
+        # 'to_sql' inserts with pandas, 'copy' bulk loads with PostgreSQL COPY FROM STDIN
+        if load_method not in LOAD_METHODS:
+            raise ValueError(f"Unknown load method {load_method}")
+        self.load_method = load_method
+        # 'append' inserts every row, 'upsert' merges the resourceType rows on id following
+        # their LOAD_ACTION and replaces the child table rows of the merged resources
+        if load_mode not in LOAD_MODES:
+            raise ValueError(f"Unknown load mode {load_mode}")
+        self.load_mode = load_mode
+        self._child_tables = {}
+        # Number of threads writing to the database, each with its own pooled connection.
+        # With more than one writer, tables of a batch are written in parallel, each in its
+        # own transaction, while writes (and schema changes) of one table stay in order.
+        self.db_writers = db_writers
+        self._table_locks = defaultdict(asyncio.Lock)
+        self._pkey_tables = set()
+        # Set once a write unit failed, the acked batches are then not all stored
+        self.failed = False
+
+    def _table_columns(self, cursor, table: str) -> list:
+        """Returns the column names of an existing table, empty list if it does not exist"""
+        if table not in self.tablecols:
+            cursor.execute("SELECT column_name FROM information_schema.columns "
+                           "WHERE table_name = %s ORDER BY ordinal_position", (table,))
+            self.tablecols[table] = [row[0] for row in cursor.fetchall()]
+        return self.tablecols[table]
+
+    def _widen_columns(self, cursor, table: str, df: pd.DataFrame):
+        """Alters the type of the table columns a dataframe column was widened for by
+        SchemaRegistry (an integer column having floats, a timestamp column having text),
+        so that its values can be stored. Does nothing when the table does not exist.
+        Input: cursor=psycopg2 cursor
+               table=Table name
+               df=Dataframe to be stored
+        Returns: None"""
+        if table not in self.tabletypes:
+            cursor.execute("SELECT column_name, data_type FROM information_schema.columns "
+                           "WHERE table_name = %s", (table,))
+            rows = cursor.fetchall()
+            if not rows:
+                return
+            self.tabletypes[table] = {name: _INFORMATION_SCHEMA_TYPES.get(data_type, "TEXT")
+                                      for name, data_type in rows}
+        col_types = self.tabletypes[table]
+        widened = {}
+        for col in df.columns:
+            # Columns missing in the table are added, all missing values fit any type
+            if col not in col_types or not df[col].notna().any():
+                continue
+            new_type = widened_type(col_types[col], _pg_type(df[col].dtype))
+            if new_type:
+                widened[col] = new_type
+        if widened:
+            logging.warning("Altering column types of %s: %s", table, widened)
+            cursor.execute(alter_types_ddl(table, widened))
+            col_types.update(widened)
+
+    def _ensure_table(self, cursor, table: str, df: pd.DataFrame) -> list:
+        """Creates the table or adds the new columns of the dataframe
+        Input: cursor=psycopg2 cursor of the batch transaction
+               table=Table name
+               df=Dataframe to be stored
+        Returns: Column names of the table"""
+        table_cols = self._table_columns(cursor, table)
+        if not table_cols:
+            cursor.execute(create_table_ddl(table, df))
+            table_cols.extend(df.columns)
+            self.tabletypes[table] = {c: _pg_type(df[c].dtype) for c in df.columns}
+            if table != root_table(table) and root_table(table) in self._child_tables:
+                self._child_tables[root_table(table)].add(table)
+        else:
+            self._widen_columns(cursor, table, df)
+            new_cols = [c for c in df.columns if c not in table_cols]
+            if new_cols:
+                cursor.execute(add_columns_ddl(table, df, new_cols))
+                table_cols.extend(new_cols)
+                self.tabletypes[table].update((c, _pg_type(df[c].dtype)) for c in new_cols)
+        return table_cols
+
+    def _copy_dataframe(self, cursor, table: str, df: pd.DataFrame):
+        """Creates/evolves the table schema and streams the dataframe with COPY FROM STDIN
+        Input: cursor=psycopg2 cursor of the batch transaction
+               table=Table name
+               df=Dataframe to be stored
+        Returns: None"""
+        self._ensure_table(cursor, table, df)
+        self._copy_rows(cursor, table, df)
+
+    def _copy_rows(self, cursor, table: str, df: pd.DataFrame):
+        """Streams the dataframe into an existing table with COPY FROM STDIN"""
+        buffer = io.StringIO()
+        df.to_csv(buffer, index=False, header=False)
+        buffer.seek(0)
+        columns = ", ".join(_quote(c) for c in df.columns)
+        cursor.copy_expert(f"COPY {_quote(table)} ({columns}) FROM STDIN WITH (FORMAT csv)",
+                           buffer)
+
+    def _stored_child_tables(self, cursor, root: str) -> set:
+        """Returns the existing child tables of a resourceType table"""
+        if root not in self._child_tables:
+            cursor.execute("SELECT table_name FROM information_schema.tables "
+                           "WHERE table_name LIKE %s", (root.replace("_", "\\_") + "\\_%",))
+            self._child_tables[root] = {row[0] for row in cursor.fetchall()}
+        return self._child_tables[root]
+
+    def _upsert_resources(self, cursor, table: str, df: pd.DataFrame) -> tuple:
+        """Merges the resourceType rows of a batch into their table through a staging table.
+        The last row of an id in the batch wins.
+        Input: cursor=psycopg2 cursor of the batch transaction
+               table=resourceType table name
+               df=Dataframe with the LOAD_ACTION column
+        Returns: Tuple of the written ids and the replaced or deleted ids, whose child table
+                 rows are removed"""
+        df = df.drop_duplicates("id", keep="last")
+        actions = df.pop(LOAD_ACTION).fillna("upsert")
+        deleted = df["id"][actions == "delete"].tolist()
+        upserted = df["id"][actions == "upsert"].tolist()
+        df = df[actions != "delete"].dropna(axis=1, how="all")
+        actions = actions[actions != "delete"]
+        written = []
+        if deleted and self._table_columns(cursor, table):
+            cursor.execute(f"DELETE FROM {_quote(table)} WHERE id = ANY(%s)", (deleted,))
+        if not df.empty:
+            table_cols = self._ensure_table(cursor, table, df)
+            staging = "staging_" + table
+            cursor.execute(f"CREATE TEMP TABLE {_quote(staging)} "
+                           f"(LIKE {_quote(table)}) ON COMMIT DROP")
+            for action in ("upsert", "insert"):
+                rows = df[actions == action]
+                if rows.empty:
+                    continue
+                cursor.execute(f"TRUNCATE {_quote(staging)}")
+                self._copy_rows(cursor, staging, rows)
+                cursor.execute(upsert_sql(table, staging, table_cols, action))
+                written.extend(row[0] for row in cursor.fetchall())
+            cursor.execute(f"DROP TABLE {_quote(staging)}")
+        return written, deleted + upserted
+
+    def upsert_batch(self, engine, transact_dict: dict):
+        """Stores a dict of dataframes in one transaction, merging the resourceType rows on
+        id. The child table rows of replaced or deleted resources are removed and the child
+        rows of the written resources are loaded with COPY. Child rows of resources that
+        were not written (conditional create of a stored id) are dropped.
+        Input: engine=SQLAlchemy engine of a PostgreSQL database
+               transact_dict=Dictionary of table name -> dataframe
+        Returns: None"""
+        con = engine.raw_connection()
+        try:
+            with con.cursor() as cursor:
+                written = {}
+                for k, df in transact_dict.items():
+                    if LOAD_ACTION not in df.columns:
+                        continue
+                    written[k], replaced = self._upsert_resources(cursor, k, df)
+                    if replaced:
+                        for child in sorted(self._stored_child_tables(cursor, k)):
+                            cursor.execute(f"DELETE FROM {_quote(child)} "
+                                           f"WHERE {_quote(RESOURCE_ID)} = ANY(%s)", (replaced,))
+                for k, df in transact_dict.items():
+                    if LOAD_ACTION in df.columns:
+                        continue
+                    if k != root_table(k) and RESOURCE_ID in df.columns:
+                        df = df[df[RESOURCE_ID].isin(written.get(root_table(k), ()))]
+                    if not df.empty:
+                        self._copy_dataframe(cursor, k, df)
+            con.commit()
+        except Exception:
+            con.rollback()
+            # Cached schemas of the batch tables are read again after the rollback
+            for k in transact_dict:
+                self.tablecols.pop(k, None)
+                self.tabletypes.pop(k, None)
+                self._child_tables.pop(root_table(k), None)
+            raise
+        finally:
+            con.close()
+
+    def copy_batch(self, engine, transact_dict: dict):
+        """Stores a dict of dataframes in one transaction using COPY. The DBAPI connection
+        is taken from and returned to the engine pool.
+        Input: engine=SQLAlchemy engine of a PostgreSQL database
+               transact_dict=Dictionary of table name -> dataframe
+        Returns: None"""
+        con = engine.raw_connection()
+        known_cols = {k: list(self.tablecols[k]) for k in transact_dict if k in self.tablecols}
+        try:
+            with con.cursor() as cursor:
+                for k, df in transact_dict.items():
+                    self._copy_dataframe(cursor, k, df)
+            con.commit()
+        except Exception:
+            con.rollback()
+            # Schema changes of the failed transaction are rolled back as well
+            for k in transact_dict:
+                self.tabletypes.pop(k, None)
+                if k in known_cols:
+                    self.tablecols[k] = known_cols[k]
+                else:
+                    self.tablecols.pop(k, None)
+            raise
+        finally:
+            con.close()
+
+    def to_sql_batch(self, engine, transact_dict: dict, written: set = None):
+        """Stores a dict of dataframes using DataFrame.to_sql(). The id column is set as
+        primary key on the first write of every table. Every table is committed on its own.
+        Input: engine=SQLAlchemy engine
+               transact_dict=Dictionary of table name -> dataframe
+               written=Set the committed table names are added to
+        Returns: None"""
+        from sqlalchemy import text, exc
+        with engine.connect() as con:
+            for k,df in transact_dict.items():
+                if k not in self.tablecols:
+                    self.tablecols[k] = list(df.columns)
+                else:
+                    col_to_add = [item for item in df.columns if item not in self.tablecols[k]]
+                    if col_to_add and engine.dialect.name == 'sqlite':
+                        # SQLite adds one column per ALTER TABLE and has no IF NOT EXISTS
+                        for col in col_to_add:
+                            con.execute(text(f"ALTER TABLE {_quote(k)} ADD COLUMN "
+                                             f"{_quote(col)} {_pg_type(df[col].dtype)}"))
+                        con.commit()
+                        self.tablecols[k].extend(col_to_add)
+                    elif col_to_add:
+                        con.execute(text(add_columns_ddl(k, df, col_to_add)))
+                        con.commit()
+                        self.tablecols[k].extend(col_to_add)
+                        self.tabletypes.pop(k, None)
+                if engine.dialect.name != 'sqlite':
+                    # SQLite stores any value in any column, PostgreSQL columns are altered
+                    cursor = con.connection.cursor()
+                    try:
+                        self._widen_columns(cursor, k, df)
+                        con.connection.commit()
+                    except Exception:
+                        con.connection.rollback()
+                        self.tabletypes.pop(k, None)
+                        raise
+                    finally:
+                        cursor.close()
+                df.to_sql(k, con, index=False, if_exists='append')
+                con.commit()
+                if written is not None:
+                    written.add(k)
+                pkey = primary_key(df)
+                if k not in self._pkey_tables and pkey:
+                    self._pkey_tables.add(k)
+                    try:
+                        columns = ", ".join(_quote(c) for c in pkey)
+                        query = f"ALTER TABLE {_quote(k)} ADD PRIMARY KEY ({columns});"
+                        q_result = con.execute(text(query))
+                        logging.debug(q_result)
+                        con.commit()
+                    except exc.SQLAlchemyError as ex:
+                        # df.to_sql() is setting primary key for Few tables. So 
+                        # with this exception, it is ok to continue.
+                        con.rollback()
+                        logging.warning("Unable to set primary key constraint: %s", str(ex))
+
+    def _write_batch(self, engine, transact_dict: dict, written: set):
+        """Stores a dict of dataframes with the configured load method
+        Input: engine=SQLAlchemy engine
+               transact_dict=Dictionary of table name -> dataframe
+               written=Set the names of the tables committed before a failure are added to.
+               Only to_sql commits per table, the other methods write all or nothing.
+        Returns: None"""
+        if self.load_mode == 'upsert':
+            self.upsert_batch(engine, transact_dict)
+        elif self.load_method == 'copy':
+            self.copy_batch(engine, transact_dict)
+        else:
+            self.to_sql_batch(engine, transact_dict, written)
+
+    def _write_per_resource(self, engine, transact_dict: dict) -> list:
+        """Writes the rows of a failed batch again one resource at a time, so that only the
+        resources failing on their own are lost. Their rows are kept as dead letters.
+        Other database errors are raised, the whole batch failing.
+        Input: engine=SQLAlchemy engine
+               transact_dict=Dictionary of table name -> dataframe not stored yet
+        Returns: List of the dead letters"""
+        failures = []
+        for (resource_type, resource_id), tables in split_by_resource(transact_dict).items():
+            written = set()
+            try:
+                self._write_batch(engine, tables, written)
+            except _data_errors() as ex:
+                rows = {k: frame_rows(df) for k, df in tables.items() if k not in written}
+                failures.append(dead_letter("store", {"tables": rows}, ex, resource_type,
+                                            resource_id))
+        return failures
+
+    def _write_sync(self, engine, transact_dict: dict):
+        """Stores a dict of dataframes with the configured load method. Runs in a writer thread.
+        When the batch is rejected for its data, its tables not committed yet are written
+        resource by resource and the failing resources go to the dead letter store. Other
+        database errors, e.g. a lost connection, are raised so that the batch is not acked.
+        Input: engine=SQLAlchemy engine
+               transact_dict=Dictionary of table name -> dataframe
+        Returns: None"""
+        method = 'upsert' if self.load_mode == 'upsert' else self.load_method
+        failures = []
+        with Metrics().timer("fhir_db_write_seconds", method=method):
+            written = set()
+            try:
+                self._write_batch(engine, transact_dict, written)
+            except _data_errors() as ex:
+                logging.warning("Batch write failed, retrying resource by resource: %s",
+                                str(ex).splitlines()[0])
+                failures = self._write_per_resource(
+                    engine, {k: df for k, df in transact_dict.items() if k not in written})
+        DeadLetterStore().add_many(failures)
+        failed_rows = defaultdict(int)
+        for failure in failures:
+            for k, rows in failure["payload"]["tables"].items():
+                failed_rows[k] += len(rows)
+        metrics = Metrics()
+        for k, df in transact_dict.items():
+            metrics.inc("fhir_rows_stored_total", len(df) - failed_rows[k], table=k)
+
+    async def _write_unit(self, engine, executor, transact_dict: dict) -> bool:
+        """Writes a dict of dataframes in a writer thread holding the locks of its tables,
+        so that the event loop is never blocked and writes to a table keep their order.
+        Input: engine=SQLAlchemy engine
+               executor=Thread pool of the database writers
+               transact_dict=Dictionary of table name -> dataframe
+        Returns: Write status as boolean"""
+        locks = [self._table_locks[k] for k in sorted(transact_dict)]
+        for lock in locks:
+            await lock.acquire()
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                executor, self._write_sync, engine, transact_dict)
+            return True
+        except _db_errors() as ex:
+            logging.error("Error inserting records to database: %s", str(ex))
+            self.failed = True
+            return False
+        finally:
+            for lock in locks:
+                lock.release()
+
+    async def _ack_stored(self, batches: deque):
+        """Acknowledges the dequeued batches whose write units all succeeded, oldest first.
+        A failed batch is never acked, nor the batches after it, so that a durable queue
+        hands it out again.
+        Input: batches=Deque of the write unit tasks of every dequeued batch
+        Returns: None"""
+        count = 0
+        while batches and all(t.done() for t in batches[0]):
+            if not all(t.result() for t in batches[0]):
+                break
+            batches.popleft()
+            count += 1
+        await StorageQueue().ack(count)
+
     async def process_storage_queue_df(self):
-        """Fetch fhir bundle as dataframe from storage queue and insert into database
+        """Fetch fhir bundle as dataframe from storage queue and insert into database.
+        Database calls run in a pool of db_writers threads so that the ingest and transform
+        tasks keep running while the batches are stored.
         Input: None
         Returns: Method execution status as boolean"""
+        from sqlalchemy import create_engine
         return_val = True
-        engine = create_engine(self.connection_str)
+        # Connections are reused from the engine pool, one per writer thread
+        engine = create_engine(self.connection_str, pool_size=self.db_writers, max_overflow=0,
+                               pool_pre_ping=True)
+        executor = ThreadPoolExecutor(max_workers=self.db_writers,
+                                      thread_name_prefix="db_writer")
         logging.info("Starting to get items from storage queue")
-        set_pkey_once = False
-        while True:
-            transact_dict = await StorageQueue().dequeue()
-            if transact_dict is None:
-                break
-            print("Storage task picking next object...")
-            # Push a bundle of records in database. dtype for columns set to defaults i.e.
-            # string object due to time constraint.
-            try:
-                for k,df in transact_dict.items():
-                    if k not in self.tablecols:
-                        self.tablecols[k] = list(df.columns)
+        pending = set()
+        batches = deque()
+        try:
+            ended = False
+            while not ended:
+                # The batches already queued are taken at once, up to one per writer slot
+                for transact_dict in await StorageQueue().dequeue_batch(2 * self.db_writers):
+                    if transact_dict is None:
+                        ended = True
+                        break
+                    logging.debug("Storage task picking next object...")
+                    # Push a bundle of records in database. A single writer stores the
+                    # batch as one unit (one transaction with copy and upsert, one per table
+                    # with to_sql), several writers store the tables of the batch in parallel.
+                    if self.db_writers == 1:
+                        units = [transact_dict]
+                    elif self.load_mode == 'upsert':
+                        # A resourceType is merged with its child tables in one transaction
+                        groups = defaultdict(dict)
+                        for k, df in transact_dict.items():
+                            groups[root_table(k)][k] = df
+                        units = list(groups.values())
                     else:
-                        temp_colist = list(df.columns)
-                        col_to_add = [item for item in temp_colist if item not in self.tablecols[k]]
-                        with engine.connect() as con:
-                            for col in col_to_add:
-                                self.tablecols[k].append(col)
-                                query = f"ALTER TABLE \"{k}\" ADD COLUMN \"{col}\" TEXT;"
-                                q_result = con.execute(text(query))
-                                con.commit()
-                                time.sleep(1)
-                    df.to_sql(k, engine, index=False, if_exists='append')
-                    if set_pkey_once is False:
-                        try:
-                            with engine.connect() as con:
-                                query = f"ALTER TABLE \"{k}\" ADD PRIMARY KEY (id);"
-                                q_result = con.execute(text(query))
-                                logging.debug(q_result)
-                                con.commit()
-                                return_val = True
-                        except exc.SQLAlchemyError as ex:
-                            # df.to_sql() is setting primary key for Few tables. So 
-                            # with this exception, it is ok to continue.
-                            logging.warning("Unable to set primary key constraint: %s", str(ex))
-            except exc.SQLAlchemyError as ex:
-                logging.error("Error inserting records to database: %s", str(ex))
-                return_val = False
-            set_pkey_once = True
+                        units = [{k: df} for k, df in transact_dict.items()]
+                    tasks = [asyncio.create_task(self._write_unit(engine, executor, unit))
+                             for unit in units]
+                    pending.update(tasks)
+                    batches.append(tasks)
+                    # Bound the batches waiting for a writer
+                    while len(pending) >= 2 * self.db_writers:
+                        done, pending = await asyncio.wait(pending,
+                                                           return_when=asyncio.FIRST_COMPLETED)
+                        return_val = all(t.result() for t in done) and return_val
+                    await self._ack_stored(batches)
+            if pending:
+                done, _ = await asyncio.wait(pending)
+                return_val = all(t.result() for t in done) and return_val
+            await self._ack_stored(batches)
+        finally:
+            executor.shutdown()
+            engine.dispose()
         logging.info("All records stored in database.")
-        return return_val
\ No newline at end of file
+        return return_val
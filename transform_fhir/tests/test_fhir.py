@@ -1,14 +1,35 @@
 """Test module to unit test ingest, transform and storae functionalities"""
 import os
+import json
+import sqlite3
 import asyncio
 import pytest
+import pandas as pd
 from asyncio.queues import QueueEmpty
 from fhir.resources.R4B import construct_fhir_element
-from transform_fhir_records.process_fhir import ProcessFihr
+from transform_fhir_records.process_fhir import ProcessFihr, load_action
+from transform_fhir_records.columnar_batch import ColumnarBatchBuilder
+from transform_fhir_records.flattener import FhirFlattener, SchemaRegistry
+from transform_fhir_records.star_schema import StarSchema, surrogate_key
+from transform_fhir_records.reference_index import ReferenceIndex
 from ingest_fhir_records.fhir_reader import FhirReader
-from store_fhir_records.store_fhir import StoreFhir
+from ingest_fhir_records.bundle_stream import BundleEntryParser
+from sqlalchemy import create_engine, text
+from store_fhir_records.store_fhir import StoreFhir, create_table_ddl, add_columns_ddl, \
+    alter_types_ddl, widened_type
+from store_fhir_records.file_sink import FileSink
 from common.fhir_queue import FhirQueue
 from common.storage_queue import StorageQueue
+from common.ingest_manifest import IngestManifest
+from common.queue_backend import SqliteQueueBackend
+from common.metrics import Metrics
+from common.dead_letter import DeadLetterStore
+from common.resource_filter import ResourceFilter
+from benchmarks.synthetic import generate_dataset
+from benchmarks.fhir_server import LocalFhirServer
+from benchmarks import bench_e2e
+
+TEST_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
 
 @pytest.fixture
 def event_loop():
@@ -23,19 +44,22 @@ def event_loop():
 @pytest.mark.asyncio
 async def test_local_dir_reader():
     """Function to test local_dir_reader() function"""
-    result = await FhirReader().local_dir_reader(os.getcwd() + "\\tests\\data")
+    result = await FhirReader().local_dir_reader(TEST_DATA_DIR)
     assert result is True
 
 @pytest.mark.asyncio
 async def test_url_file_reader():
-    """Function to test url_file_reader() function"""
-    result = await FhirReader().url_file_reader("https://raw.githubusercontent.com/dmauktik/exa-data-eng-assessment/main/data/Aaron697_Dickens475_8c95253e-8ee8-9ae8-6d40-021d702dc78e.json")
+    """Function to test url_file_reader() function, against a local stand-in of the github
+    raw file url"""
+    async with LocalFhirServer(TEST_DATA_DIR) as server:
+        result = await FhirReader().url_file_reader(server.file_url("testdata.json"))
     assert result is True
 
 @pytest.mark.asyncio
-async def test_negative_url_directory_reader():
-    """Function to test url_directory_reader() function"""
-    result = await FhirReader().url_directory_reader("https://example.com")
+async def test_negative_url_directory_reader(tmp_path):
+    """Function to test url_directory_reader() function on a folder url answering 404"""
+    async with LocalFhirServer(str(tmp_path)) as server:
+        result = await FhirReader().url_directory_reader(server.base_url + "/missing/")
     assert result is False
 
 @pytest.mark.asyncio
@@ -91,10 +115,907 @@ async def test_process_bundle():
     result = await ProcessFihr().process_bundle()
     assert size is size #1 record processed
 
-async def test_process_storage_queue_df():
-    """Function to test StoreFhir.process_storage_queue_df() method"""
-    await StorageQueue().enqueue("test message")
-    result = await StoreFhir().process_storage_queue_df()
-    assert True is result # queue items accumulated from previous cases
+@pytest.mark.asyncio
+async def test_process_storage_queue_df(tmp_path):
+    """Function to test StoreFhir.process_storage_queue_df() method, on a SQLite database"""
+    _drain_queues()
+    await StorageQueue().enqueue({"Patient": pd.DataFrame({"id": ["p1", "p2"]})})
+    await StorageQueue().enqueue(None)
+    storage = StoreFhir(database_url=f"sqlite:///{tmp_path}/fhir.db")
+    result = await storage.process_storage_queue_df()
+    assert True is result
+    with create_engine(storage.connection_str).connect() as con:
+        assert con.execute(text('SELECT count(*) FROM "Patient"')).scalar() == 2
+
+@pytest.mark.asyncio
+async def test_store_failed_batch_not_acked(tmp_path, monkeypatch):
+    """Function to test that a batch failing to store stays in the durable storage queue,
+    with the batches after it, while the batches before it are acked"""
+    from sqlalchemy import exc
+    path = str(tmp_path / "queues.db")
+    StorageQueue().configure(backend=SqliteQueueBackend(path, "storage"))
+    for pid in ("p1", "bad", "p2"):
+        await StorageQueue().enqueue({"Patient": pd.DataFrame({"id": [pid]})})
+    await StorageQueue().enqueue(None)
+    storage = StoreFhir(database_url=f"sqlite:///{tmp_path}/fhir.db")
+    write_batch = storage._write_batch
+
+    def failing_write(engine, tables, written):
+        if tables["Patient"]["id"].iloc[0] == "bad":
+            raise exc.OperationalError("INSERT", {}, Exception("down"))
+        write_batch(engine, tables, written)
+    monkeypatch.setattr(storage, "_write_batch", failing_write)
+    assert await storage.process_storage_queue_df() is False
+    StorageQueue().configure()
+    consumer = SqliteQueueBackend(path, "storage", lease_timeout=0)
+    assert await consumer.depth() == 2
+    assert (await consumer.get())["Patient"]["id"].tolist() == ["bad"]
+    consumer.close()
+
+@pytest.mark.asyncio
+async def test_store_outage_fails_batch(tmp_path, monkeypatch):
+    """Function to test that only a batch rejected for its data is retried resource by
+    resource, a database outage failing the batch without dead letters"""
+    from sqlalchemy import exc
+    DeadLetterStore().configure(str(tmp_path / "dead_letters.db"))
+    storage = StoreFhir(database_url=f"sqlite:///{tmp_path}/fhir.db")
+    engine = create_engine(storage.connection_str)
+    batch = {"Patient": pd.DataFrame({"id": ["p1", "p2"]})}
+    retried = []
+    monkeypatch.setattr(storage, "_write_per_resource",
+                        lambda engine, tables: retried.append(tables) or [])
+    for error, stored in ((exc.OperationalError("INSERT", {}, Exception("down")), False),
+                          (exc.IntegrityError("INSERT", {}, Exception("duplicate")), True)):
+        def write_batch(engine, tables, written, error=error):
+            raise error
+        monkeypatch.setattr(storage, "_write_batch", write_batch)
+        assert await storage._write_unit(engine, None, batch) is stored
+    assert len(retried) == 1
+    assert DeadLetterStore().pending() == []
+    engine.dispose()
+    DeadLetterStore().configure()
 
 # command: pytest -q .\tests\test_fhir.py
+
+def _patient_bundle(patient_id: str) -> dict:
+    """Small transaction bundle holding one Patient and one Observation"""
+    return {
+        "resourceType": "Bundle",
+        "type": "transaction",
+        "entry": [
+            {"fullUrl": f"urn:uuid:{patient_id}",
+             "resource": {"resourceType": "Patient", "id": patient_id, "gender": "male",
+                          "birthDate": "1980-01-01"},
+             "request": {"method": "POST", "url": "Patient"}},
+            {"fullUrl": f"urn:uuid:obs-{patient_id}",
+             "resource": {"resourceType": "Observation", "id": f"obs-{patient_id}",
+                          "status": "final", "code": {"text": "Body Height"},
+                          "subject": {"reference": f"urn:uuid:{patient_id}"}},
+             "request": {"method": "POST", "url": "Observation"}}
+        ]
+    }
+
+def _drain_queues():
+    """Empty the singleton queues left over by the previous test cases"""
+    FhirQueue().configure()
+    StorageQueue().configure()
+
+def test_transform_bundle():
+    """Function to test ProcessFihr.transform_bundle() columnar output"""
+    columns = ProcessFihr().transform_bundle(_patient_bundle("p1"))
+    assert set(columns) == {"Patient", "Observation"}
+    assert columns["Patient"]["id"] == ['p1']
+    assert columns["Observation"]["status"] == ['final']
+    assert columns["Observation"]["subject_reference"] == ['urn:uuid:p1']
+
+@pytest.mark.asyncio
+async def test_process_bundle_workers():
+    """Function to test ProcessFihr.process_bundle() with a process pool keeps bundle order
+    and reports the plan cache counters of the workers"""
+    _drain_queues()
+    ids = [f"p{i}" for i in range(5)]
+    for patient_id in ids:
+        await FhirQueue().enqueue(_patient_bundle(patient_id))
+    await FhirQueue().enqueue(None)
+    transform = ProcessFihr(workers=2)
+    result = await transform.process_bundle()
+    assert result is True
+    # The flattener of the main process is unused, the counters come from the workers
+    stats = transform.cache_stats()
+    assert stats["workers"] >= 1 and stats["plans"]["misses"] > 0
+    stored = []
+    while (item := await StorageQueue().dequeue()) is not None:
+        stored.append(item["Patient"]["id"].iloc[0])
+    assert stored == ids
+
+def test_bundle_entry_parser():
+    """Function to test BundleEntryParser returns entries while the document is fed"""
+    text = json.dumps(_patient_bundle("p1"))
+    parser = BundleEntryParser()
+    entries = []
+    for i in range(0, len(text), 7):
+        entries.extend(parser.feed(text[i:i + 7]))
+    parser.close()
+    assert entries == _patient_bundle("p1")["entry"]
+    assert parser.header == {"resourceType": "Bundle", "type": "transaction"}
+    with pytest.raises(ValueError):
+        truncated = BundleEntryParser()
+        truncated.feed(text[:-3])
+        truncated.close()
+    # An entry spanning many chunks is decoded once closed, escapes cut by a chunk included
+    bundle = {"resourceType": "Bundle", "entry": [
+        {"resource": {"data": "A" * 100000, "text": 'a "b" \\ ]}'}}, {"id": 2}]}
+    text = json.dumps(bundle)
+    parser = BundleEntryParser()
+    entries = []
+    for i in range(0, len(text), 3):
+        entries.extend(parser.feed(text[i:i + 3]))
+    parser.close()
+    assert entries == bundle["entry"]
+    # A syntax error fails as soon as its entry is closed, not at the end of the document
+    with pytest.raises(ValueError):
+        BundleEntryParser().feed('{"entry": [{"id": x}, ')
+    # Split at every position, numbers included, the document decodes as json.loads does
+    text = json.dumps({"resourceType": "Bundle", "total": 1.5e+3, "n": -12, "f": False,
+                       "z": None, "t": "a\"b\\c\u00e9", "entry": [
+                           1, 2.5, -3e-2, True, None, "s",
+                           {"resource": {"resourceType": "Patient", "v": [0.25, 1e10]}}]},
+                      ensure_ascii=False)
+    for cut in range(len(text) + 1):
+        parser = BundleEntryParser()
+        entries = parser.feed(text[:cut]) + parser.feed(text[cut:])
+        parser.close()
+        assert parser.bundle(entries) == json.loads(text)
+
+@pytest.mark.asyncio
+async def test_local_dir_reader_stream(tmp_path):
+    """Function to test local_dir_reader() in streaming mode"""
+    _drain_queues()
+    (tmp_path / "bundle.json").write_text(json.dumps(_patient_bundle("p1")), encoding="UTF-8")
+    result = await FhirReader(parse_bundles=False, stream_entries=1, chunk_size=16) \
+        .local_dir_reader(str(tmp_path))
+    assert result is True
+    first, second = await FhirQueue().dequeue(), await FhirQueue().dequeue()
+    assert [e["resource"]["id"] for e in first["entry"] + second["entry"]] == ["p1", "obs-p1"]
+    assert await FhirQueue().dequeue() is None
+
+@pytest.mark.asyncio
+async def test_resource_filter(tmp_path):
+    """Function to test the resourceType routing of the reader and the field projection"""
+    _drain_queues()
+    config = tmp_path / "filter.json"
+    config.write_text(json.dumps({"exclude_types": ["Observation"],
+                                  "include_fields": ["Patient.gender"]}), encoding="UTF-8")
+    resource_filter = ResourceFilter.from_file(str(config), exclude_fields=["*.meta"])
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+    block = _patient_bundle("p1")
+    block["entry"][0]["resource"]["meta"] = {"profile": ["http://example.org/p"]}
+    (data_dir / "bundle.json").write_text(json.dumps(block), encoding="UTF-8")
+    result = await FhirReader(parse_bundles=False, stream_entries=1, chunk_size=16,
+                              resource_filter=resource_filter).local_dir_reader(str(data_dir))
+    assert result is True
+    queued = await FhirQueue().dequeue()
+    assert [e["resource"]["id"] for e in queued["entry"]] == ["p1"]
+    assert await FhirQueue().dequeue() is None
+    # The transform drops the skipped resourceTypes of bundles queued by other readers
+    for validation in ('full', 'none'):
+        columns = ProcessFihr(validation=validation, resource_filter=resource_filter) \
+            .transform_bundle(dict(block))
+        assert set(columns) == {"Patient"}
+        assert set(columns["Patient"]) == {"resourceType", "id", "gender"}
+    assert resource_filter.skipped == 3
+    with pytest.raises(ValueError):
+        ResourceFilter(include_fields=["Patient.name.given"])
+
+@pytest.mark.asyncio
+async def test_watch_dir_micro_batches(tmp_path):
+    """Function to test watch_dir_reader() with time windowed transform batches and a
+    graceful stop draining the queues"""
+    _drain_queues()
+    reader = FhirReader(parse_bundles=False)
+    transform = ProcessFihr(validation='none', flush_rows=100000, flush_interval=0.2)
+    watcher = asyncio.ensure_future(reader.watch_dir_reader(str(tmp_path), 0.05))
+    transformer = asyncio.ensure_future(transform.process_bundle())
+    (tmp_path / "p1.json").write_text(json.dumps(_patient_bundle("p1")), encoding="UTF-8")
+    # The bundle is flushed by the time window, far below flush_rows
+    first = await asyncio.wait_for(StorageQueue().dequeue(), 5)
+    assert first["Patient"]["id"].tolist() == ["p1"]
+    (tmp_path / "p2.json").write_text(json.dumps(_patient_bundle("p2")), encoding="UTF-8")
+    await asyncio.sleep(0.5)
+    reader.stop()
+    assert await asyncio.wait_for(watcher, 5) is True
+    assert await asyncio.wait_for(transformer, 5) is True
+    second = await StorageQueue().dequeue()
+    assert second["Patient"]["id"].tolist() == ["p2"]
+    assert await StorageQueue().dequeue() is None
+
+@pytest.mark.asyncio
+async def test_watch_dir_manifest_commits(tmp_path):
+    """Function to test that the sources of a watch_dir round are committed to the manifest
+    once their micro-batch is stored, while the watcher keeps running"""
+    import main as etl
+    _drain_queues()
+    data_dir = tmp_path / "in"
+    data_dir.mkdir()
+    manifest = IngestManifest(str(tmp_path / "manifest.db"))
+    reader = FhirReader(parse_bundles=False, manifest=manifest)
+    sink = FileSink(output_dir=str(tmp_path / "out"), file_format='csv', flush_interval=0.1)
+    stages = [asyncio.ensure_future(stage) for stage in (
+        reader.watch_dir_reader(str(data_dir), 0.05),
+        ProcessFihr(validation='none', flush_interval=0.1).process_bundle(),
+        sink.process_storage_queue_df())]
+    committer = asyncio.ensure_future(etl._commit_watched(manifest, reader, sink, 0.05))
+    path = str(data_dir / "p1.json")
+    with open(path, 'w', encoding='UTF-8') as fp:
+        json.dump(_patient_bundle("p1"), fp)
+    for _ in range(100):
+        if manifest.get(path) is not None:
+            break
+        await asyncio.sleep(0.05)
+    assert manifest.get(path) is not None and sink.files_written == 2
+    assert not committer.done() and manifest.pending == {}
+    reader.stop()
+    assert await asyncio.wait_for(asyncio.gather(*stages), 5) == [True, True, True]
+    await asyncio.wait_for(committer, 5)
+    manifest.close()
+
+@pytest.mark.asyncio
+async def test_queue_backpressure():
+    """Function to test producers are paused between the high and low watermarks"""
+    que = FhirQueue()
+    que.configure(maxsize=10, high_watermark=4, low_watermark=1)
+    producer = asyncio.ensure_future(asyncio.gather(*[que.enqueue(i) for i in range(6)]))
+    await asyncio.sleep(0.01)
+    assert que.queue_size() == 4 and not producer.done()
+    assert await que.dequeue_batch(2) == [0, 1]
+    await asyncio.sleep(0.01)
+    assert que.queue_size() == 2 and not producer.done()
+    assert await que.dequeue() == 2
+    await producer
+    assert await que.dequeue_batch(10, max_wait=0.01) == [3, 4, 5]
+    stats = que.stats()
+    assert stats["enqueued"] == stats["dequeued"] == 6 and stats["pause_count"] == 1
+    que.configure()
+
+@pytest.mark.asyncio
+async def test_dequeue_batch_sentinel():
+    """Function to test dequeue_batch() stops at the None sentinel and times out on an
+    empty queue"""
+    que = StorageQueue()
+    que.configure()
+    for item in ("a", None, "b"):
+        await que.enqueue(item)
+    assert await que.dequeue_batch(5) == ["a", None]
+    assert await que.dequeue_batch(5, timeout=0.01) == ["b"]
+    with pytest.raises(asyncio.TimeoutError):
+        await que.dequeue_batch(5, timeout=0.01)
+
+def test_columnar_batch_builder():
+    """Function to test ColumnarBatchBuilder handles sparse columns and thresholds"""
+    builder = ColumnarBatchBuilder(flush_rows=3)
+    builder.append("Patient", {"id": "1", "gender": "male"})
+    builder.append("Patient", {"id": "2", "birthDate": "1980-01-01"})
+    assert not builder.should_flush()
+    builder.extend({"Patient": {"id": ["3"], "deceased": [True]}})
+    assert builder.should_flush()
+    df = builder.flush()["Patient"]
+    assert list(df.columns) == ["id", "gender", "birthDate", "deceased"]
+    # Coded columns are dictionary encoded
+    assert str(df["gender"].dtype) == "category"
+    assert df["gender"].isna().tolist() == [False, True, True] and df["gender"][0] == "male"
+    assert df["deceased"].isna().tolist() == [True, True, False]
+    assert builder.num_rows == 0 and builder.flush() == {}
+
+@pytest.mark.asyncio
+async def test_process_bundle_flush_rows():
+    """Function to test ProcessFihr.process_bundle() accumulates bundles up to flush_rows"""
+    _drain_queues()
+    for patient_id in ("p1", "p2", "p3"):
+        await FhirQueue().enqueue(_patient_bundle(patient_id))
+    await FhirQueue().enqueue(None)
+    assert await ProcessFihr(flush_rows=4).process_bundle() is True
+    first, second = await StorageQueue().dequeue(), await StorageQueue().dequeue()
+    assert first["Patient"]["id"].tolist() == ['p1', 'p2']
+    assert second["Observation"]["id"].tolist() == ['obs-p3']
+    assert await StorageQueue().dequeue() is None
+
+def test_transform_bundle_validation_modes():
+    """Function to test 'none' and 'sample' validation modes flatten raw json resources"""
+    bundle = _patient_bundle("p1")
+    bundle["entry"][1]["resource"]["effectiveDateTime"] = "yesterday"
+    full = ProcessFihr().transform_bundle(_patient_bundle("p1"))
+    raw = ProcessFihr(validation='none').transform_bundle(_patient_bundle("p1"))
+    assert set(raw) == set(full)
+    for table, columns in full.items():
+        pd.testing.assert_frame_equal(SchemaRegistry().to_frame(table, columns),
+                                      SchemaRegistry().to_frame(table, raw[table]))
+    # Invalid Observation is only dropped when it is validated
+    assert "Observation" in ProcessFihr(validation='none').transform_bundle(bundle)
+    sampled = ProcessFihr(validation='sample', sample_rate=0.5)
+    assert "Observation" in sampled.transform_bundle(bundle)
+    assert "Observation" not in sampled.transform_bundle(bundle)
+    typed = ProcessFihr(validation='none', validate_types=["Observation"])
+    assert set(typed.transform_bundle(bundle)) == {"Patient"}
+
+def test_copy_loader_ddl():
+    """Function to test schema DDL of the COPY loader is grouped per table"""
+    df = pd.DataFrame({"id": ["1"], "value": [1.5], "active": [True], "code": ['"x"']})
+    assert create_table_ddl("Observation", df) == (
+        'CREATE TABLE IF NOT EXISTS "Observation" ("id" TEXT, "value" DOUBLE PRECISION, '
+        '"active" BOOLEAN, "code" TEXT, PRIMARY KEY ("id"))')
+    child = pd.DataFrame({"resource_id": ["1"], "parent_key": [None], "row_key": ["0"],
+                          "id": ["contained"]})
+    assert create_table_ddl("Claim_contained", child).endswith(
+        'PRIMARY KEY ("resource_id", "row_key"))')
+    assert add_columns_ddl("Observation", df, ["value", "code"]) == (
+        'ALTER TABLE "Observation" ADD COLUMN IF NOT EXISTS "value" DOUBLE PRECISION, '
+        'ADD COLUMN IF NOT EXISTS "code" TEXT')
+    assert alter_types_ddl("Observation", {"value": "TEXT"}) == (
+        'ALTER TABLE "Observation" ALTER COLUMN "value" TYPE TEXT USING "value"::TEXT')
+    assert widened_type("BIGINT", "DOUBLE PRECISION") == "DOUBLE PRECISION"
+    assert widened_type("DOUBLE PRECISION", "BIGINT") is None
+    assert widened_type("TIMESTAMPTZ", "TEXT") == "TEXT"
+    assert widened_type("TEXT", "BOOLEAN") is None
+
+@pytest.mark.asyncio
+async def test_process_storage_queue_db_writers(tmp_path):
+    """Function to test StoreFhir stores the tables of the batches with parallel writers"""
+    _drain_queues()
+    for batch in range(3):
+        await StorageQueue().enqueue({
+            "Patient": pd.DataFrame({"id": [f"p{batch}"]}),
+            "Observation": pd.DataFrame({"id": [f"o{batch}-{i}" for i in range(4)]})})
+    await StorageQueue().enqueue(None)
+    storage = StoreFhir(db_writers=3)
+    storage.connection_str = f"sqlite:///{tmp_path}/fhir.db"
+    assert await storage.process_storage_queue_df() is True
+    with create_engine(storage.connection_str).connect() as con:
+        assert con.execute(text('SELECT count(*) FROM "Patient"')).scalar() == 3
+        assert con.execute(text('SELECT count(*) FROM "Observation"')).scalar() == 12
+
+@pytest.mark.asyncio
+async def test_file_sink_parquet(tmp_path):
+    """Function to test FileSink writes one partitioned parquet dataset per resourceType,
+    keeping the categorical columns of batches with different categories dictionary encoded,
+    also when a batch has the column as plain strings"""
+    _drain_queues()
+    for batch in range(3):
+        codes = [f"c{batch}", "x"]
+        await StorageQueue().enqueue({
+            "Observation": pd.DataFrame({"id": [f"o{batch}-{i}" for i in range(2)],
+                                         "status": ["final", None],
+                                         "code": pd.Categorical(codes) if batch else codes})})
+    await StorageQueue().enqueue(None)
+    sink = FileSink(output_dir=str(tmp_path), row_group_size=4)
+    assert await sink.process_storage_queue_df() is True
+    assert sink.files_written == 2
+    partition = tmp_path / "Observation" / f"ingest_date={sink.ingest_date}"
+    df = pd.read_parquet(partition)
+    assert len(df) == 6 and df["status"].tolist().count("final") == 3
+    assert isinstance(df["code"].dtype, pd.CategoricalDtype)
+    assert sorted(df["code"].cat.categories) == ["c0", "c1", "c2", "x"]
+    assert sorted(df["code"].astype(str)) == ["c0", "c1", "c2", "x", "x", "x"]
+
+@pytest.mark.asyncio
+async def test_file_sink_failed_write_not_acked(tmp_path, monkeypatch):
+    """Function to test that rows failing to be written stay buffered and their batches
+    stay in the durable storage queue"""
+    path = str(tmp_path / "queues.db")
+    StorageQueue().configure(backend=SqliteQueueBackend(path, "storage"))
+    for pid in ("p1", "p2"):
+        await StorageQueue().enqueue({"Patient": pd.DataFrame({"id": [pid]})})
+    await StorageQueue().enqueue(None)
+    sink = FileSink(output_dir=str(tmp_path / "out"), file_format='csv')
+
+    def failing_write(table, df):
+        raise OSError("disk full")
+    monkeypatch.setattr(sink, "write_table", failing_write)
+    assert await sink.process_storage_queue_df() is False
+    assert sink._buffers["Patient"][0]["id"].tolist() == ["p1", "p2"]
+    StorageQueue().configure()
+    consumer = SqliteQueueBackend(path, "storage", lease_timeout=0)
+    assert await consumer.depth() == 2
+    consumer.close()
+
+def test_flattener_child_tables():
+    """Function to test FhirFlattener expands nested objects and explodes repeating elements"""
+    resource = {"resourceType": "Observation", "id": "o1", "status": "final",
+                "code": {"coding": [{"system": "http://loinc.org", "code": "8302-2"}],
+                         "text": "Body Height"},
+                "component": [{"code": {"coding": [{"code": "a"}, {"code": "b"}]},
+                               "valueQuantity": {"value": 1.5}}]}
+    tables = FhirFlattener().flatten("Observation", resource)
+    assert tables["Observation"] == [{"resourceType": "Observation", "id": "o1",
+                                      "status": "final", "code_text": "Body Height"}]
+    assert tables["Observation_code_coding"] == [
+        {"resource_id": "o1", "parent_key": None, "row_key": "0",
+         "system": "http://loinc.org", "code": "8302-2"}]
+    assert tables["Observation_component"][0]["valueQuantity_value"] == 1.5
+    assert [r["row_key"] for r in tables["Observation_component_code_coding"]] == ["0.0", "0.1"]
+    assert {r["parent_key"] for r in tables["Observation_component_code_coding"]} == {"0"}
+
+def test_schema_registry_types():
+    """Function to test SchemaRegistry infers, caches and widens column types"""
+    schemas = SchemaRegistry()
+    df = schemas.to_frame("Observation", {
+        "active": [True, None], "count": [1, 2], "value": [1.5, 2],
+        "issued": ["2020-01-01T10:00:00+02:00", "2020-01-02"], "status": ["final", None],
+        "note": [None, None], "valueQuantity_value": [120, None],
+        "comment": ["2020-01-01", "2020-01-01 was the first visit"]})
+    assert [str(t) for t in df.dtypes] == ["boolean", "Int64", "float64",
+                                           "datetime64[ns, UTC]", "category", "object",
+                                           "float64", "object"]
+    assert df["issued"][0] == pd.Timestamp("2020-01-01T08:00:00Z")
+    assert schemas.schemas["Observation"]["issued"] == "timestamp"
+    assert schemas.schemas["Observation"]["comment"] == "string"
+    assert "note" not in schemas.schemas["Observation"]
+    df = schemas.to_frame("Observation", {"count": [3], "issued": ["unknown"]})
+    assert str(df["count"].dtype) == "Int64" and df["issued"].tolist() == ["unknown"]
+    assert schemas.schemas["Observation"]["issued"] == "string"
+    df = schemas.to_frame("Observation", {"count": [3.5, 4]})
+    assert str(df["count"].dtype) == "float64" and df["count"].tolist() == [3.5, 4.0]
+    assert schemas.schemas["Observation"]["count"] == "float"
+    df = schemas.to_frame("Observation", {"count": ["many"]})
+    assert schemas.schemas["Observation"]["count"] == "string"
+
+def test_flattener_plan_cache():
+    """Function to test compiled flatten plans give the generic walk output and are bounded"""
+    resources = [
+        {"resourceType": "Observation", "id": "o1", "code": {"text": "a"},
+         "category": [{"coding": [{"code": "vital-signs"}]}]},
+        {"resourceType": "Observation", "id": "o2", "code": {"text": "b"},
+         "category": [{"coding": [{"code": "laboratory"}]}]},
+        # Same member names, nested shape changed
+        {"resourceType": "Observation", "id": "o3", "code": {"coding": [{"code": "x"}]},
+         "category": [{"text": "survey"}]}]
+    cached, generic = FhirFlattener(), FhirFlattener(plan_cache_size=0)
+    for resource in resources:
+        assert cached.flatten("Observation", resource) == generic.flatten("Observation", resource)
+    assert cached.stats() == {"size": 5, "hits": 4, "misses": 5, "fallbacks": 1, "evictions": 0}
+    bounded = FhirFlattener(plan_cache_size=2)
+    for resource in resources:
+        bounded.flatten("Observation", resource)
+    stats = bounded.stats()
+    assert stats["size"] == 2 and stats["evictions"] == stats["misses"] - 2
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("stream_entries", [0, 1])
+async def test_local_dir_reader_manifest(tmp_path, stream_entries):
+    """Function to test that a rerun with the manifest skips unchanged files, read whole or
+    streamed"""
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+    for pid in ("p1", "p2"):
+        (data_dir / f"{pid}.json").write_text(json.dumps(_patient_bundle(pid)), encoding="UTF-8")
+
+    async def ingest(manifest):
+        _drain_queues()
+        await FhirReader(parse_bundles=False, manifest=manifest,
+                         stream_entries=stream_entries).local_dir_reader(str(data_dir))
+        patients = []
+        while (bundle := await FhirQueue().dequeue()) is not None:
+            patients.extend(e["resource"]["id"] for e in bundle["entry"]
+                            if e["resource"]["resourceType"] == "Patient")
+        manifest.commit()
+        return sorted(patients)
+
+    manifest = IngestManifest(str(tmp_path / "manifest.db"))
+    assert await ingest(manifest) == ["p1", "p2"]
+    assert await ingest(manifest) == []
+    # Touched file with the same content is skipped by the hash, a changed one is read again
+    os.utime(data_dir / "p1.json", (1, 1))
+    (data_dir / "p2.json").write_text(json.dumps(_patient_bundle("p3")), encoding="UTF-8")
+    assert await ingest(manifest) == ["p3"]
+    assert await ingest(manifest) == []
+    # A file failing to parse is not recorded, it is read again once fixed
+    (data_dir / "p4.json").write_text('{"resourceType": "Bundle", "entry": [', encoding="UTF-8")
+    assert await ingest(manifest) == []
+    assert manifest.get(str(data_dir / "p4.json")) is None
+    (data_dir / "p4.json").write_text(json.dumps(_patient_bundle("p4")), encoding="UTF-8")
+    assert await ingest(manifest) == ["p4"]
+    # A file removed after the directory listing is skipped, the others are read
+    _drain_queues()
+    (data_dir / "p5.json").write_text(json.dumps(_patient_bundle("p5")), encoding="UTF-8")
+    reader = FhirReader(parse_bundles=False, manifest=manifest, stream_entries=stream_entries)
+    assert await reader._ingest_files([str(data_dir / "gone.json"),
+                                       str(data_dir / "p5.json")]) is True
+    manifest.close()
+
+@pytest.mark.asyncio
+async def test_local_dir_reader_mmap(tmp_path):
+    """Function to test the mmap read mode with a read ahead window smaller than the
+    directory, an empty file and the manifest"""
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+    for pid in ("p1", "p2", "p3"):
+        (data_dir / f"{pid}.json").write_text(json.dumps(_patient_bundle(pid)), encoding="UTF-8")
+    (data_dir / "empty.json").write_bytes(b"")
+    manifest = IngestManifest(str(tmp_path / "manifest.db"))
+
+    async def ingest():
+        _drain_queues()
+        reader = FhirReader(parse_bundles=False, manifest=manifest, read_mode='mmap',
+                            read_ahead=2)
+        await reader.local_dir_reader(str(data_dir))
+        bundles = []
+        while (bundle := await FhirQueue().dequeue()) is not None:
+            bundles.append(bundle["entry"][0]["resource"]["id"])
+        manifest.commit()
+        return sorted(bundles)
+
+    assert await ingest() == ["p1", "p2", "p3"]
+    os.utime(data_dir / "p1.json", (1, 1))
+    assert await ingest() == []
+    manifest.close()
+
+def test_load_action():
+    """Function to test the mapping of entry.request to the upsert load actions"""
+    assert load_action({"request": {"method": "PUT", "url": "Patient/p1"}}) == ("upsert", None)
+    assert load_action({"request": {"method": "POST", "url": "Patient"}}) == ("upsert", None)
+    assert load_action({}) == ("upsert", None)
+    assert load_action({"request": {"method": "POST", "url": "Patient",
+                                    "ifNoneExist": "identifier=x|1"}}) == ("insert", None)
+    assert load_action({"request": {"method": "DELETE", "url": "Patient/p1"}}) == \
+        ("delete", ("Patient", "p1"))
+    assert load_action({"request": {"method": "DELETE", "url": "Patient?name=x"}}) == \
+        (None, None)
+
+def test_star_schema():
+    """Function to test the star output model dimension tables and surrogate keys"""
+    def bundle(patient_id):
+        block = _patient_bundle(patient_id)
+        block["entry"][1]["resource"]["code"]["coding"] = [
+            {"system": "http://loinc.org", "code": "8302-2", "display": "Body Height"}]
+        block["entry"].append({"resource": {
+            "resourceType": "Encounter", "id": f"enc-{patient_id}", "status": "finished",
+            "class": {"code": "AMB"},
+            "participant": [{"individual": {
+                "reference": "Practitioner?identifier=http://hl7.org/fhir/sid/us-npi|9",
+                "display": "Dr. Who"}}],
+            "serviceProvider": {"reference": "Organization/org1"}}})
+        return block
+    processor = ProcessFihr(validation='none', output_model='star')
+    loinc = surrogate_key("DimCoding", "http://loinc.org", "8302-2")
+    first = processor.star.apply(processor.transform_bundle(bundle("p1")))
+    assert first["DimCoding"] == {"id": [loinc], "system": ["http://loinc.org"],
+                                  "code": ["8302-2"], "display": ["Body Height"],
+                                  "version": [None]}
+    assert first["Observation_code_coding"]["coding_sk"] == [loinc]
+    assert "code" not in first["Observation_code_coding"]
+    assert first["Observation"]["code_coding_sk"] == [loinc]
+    assert first["DimPractitioner"]["display"] == ["Dr. Who"]
+    assert first["Encounter_participant"]["individual_practitioner_sk"] == \
+        first["DimPractitioner"]["id"]
+    assert "individual_reference" not in first["Encounter_participant"]
+    assert first["Encounter"]["serviceProvider_organization_sk"] == \
+        first["DimOrganization"]["id"]
+    # Dimension members already seen are only referenced by the next bundles
+    second = processor.star.apply(processor.transform_bundle(bundle("p2")))
+    assert not {"DimCoding", "DimPractitioner", "DimOrganization"} & set(second)
+    assert second["Observation"]["code_coding_sk"] == [loinc]
+    assert processor.star.stats() == {"size": 3, "hits": 3, "misses": 3}
+    assert StarSchema().apply(processor.transform_bundle(bundle("p3")))["DimCoding"]["id"] == \
+        [loinc]
+    frame = processor.batch.schemas.to_frame("Observation", second["Observation"])
+    assert str(frame["code_coding_sk"].dtype) == "Int64"
+
+def test_reference_index(tmp_path):
+    """Function to test the resolution of references across bundles with a spilling index"""
+    path = str(tmp_path / "references.db")
+    practitioners = {"resourceType": "Bundle", "type": "batch", "entry": [
+        {"fullUrl": "urn:uuid:pr1", "resource": {
+            "resourceType": "Practitioner", "id": "pr1",
+            "identifier": [{"system": "http://hl7.org/fhir/sid/us-npi", "value": "9"}]}}]}
+    processor = ProcessFihr(validation='none', resolve_references=True,
+                            reference_index=path, reference_cache_size=1)
+    columns = processor.references.resolve_columns(processor.transform_bundle(practitioners))
+    assert "_full_url" not in columns["Practitioner"]
+    block = _patient_bundle("p1")
+    block["entry"].append({"resource": {
+        "resourceType": "Encounter", "id": "enc1", "status": "finished", "class": {},
+        "subject": {"reference": "Patient/p1"},
+        "participant": [{"individual": {
+            "reference": "Practitioner?identifier=http://hl7.org/fhir/sid/us-npi|9"}}]}})
+    columns = processor.references.resolve_columns(processor.transform_bundle(block))
+    assert columns["Observation"]["subject_reference_type"] == ["Patient"]
+    assert columns["Observation"]["subject_reference_id"] == ["p1"]
+    assert columns["Encounter"]["subject_reference_id"] == ["p1"]
+    # The practitioner was spilled to disk by the keys of the second bundle
+    assert columns["Encounter_participant"]["individual_reference_id"] == ["pr1"]
+    assert processor.references.stats()["spilled"] > 0
+    processor.references.close()
+    # The index file resolves the references of the next runs
+    assert ReferenceIndex(path=path).resolve("urn:uuid:p1") == ("Patient", "p1")
+    assert ReferenceIndex(path=path).resolve("urn:uuid:unknown") is None
+
+@pytest.mark.asyncio
+async def test_upsert_load_mode():
+    """Function to test that resent, changed and deleted resources are merged on id.
+    Needs the PostgreSQL database of the docker compose setup."""
+    storage = StoreFhir(load_mode='upsert')
+    engine = create_engine(storage.connection_str)
+    try:
+        engine.connect().close()
+    except Exception:
+        pytest.skip("PostgreSQL database is not available")
+
+    def drop_tables():
+        with engine.begin() as con:
+            for table in ("Basic", "Basic_code_coding"):
+                con.execute(text(f'DROP TABLE IF EXISTS "{table}"'))
+
+    def basic(rid, codes, method="PUT", **request):
+        return {"resource": {"resourceType": "Basic", "id": rid,
+                             "code": {"coding": [{"code": c} for c in codes]}},
+                "request": {"method": method, "url": f"Basic/{rid}", **request}}
+
+    async def load(*entries):
+        _drain_queues()
+        await FhirQueue().enqueue({"resourceType": "Bundle", "entry": list(entries)})
+        await FhirQueue().enqueue(None)
+        await ProcessFihr(validation='none', load_actions=True).process_bundle()
+        assert await StoreFhir(load_mode='upsert').process_storage_queue_df() is True
+        with engine.connect() as con:
+            rows = con.execute(text('SELECT id, count(c.row_key) FROM "Basic" b LEFT JOIN '
+                                    '"Basic_code_coding" c ON c.resource_id = b.id '
+                                    'GROUP BY id ORDER BY id')).fetchall()
+        return [tuple(row) for row in rows]
+
+    drop_tables()
+    try:
+        assert await load(basic("b1", "xy"), basic("b2", "z", "POST")) == [("b1", 2), ("b2", 1)]
+        # Full resend is idempotent
+        assert await load(basic("b1", "xy"), basic("b2", "z", "POST")) == [("b1", 2), ("b2", 1)]
+        # Corrections replace the child rows, conditional create keeps the stored resource
+        assert await load(basic("b1", "x"), basic("b2", "uvw", "POST", ifNoneExist="id=b2"),
+                          basic("b3", "")) == [("b1", 1), ("b2", 1), ("b3", 0)]
+        assert await load({"request": {"method": "DELETE", "url": "Basic/b1"}}) == \
+            [("b2", 1), ("b3", 0)]
+    finally:
+        drop_tables()
+        engine.dispose()
+
+async def _storage_ids(table: str) -> list:
+    """Drains the storage queue and returns the ids stored in a table"""
+    ids = []
+    while (frames := await StorageQueue().dequeue()) is not None:
+        if table in frames:
+            ids.extend(frames[table]["id"])
+    return ids
+
+@pytest.mark.asyncio
+async def test_dead_letters_replay(tmp_path):
+    """Function to test that invalid resources and bundles without entry are dead lettered
+    while the rest is processed, and that a replay reprocesses only the dead letters"""
+    db_path = str(tmp_path / "dead_letters.db")
+    DeadLetterStore().configure(db_path)
+    invalid = _patient_bundle("p1")
+    invalid["entry"][1]["resource"]["bogus"] = 1
+    _drain_queues()
+    for bundle in (invalid, {"resourceType": "Bundle", "type": "collection"},
+                   _patient_bundle("p2")):
+        await FhirQueue().enqueue(bundle)
+    await FhirQueue().enqueue(None)
+    assert await ProcessFihr().process_bundle() is True
+    assert await _storage_ids("Observation") == ["obs-p2"]
+    records = DeadLetterStore().pending()
+    assert [(r["stage"], r["resource_id"]) for r in records] == \
+        [("transform", "obs-p1"), ("transform", None)]
+    # The invalid resource is corrected in the store, the bundle without entry is not
+    entry = records[0]["payload"]["entry"]
+    del entry["resource"]["bogus"]
+    with sqlite3.connect(db_path) as con:
+        con.execute("UPDATE dead_letters SET payload = ? WHERE id = ?",
+                    (json.dumps({"entry": entry}), records[0]["id"]))
+    DeadLetterStore().replaying = []
+    _drain_queues()
+    assert await FhirReader().dead_letter_reader() is True
+    await ProcessFihr().process_bundle()
+    assert await _storage_ids("Observation") == ["obs-p1"]
+    DeadLetterStore().commit_replay()
+    assert [r["resource_id"] for r in DeadLetterStore().pending()] == [None]
+    DeadLetterStore().configure()
+
+@pytest.mark.asyncio
+async def test_store_dead_letters(tmp_path):
+    """Function to test that a failed batch is stored resource by resource and only the
+    failing resource is dead lettered. Needs the PostgreSQL database of the docker compose
+    setup."""
+    storage = StoreFhir()
+    engine = create_engine(storage.connection_str)
+    try:
+        engine.connect().close()
+    except Exception:
+        pytest.skip("PostgreSQL database is not available")
+    DeadLetterStore().configure(str(tmp_path / "dead_letters.db"))
+
+    def drop_tables():
+        with engine.begin() as con:
+            for table in ("Basic", "Basic_code_coding"):
+                con.execute(text(f'DROP TABLE IF EXISTS "{table}"'))
+
+    def basic(rid):
+        return {"resource": {"resourceType": "Basic", "id": rid,
+                             "code": {"coding": [{"code": rid}]}}}
+
+    drop_tables()
+    try:
+        _drain_queues()
+        # b1 is sent twice, the second time it violates the primary key
+        for entries in ([basic("b1")], [basic("b1"), basic("b2")]):
+            await FhirQueue().enqueue({"resourceType": "Bundle", "entry": entries})
+        await FhirQueue().enqueue(None)
+        await ProcessFihr(validation='none').process_bundle()
+        assert await StoreFhir().process_storage_queue_df() is True
+        with engine.connect() as con:
+            rows = con.execute(text('SELECT id FROM "Basic" ORDER BY id')).fetchall()
+        assert [row[0] for row in rows] == ["b1", "b2"]
+        records = DeadLetterStore().pending()
+        assert [(r["stage"], r["resource_type"], r["resource_id"]) for r in records] == \
+            [("store", "Basic", "b1")]
+        assert [row["id"] for row in records[0]["payload"]["tables"]["Basic"]] == ["b1"]
+    finally:
+        drop_tables()
+        engine.dispose()
+        DeadLetterStore().configure()
+
+@pytest.mark.parametrize("load_method", ["copy", "to_sql"])
+def test_store_widened_columns(load_method):
+    """Function to test the PostgreSQL columns are altered when SchemaRegistry widens a
+    column, an integer column to float and a timestamp column to text. Needs the
+    PostgreSQL database of the docker compose setup."""
+    storage = StoreFhir(load_method=load_method)
+    engine = create_engine(storage.connection_str)
+    try:
+        engine.connect().close()
+    except Exception:
+        pytest.skip("PostgreSQL database is not available")
+
+    def drop_table():
+        with engine.begin() as con:
+            con.execute(text('DROP TABLE IF EXISTS "Basic"'))
+
+    schemas = SchemaRegistry()
+    batches = [{"id": ["b1"], "count": [1], "created": ["2020-01-01"]},
+               {"id": ["b2"], "count": [1.5], "created": ["unknown"]},
+               {"id": ["b3"], "count": [None], "created": [None]}]
+    drop_table()
+    try:
+        for columns in batches:
+            storage._write_batch(engine, {"Basic": schemas.to_frame("Basic", columns)}, set())
+        with engine.connect() as con:
+            types = dict(con.execute(text(
+                "SELECT column_name, data_type FROM information_schema.columns "
+                "WHERE table_name = 'Basic'")).fetchall())
+            rows = con.execute(text('SELECT id, count, created FROM "Basic" ORDER BY id'))
+            rows = [tuple(row) for row in rows.fetchall()]
+        assert types == {"id": "text", "count": "double precision", "created": "text"}
+        assert rows[1:] == [("b2", 1.5, "unknown"), ("b3", None, None)]
+        assert rows[0][:2] == ("b1", 1.0) and rows[0][2].startswith("2020-01-01")
+    finally:
+        drop_table()
+        engine.dispose()
+
+@pytest.mark.asyncio
+async def test_url_directory_reader_cache(tmp_path):
+    """Function to test url_directory_reader() retries, limits and cache revalidation"""
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+    for pid in ("p1", "p2", "p3"):
+        (data_dir / f"{pid}.json").write_text(json.dumps(_patient_bundle(pid)), encoding="UTF-8")
+    server = await LocalFhirServer(str(data_dir), failures=1).start()
+    url, log = server.folder_url, server.log
+
+    async def ingest(**kwargs):
+        _drain_queues()
+        reader = FhirReader(parse_bundles=False, cache_dir=str(tmp_path / "cache"), backoff=0,
+                            http_limit_per_host=2, **kwargs)
+        assert await reader.url_directory_reader(url) is True
+        bundle_ids = []
+        while (bundle := await FhirQueue().dequeue()) is not None:
+            bundle_ids.extend(e["resource"]["id"] for e in bundle["entry"])
+        return sorted(bundle_ids), reader
+
+    try:
+        ids, _ = await ingest()
+        assert ids == ["obs-p1", "obs-p2", "obs-p3", "p1", "p2", "p3"]
+        assert [status for _, status in log].count(503) == 1
+        # Second pull only revalidates, the bodies come from the cache
+        log.clear()
+        (data_dir / "p2.json").write_text(json.dumps(_patient_bundle("p4")), encoding="UTF-8")
+        # Same size, the ETag changes with the mtime
+        os.utime(data_dir / "p2.json", (1, 1))
+        ids, reader = await ingest(stream_entries=1)
+        assert ids == ["obs-p1", "obs-p3", "obs-p4", "p1", "p3", "p4"]
+        assert sorted(log) == [("p1.json", 304), ("p2.json", 200), ("p3.json", 304)]
+        assert reader.cache.hits == 2
+    finally:
+        await server.close()
+
+@pytest.mark.asyncio
+async def test_sqlite_queue_backend(tmp_path):
+    """Function to test the durable queue: acknowledgements, lease recovery and the end
+    markers of several producer shards"""
+    path = str(tmp_path / "queues.db")
+    producer = SqliteQueueBackend(path, "fhir", producers=2)
+    await producer.open_producer(0)
+    for item in ({"id": 1}, {"id": 2}):
+        await producer.put(item)
+    await producer.put(None)
+
+    consumer = SqliteQueueBackend(path, "fhir", producers=2)
+    assert await consumer.get() == {"id": 1}
+    await consumer.ack(1)
+    assert await consumer.get() == {"id": 2}
+    # Crashed consumer: the unacknowledged item is handed out again once its lease expires
+    consumer.close()
+    consumer = SqliteQueueBackend(path, "fhir", producers=2, lease_timeout=0)
+    assert consumer.qsize() == 1 and await consumer.depth() == 1
+    assert await consumer.get() == {"id": 2}
+    await consumer.ack(1)
+    # Stream ends only when the second producer shard is done too
+    with pytest.raises(QueueEmpty):
+        await consumer.get_nowait()
+    await producer.open_producer(1)
+    await producer.put(None)
+    assert await consumer.get() is None
+    producer.close()
+    consumer.close()
+
+def test_reader_shards():
+    """Function to test that the reader shards split the input files"""
+    names = [f"{i}.json" for i in range(50)]
+    shards = [[n for n in names if FhirReader(shard_id=i, shard_count=3)._in_shard(n)]
+              for i in range(3)]
+    assert sorted(sum(shards, [])) == sorted(names)
+    assert all(shards)
+
+def test_synthetic_generator(tmp_path):
+    """Function to test the benchmark bundle generator"""
+    template_dir = tmp_path / "templates"
+    template_dir.mkdir()
+    bundle = _patient_bundle("8c95253e-8ee8-9ae8-6d40-021d702dc78e")
+    bundle["entry"][1]["resource"]["id"] = "4dbc90e0-b7b2-482c-24af-1405654e59ae"
+    (template_dir / "t.json").write_text(json.dumps(bundle), encoding="UTF-8")
+    stats = generate_dataset(str(tmp_path / "out"), 3, 4, str(template_dir))
+    assert stats["files"] == 3 and stats["resources"] == 15
+    ids = set()
+    for path in sorted((tmp_path / "out").iterdir()):
+        entries = json.loads(path.read_text(encoding="UTF-8"))["entry"]
+        assert [e["resource"]["resourceType"] for e in entries] == ["Patient"] + ["Observation"] * 4
+        # References follow the new patient id
+        assert {e["resource"]["subject"]["reference"] for e in entries[1:]} == \
+            {f"urn:uuid:{entries[0]['resource']['id']}"}
+        ids.update(e["resource"]["id"] for e in entries)
+    assert len(ids) == 15
+
+def test_offline_harness(tmp_path):
+    """Function to test main() end to end, from a local stand-in of the github folder url
+    to a SQLite database, with the row counts checked per resourceType"""
+    generate_dataset(str(tmp_path / "data"), 3, 30)
+    figures = bench_e2e.run(str(tmp_path / "data"), "get_folder_url", "sqlite",
+                            str(tmp_path / "out"), ["--validation", "none"])
+    assert figures["mismatches"] == []
+    assert figures["files"] == 3 and figures["http_requests"] == 4
+    assert figures["stored"]["Patient"] == 3
+    assert sum(figures["stored"].values()) == figures["resources"] == 93
+
+@pytest.mark.asyncio
+async def test_metrics():
+    """Function to test the transform metrics and their Prometheus text format"""
+    _drain_queues()
+    metrics = Metrics()
+    metrics.reset()
+    FhirQueue().register_metrics("fhir")
+    await FhirQueue().enqueue(_patient_bundle("p1"))
+    await FhirQueue().enqueue(None)
+    await ProcessFihr(validation='none').process_bundle()
+    text_format = metrics.render()
+    assert 'fhir_rows_total{table="Patient"} 1' in text_format
+    assert 'fhir_transform_seconds_count{mode="inline"} 1' in text_format
+    assert 'fhir_transform_seconds_bucket{mode="inline",le="+Inf"} 1' in text_format
+    assert 'fhir_queue_dequeued{queue="fhir"} 2' in text_format
+    assert "fhir_flush_seconds{}" not in text_format
+    assert "count=1" in metrics.summary()
+    metrics.reset()
@@ -0,0 +1,133 @@
+"""ColumnarBatchBuilder accumulates flattened resources per resourceType in per-column lists.
+Appending a row is linear in the number of columns of the resourceType, new or sparse columns
+are back-filled with None, and one dataframe per resourceType is built only when the batch
+is flushed to the storage queue. Column types are inferred by a SchemaRegistry. The strings
+of the coded columns are interned, so that a repeated code, system or status is held once in
+memory and pickled once per bundle by the transform workers."""
+from sys import intern
+from transform_fhir_records.flattener import SchemaRegistry, is_category_column
+
+def _value_size(value) -> int:
+    """Rough size in bytes of a flattened value, used for the flush threshold"""
+    return len(value) if isinstance(value, (str, bytes)) else 8
+
+class ColumnarTable:
+    """Column name -> list of values for the rows of one resourceType"""
+    def __init__(self, intern_strings: bool = True) -> None:
+        self.columns = {}
+        self.num_rows = 0
+        self.nbytes = 0
+        self.intern_strings = intern_strings
+        # Columns whose strings are interned
+        self.interned = set()
+
+    def _new_column(self, col: str) -> list:
+        """Adds a column back-filled with None for the rows appended so far"""
+        values = self.columns[col] = [None] * self.num_rows
+        if self.intern_strings and is_category_column(col):
+            self.interned.add(col)
+        return values
+
+    def append(self, row: dict):
+        """Append one flattened resource to the table.
+        Input: row=Dictionary of column name -> value
+        Returns: None"""
+        columns = self.columns
+        interned = self.interned
+        for col, value in row.items():
+            values = columns.get(col)
+            if values is None:
+                values = self._new_column(col)
+            if col in interned and type(value) is str:
+                value = intern(value)
+            values.append(value)
+            self.nbytes += _value_size(value)
+        self.num_rows += 1
+        # Columns missing in this row
+        if len(columns) > len(row):
+            for values in columns.values():
+                if len(values) < self.num_rows:
+                    values.append(None)
+
+    def extend(self, columns: dict):
+        """Append the rows of another columnar dict (column name -> list of values).
+        Input: columns=Columnar dict, all lists having the same length
+        Returns: None"""
+        if not columns:
+            return
+        num_rows = len(next(iter(columns.values())))
+        for col, values in columns.items():
+            if col not in self.columns:
+                self._new_column(col)
+            if col in self.interned:
+                values = [intern(v) if type(v) is str else v for v in values]
+            self.columns[col].extend(values)
+            self.nbytes += sum(_value_size(v) for v in values)
+        self.num_rows += num_rows
+        for values in self.columns.values():
+            if len(values) < self.num_rows:
+                values.extend([None] * (self.num_rows - len(values)))
+
+class ColumnarBatchBuilder:
+    """Accumulates ColumnarTable objects per resourceType until a flush threshold is reached.
+    With both thresholds set to 0 every bundle is flushed on its own."""
+    def __init__(self, flush_rows=0, flush_bytes=0, schemas: SchemaRegistry = None,
+                 dictionary_encoding: bool = True) -> None:
+        self.flush_rows = flush_rows
+        self.flush_bytes = flush_bytes
+        self.tables = {}
+        self.schemas = SchemaRegistry(dictionary_encoding) if schemas is None else schemas
+        # Interns the coded strings and builds categorical columns from them
+        self.dictionary_encoding = dictionary_encoding
+
+    @property
+    def num_rows(self) -> int:
+        """Number of rows accumulated over all resourceTypes"""
+        return sum(t.num_rows for t in self.tables.values())
+
+    @property
+    def nbytes(self) -> int:
+        """Approximate size in bytes of the accumulated values"""
+        return sum(t.nbytes for t in self.tables.values())
+
+    def append(self, resource_type: str, row: dict):
+        """Append one flattened resource.
+        Input: resource_type=resourceType i.e. table name
+               row=Dictionary of column name -> value
+        Returns: None"""
+        table = self.tables.get(resource_type)
+        if table is None:
+            table = self.tables[resource_type] = ColumnarTable(self.dictionary_encoding)
+        table.append(row)
+
+    def extend(self, columns_dict: dict):
+        """Append the output of ProcessFihr.transform_bundle().
+        Input: columns_dict=Dictionary of resourceType -> columnar dict
+        Returns: None"""
+        for resource_type, columns in columns_dict.items():
+            table = self.tables.get(resource_type)
+            if table is None:
+                table = self.tables[resource_type] = ColumnarTable(self.dictionary_encoding)
+            table.extend(columns)
+
+    def to_columns(self) -> dict:
+        """Returns the accumulated tables as resourceType -> columnar dict"""
+        return {k: t.columns for k, t in self.tables.items()}
+
+    def should_flush(self) -> bool:
+        """Tells if the row-count or byte threshold is reached
+        Input: None
+        Returns: Boolean value, always True when no threshold is configured"""
+        if not self.flush_rows and not self.flush_bytes:
+            return bool(self.tables)
+        return (bool(self.flush_rows) and self.num_rows >= self.flush_rows) or \
+               (bool(self.flush_bytes) and self.nbytes >= self.flush_bytes)
+
+    def flush(self) -> dict:
+        """Builds one typed dataframe per resourceType and empties the builder
+        Input: None
+        Returns: Dictionary of resourceType -> dataframe"""
+        df_dict = {k: self.schemas.to_frame(k, t.columns)
+                   for k, t in self.tables.items() if t.num_rows}
+        self.tables = {}
+        return df_dict
@@ -0,0 +1,325 @@
+"""FhirFlattener flattens fhir resource dictionaries into tabular rows. Nested objects are
+expanded into prefixed columns of the same row (code_text, subject_reference, period_start)
+and repeating elements (lists of objects) are exploded into child tables named
+<resourceType>_<path>, linked to their parent by resource_id and parent_key/row_key.
+Flatten plans compiled per table and shape are cached, so resources of a known shape skip
+the generic recursive walk. SchemaRegistry infers and caches a column type per table (boolean, integer, float,
+timestamp, string) and builds typed dataframes from the flattened columns. The coded elements repeating
+a few values across resources (is_category_column()) are dictionary encoded as categorical
+columns. pandas is imported when the first dataframe is built."""
+from __future__ import annotations
+import json
+import logging
+import re
+from collections import OrderedDict
+from datetime import date
+from decimal import Decimal
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+SEPARATOR = '_'
+# Columns linking the rows of a child table to the resource and the parent element
+RESOURCE_ID = 'resource_id'
+PARENT_KEY = 'parent_key'
+ROW_KEY = 'row_key'
+# Column of the resourceType rows telling the upsert loader how to merge the row:
+# 'upsert', 'insert' (conditional create) or 'delete'. Not stored in the tables.
+LOAD_ACTION = '_load_action'
+
+# Elements holding codes, enumerations, CodeableConcept texts and references, which repeat
+# the same few values over thousands of resources (every Observation of a patient has the
+# same subject_reference). Their strings are interned by the columnar builder and their
+# columns are categorical, i.e. every distinct value is stored once per column.
+CATEGORY_ELEMENTS = frozenset(('resourceType', 'system', 'code', 'display', 'version',
+                               'status', 'unit', 'use', 'gender', 'language', 'intent',
+                               'priority', 'profile', 'currency', 'text', 'reference'))
+# Elements of the FHIR decimal type (Quantity.value, Location.position, SampledData) and
+# the decimal choice elements (valueDecimal). json writes a decimal without a fraction as
+# an integer (a quantity can be 120 and later 120.5), so their columns are float from the
+# first batch instead of being widened from integer.
+DECIMAL_ELEMENTS = frozenset(('value', 'factor', 'factorOverride', 'latitude', 'longitude',
+                              'altitude', 'period', 'lowerLimit', 'upperLimit'))
+# Type a column is widened to when its values do not fit, string for the other types
+WIDER_TYPES = {'integer': 'float'}
+# Distinct json arrays of repeating primitives kept by FhirFlattener
+JSON_ARRAY_CACHE_SIZE = 4096
+
+# FHIR date, dateTime and instant values with at least a day part
+_TIMESTAMP_RE = re.compile(r'\d{4}-\d{2}-\d{2}([T ]\d{2}:\d{2}(:\d{2}(\.\d+)?)?(Z|[+-]\d{2}:\d{2})?)?$')
+
+def _emit_plan(obj: dict, var: str, prefix: str, table: str, lines: list, consts: dict,
+               indent: str):
+    """Emits the python statements flattening the members of a dictionary shape
+    Input: obj=Sample dictionary of the shape
+           var=Name of the variable holding the dictionary in the generated code
+           prefix=Column name prefix of the members of obj
+           table=Table name of the rows built from obj
+           lines=List collecting the generated lines
+           consts=Dictionary collecting the constants used by the generated code
+           indent=Indentation of the generated statements
+    Returns: None"""
+    for k, v in obj.items():
+        col = prefix + k
+        val = f"v{len(lines)}"
+        fallback = f"{indent}    fl._fallback({col!r}, {val}, row, table, resource_id, row_key, tables)"
+        lines.append(f"{indent}{val} = {var}[{k!r}]")
+        if isinstance(v, dict):
+            keys = f"K{len(consts)}"
+            consts[keys] = tuple(v)
+            lines.append(f"{indent}if isinstance({val}, dict) and tuple({val}) == {keys}:")
+            _emit_plan(v, val, col + SEPARATOR, table, lines, consts, indent + "    ")
+            if not v:
+                # An empty object adds no column
+                lines.append(f"{indent}    pass")
+        elif isinstance(v, list) and any(isinstance(item, dict) for item in v):
+            lines.append(f"{indent}if isinstance({val}, list):")
+            lines.append(f"{indent}    fl._children({table + SEPARATOR + col!r}, {val}, "
+                         "resource_id, row_key, tables)")
+        elif isinstance(v, list):
+            lines.append(f"{indent}if isinstance({val}, list) and "
+                         f"not any(isinstance(item, dict) for item in {val}):")
+            lines.append(f"{indent}    if {val}:")
+            lines.append(f"{indent}        row[{col!r}] = fl._json_array({val})")
+        else:
+            # FHIR fixes the type of every element name, so a primitive member stays
+            # primitive for a given shape and is copied without a type check
+            lines[-1] = f"{indent}row[{col!r}] = {var}[{k!r}]"
+            continue
+        lines.append(f"{indent}else:")
+        lines.append(fallback)
+
+def compile_plan(obj: dict, table: str):
+    """Compiles a flat extractor function for a dictionary shape. The generated function
+    reads every member by name, writes it to its precomputed column and hands the members
+    whose shape differs from the sample back to the generic walk.
+    Input: obj=Sample dictionary of the shape
+           table=Table name of the rows built from obj
+    Returns: Function (obj, row, table, resource_id, row_key, tables, flattener)"""
+    lines = ["def extract(obj, row, table, resource_id, row_key, tables, fl):"]
+    consts = {}
+    _emit_plan(obj, "obj", '', table, lines, consts, "    ")
+    lines.append("    return None")
+    namespace = {"json": json, **consts}
+    exec("\n".join(lines), namespace)  # pylint: disable=exec-used
+    return namespace["extract"]
+
+class FhirFlattener:
+    """Flattens one resource into a root row and the rows of its child tables.
+    A flatten plan is compiled on the first sight of a table and member names and reused
+    for every later object of the same shape. A member whose shape differs from the plan
+    falls back to the generic walk. Plans are kept in a LRU of plan_cache_size entries,
+    plan_cache_size=0 always uses the generic walk."""
+    def __init__(self, plan_cache_size=1024) -> None:
+        self.plan_cache_size = plan_cache_size
+        self._plans = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.fallbacks = 0
+        self.evictions = 0
+        # json text of the arrays of strings seen, so that repeated arrays (profiles,
+        # address lines) are serialized once and share one string
+        self._json_arrays = {}
+
+    def stats(self) -> dict:
+        """Returns the plan cache counters
+        Input: None
+        Returns: Dictionary of cache size, hits, misses, members flattened by the generic
+                 walk after a shape change and evictions"""
+        return {"size": len(self._plans), "hits": self.hits, "misses": self.misses,
+                "fallbacks": self.fallbacks, "evictions": self.evictions}
+
+    def _json_array(self, values: list) -> str:
+        """Returns the json array text of repeating primitives, memoized for strings"""
+        if not all(type(v) is str for v in values):
+            return json.dumps(values, default=str)
+        key = tuple(values)
+        text = self._json_arrays.get(key)
+        if text is None:
+            if len(self._json_arrays) >= JSON_ARRAY_CACHE_SIZE:
+                self._json_arrays.clear()
+            text = self._json_arrays[key] = json.dumps(values)
+        return text
+
+    def flatten(self, table: str, resource: dict) -> dict:
+        """Flattens a resource dictionary (raw json or fhir.resources dict())
+        Input: table=Table name of the resource i.e. resourceType
+               resource=Resource dictionary
+        Returns: Dictionary of table name -> list of rows, root table first"""
+        root = {}
+        tables = {table: [root]}
+        self._object(resource, root, table, resource.get("id"), None, tables)
+        return tables
+
+    def _object(self, obj: dict, row: dict, table: str, resource_id, row_key, tables: dict):
+        """Flattens a resource or a repeating element into row, with its cached plan"""
+        if self.plan_cache_size:
+            self._plan(table, obj)(obj, row, table, resource_id, row_key, tables, self)
+        else:
+            self._walk(obj, '', row, table, resource_id, row_key, tables)
+
+    def _plan(self, table: str, obj: dict):
+        """Returns the cached plan of a table and member names, compiling it on a miss"""
+        key = (table, tuple(obj))
+        extract = self._plans.get(key)
+        if extract is not None:
+            self.hits += 1
+            self._plans.move_to_end(key)
+            return extract
+        self.misses += 1
+        extract = self._plans[key] = compile_plan(obj, table)
+        if len(self._plans) > self.plan_cache_size:
+            self._plans.popitem(last=False)
+            self.evictions += 1
+        return extract
+
+    def _fallback(self, col: str, v, row: dict, table: str, resource_id, row_key,
+                  tables: dict):
+        """Called by the compiled plans for a member whose shape differs from the plan"""
+        self.fallbacks += 1
+        self._member(col, v, row, table, resource_id, row_key, tables)
+
+    def _walk(self, obj: dict, prefix: str, row: dict, table: str, resource_id,
+              row_key, tables: dict):
+        """Recursively adds the members of obj to row and the repeating elements to tables
+        Input: obj=Dictionary to be flattened
+               prefix=Column name prefix of the members of obj
+               row=Row being built
+               table=Table name of row
+               resource_id=id of the resource being flattened
+               row_key=Key of row in its table, None for the root row
+               tables=Dictionary of table name -> list of rows being built"""
+        for k, v in obj.items():
+            self._member(prefix + k, v, row, table, resource_id, row_key, tables)
+
+    def _member(self, col: str, v, row: dict, table: str, resource_id, row_key,
+                tables: dict):
+        """Generic flattening of one member, col being its column name"""
+        if isinstance(v, dict):
+            self._walk(v, col + SEPARATOR, row, table, resource_id, row_key, tables)
+        elif isinstance(v, list):
+            if any(isinstance(item, dict) for item in v):
+                self._children(table + SEPARATOR + col, v, resource_id, row_key, tables)
+            elif v:
+                # Repeating primitives (given names, profiles) are kept as a json array
+                row[col] = self._json_array(v)
+        else:
+            row[col] = v
+
+    def _children(self, child_table: str, items: list, resource_id, row_key, tables: dict):
+        """Explodes a repeating element into rows of its child table"""
+        child_rows = tables.setdefault(child_table, [])
+        for i, item in enumerate(items):
+            child_key = str(i) if row_key is None else f"{row_key}.{i}"
+            child = {RESOURCE_ID: resource_id, PARENT_KEY: row_key, ROW_KEY: child_key}
+            if isinstance(item, dict):
+                self._object(item, child, child_table, resource_id, child_key, tables)
+            else:
+                child["value"] = item
+            child_rows.append(child)
+
+def is_category_column(col: str) -> bool:
+    """Tells if a column holds a coded element (code_coding_system, status, valueQuantity_unit)
+    and is dictionary encoded. Decided by name, so that a column keeps its encoding in every
+    batch and run."""
+    return col.rsplit(SEPARATOR, 1)[-1] in CATEGORY_ELEMENTS
+
+def is_decimal_column(col: str) -> bool:
+    """Tells if a column holds a FHIR decimal element (valueQuantity_value, valueDecimal),
+    whose numbers are float even when the batch only has integers"""
+    element = col.rsplit(SEPARATOR, 1)[-1]
+    return element in DECIMAL_ELEMENTS or element.endswith('Decimal')
+
+def infer_type(values: list, col: str = ''):
+    """Infers the column type of a list of flattened values
+    Input: values=Column values, None for missing values
+           col=Column name, telling the decimal elements from the integer ones
+    Returns: 'boolean', 'integer', 'float', 'timestamp', 'string' or None when all values
+             are missing"""
+    types = {type(v) for v in values if v is not None}
+    if not types:
+        return None
+    if types == {bool}:
+        return 'boolean'
+    if types == {int} and not is_decimal_column(col):
+        return 'integer'
+    if bool not in types and types <= {int, float, Decimal}:
+        return 'float'
+    if all(issubclass(t, date) for t in types):
+        return 'timestamp'
+    if all(issubclass(t, str) for t in types):
+        # Every value must be a timestamp, a note starting with a date is a string
+        if all(_TIMESTAMP_RE.match(v) for v in values if v is not None):
+            return 'timestamp'
+    return 'string'
+
+def cast_column(values: list, col_type: str):
+    """Converts a list of values to a typed series
+    Input: values=Column values
+           col_type=Column type from infer_type() or declare()
+    Returns: Typed series, or None when the values do not fit the type"""
+    import pandas as pd
+    try:
+        if col_type == 'integer':
+            return pd.Series(pd.array(values, dtype='Int64'))
+        if col_type == 'boolean':
+            return pd.Series(pd.array(values, dtype='boolean'))
+        if col_type == 'float':
+            return pd.Series(values, dtype='float64')
+        if col_type == 'timestamp':
+            series = pd.Series(values, dtype=object)
+            converted = pd.to_datetime(series, utc=True, errors='coerce', format='ISO8601')
+            if (converted.isna() & series.notna()).any():
+                return None
+            return converted
+    except (TypeError, ValueError, OverflowError):
+        return None
+    return pd.Series([v if v is None or isinstance(v, str) else str(v) for v in values],
+                     dtype=object)
+
+class SchemaRegistry:
+    """Per table cache of the inferred column types. The first batch having values for a
+    column fixes its type, later batches are cast to it so that database tables and
+    parquet datasets keep one type per column. A column whose values do not fit is
+    widened, integer to float and any other type to string."""
+    def __init__(self, dictionary_encoding: bool = True) -> None:
+        self.schemas = {}
+        # String columns of is_category_column() are built as categorical
+        self.dictionary_encoding = dictionary_encoding
+
+    def declare(self, table: str, col: str, col_type: str):
+        """Fixes the type of a column instead of inferring it, e.g. 'integer' for surrogate
+        keys whose first batch could be all missing
+        Input: table=Table name
+               col=Column name
+               col_type=Column type
+        Returns: None"""
+        self.schemas.setdefault(table, {})[col] = col_type
+
+    def to_frame(self, table: str, columns: dict) -> pd.DataFrame:
+        """Builds a typed dataframe from a columnar dict
+        Input: table=Table name
+               columns=Dictionary of column name -> list of values
+        Returns: Dataframe"""
+        import pandas as pd
+        schema = self.schemas.setdefault(table, {})
+        data = {}
+        for col, values in columns.items():
+            col_type = schema.get(col) or infer_type(values, col)
+            if col_type is None:
+                data[col] = pd.Series(values, dtype=object)
+                continue
+            series = cast_column(values, col_type)
+            while series is None:
+                wider = WIDER_TYPES.get(col_type, 'string')
+                if col in schema:
+                    logging.warning("Column %s.%s widened from %s to %s", table, col,
+                                    col_type, wider)
+                col_type = wider
+                series = cast_column(values, col_type)
+            schema[col] = col_type
+            if col_type == 'string' and self.dictionary_encoding and is_category_column(col):
+                series = series.astype('category')
+            data[col] = series
+        return pd.DataFrame(data)
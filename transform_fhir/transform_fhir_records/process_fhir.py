@@ -1,92 +1,433 @@
 """ProcessFihr module reads fhir model object from the queue, parses and flattens the object
  and transform resource objects in tabular form representing resourceType as DB table."""
+import asyncio
 import importlib
 import logging
-from collections import OrderedDict
-import simplejson as json
-import pandas as pd
+import os
+from collections import Counter, deque
+from functools import lru_cache
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor
 from  common.fhir_queue import FhirQueue
 from common.storage_queue import StorageQueue
+from common.metrics import Metrics
+from common.dead_letter import DeadLetterStore, dead_letter
+from transform_fhir_records.columnar_batch import ColumnarBatchBuilder
+from transform_fhir_records.flattener import FhirFlattener, LOAD_ACTION
+from transform_fhir_records.star_schema import StarSchema, OUTPUT_MODELS
+from transform_fhir_records.reference_index import ReferenceIndex, FULL_URL
 
-logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', 
-                    filename='transform_fhir.log', encoding='utf-8', level=logging.INFO,
-                    datefmt='%Y-%m-%d %H:%M:%S')
+VALIDATION_MODES = ('full', 'sample', 'none')
+
+# ProcessFihr instance of a worker process of the transform pool
+_worker_processor = None
+
+def _init_worker(config: dict):
+    """Initializer of the worker processes of the transform pool.
+    Input: config=ProcessFihr keyword arguments
+    Returns: None"""
+    global _worker_processor
+    _worker_processor = ProcessFihr(**config)
+
+def _transform_in_worker(fhil_block) -> tuple:
+    """Entry point for the worker processes of the transform pool.
+    Input: fhil_block=Bundle model object or raw bundle json dict
+    Returns: Tuple of the columnar dict as returned by ProcessFihr.transform_bundle(), the
+             dead letters of the bundle, recorded by the main process, and the process id
+             with the cache counters of the worker, aggregated by the main process"""
+    return (_worker_processor.transform_bundle(fhil_block), _worker_processor.take_failures(),
+            (os.getpid(), _worker_processor.cache_stats()))
+
+def _sum_counters(counters) -> dict:
+    """Sums dictionaries of counters key by key"""
+    total = Counter()
+    for counter in counters:
+        total.update(counter)
+    return dict(total)
+
+def load_action(entry: dict) -> tuple:
+    """Maps entry.request of a bundle entry to the action of the upsert loader.
+    PUT and POST merge the resource on its id (a POST with the id of a stored resource is a
+    resend), a conditional create (POST with ifNoneExist) only inserts a new id and DELETE
+    removes the resource. Entries without request are merged as well.
+    Input: entry=Bundle entry dictionary
+    Returns: Tuple of action and, for DELETE, (resourceType, id) parsed from request.url.
+             Action is None for entries that can not be loaded"""
+    request = entry.get("request") or {}
+    method = (request.get("method") or "PUT").upper()
+    if method == "DELETE":
+        resource_type, _, resource_id = (request.get("url") or "").partition("/")
+        if not resource_id or "?" in resource_type or "/" in resource_id:
+            logging.warning("Unsupported DELETE url %s", request.get("url"))
+            return None, None
+        return "delete", (resource_type, resource_id)
+    if method == "POST" and request.get("ifNoneExist"):
+        return "insert", None
+    if method in ("PUT", "POST"):
+        return "upsert", None
+    logging.warning("Skipping entry with request method %s", method)
+    return None, None
+
+def _observe_latency(name: str, start: float, **labels):
+    """Returns a future done callback observing the time since start in a histogram"""
+    def callback(_):
+        Metrics().observe(name, perf_counter() - start, **labels)
+    return callback
+
+@lru_cache(maxsize=256)
+def _resource_class(resource_type: str):
+    """Returns fhir.resources.R4B.<resourcetype>.<Resourcetype> class using importlib.
+    The class is resolved once per resourceType
+    Input: resource_type=resourceType name
+    Returns: Model class, raises ModuleNotFoundError for unknown resourceTypes"""
+    module = importlib.import_module("fhir.resources.R4B." +  resource_type.lower())
+    return getattr(module, resource_type)
 
 class ProcessFihr:
-     """Class to fetch and process queue items/objects to dataframe"""
-     def __init__(self) -> None:
-            self.entity_df_dict = {}
-     
-     def _flatten_obj(self, d: dict, parent_key=''):
-            """Recursive function to flatten fhir.resurce objects (array of dict)
-            to json array object
-            Input: d=dictionary object to be flattened
-                   key_name=json parent key name used while breaking an object
-            Returns: Dictionary of flattened object"""
-            flat_list = []
-            for k, v in d.items():
-                  clild_key = parent_key + k
-                  if isinstance(v, OrderedDict):
-                        self._flatten_obj(v, clild_key).items()
-                  else:
-                        v_json = json.dumps(v, skipkeys=False, ensure_ascii=True, 
-                        check_circular=True, allow_nan=True, cls=None, indent=None,
-                        separators=None,encoding='utf-8', default=str, use_decimal=True,
-                        namedtuple_as_object=True, tuple_as_array=True,bigint_as_string=False,
-                        sort_keys=False, item_sort_key=None, for_json=False, ignore_nan=False)
-                        flat_list.append((clild_key, v_json))
-            return dict(flat_list)
-      
-     async def process_bundle(self):
+    """Class to fetch and process queue items/objects to dataframe"""
+    def __init__(self, workers: int = 0, flush_rows: int = 0, flush_bytes: int = 0,
+                 validation: str = 'full', sample_rate: float = 0.1,
+                 validate_types=(), plan_cache_size: int = 1024,
+                 load_actions: bool = False, output_model: str = 'flat',
+                 resolve_references: bool = False, reference_index: str = None,
+                 reference_cache_size: int = 100000, resource_filter=None,
+                 flush_interval: float = 0, dictionary_encoding: bool = True) -> None:
+        # workers=0 transforms bundles on the event loop, otherwise bundles are
+        # transformed by a pool of worker processes.
+        self.entity_df_dict = {}
+        self.workers = workers
+        # validation='full' parses every bundle and resource with fhir.resources. With
+        # 'sample' only sample_rate of the bundles and the resources of validate_types are
+        # validated, with 'none' only the resources of validate_types are. Raw json
+        # resources are flattened in both modes.
+        if validation not in VALIDATION_MODES:
+            raise ValueError(f"Unknown validation mode {validation}")
+        self.validation = validation
+        self.sample_rate = sample_rate
+        self.validate_types = frozenset(validate_types)
+        self._sample_credit = 0.0
+        # Rows are accumulated across bundles until flush_rows rows or flush_bytes bytes
+        # are reached. By default every bundle is flushed on its own.
+        # Coded strings (system, code, status...) are interned and stored as categorical
+        # columns, see is_category_column()
+        self.dictionary_encoding = dictionary_encoding
+        self.batch = ColumnarBatchBuilder(flush_rows, flush_bytes,
+                                          dictionary_encoding=dictionary_encoding)
+        # With flush_interval > 0 a batch is also flushed flush_interval seconds after its
+        # first bundle, even when no further bundle arrives (micro-batches of watch_dir)
+        self.flush_interval = flush_interval
+        self._batch_started = None
+        # Compiled flatten plans per resourceType/child table and shape, 0 disables the cache
+        self.flattener = FhirFlattener(plan_cache_size)
+        # Tags every resourceType row with the LOAD_ACTION of its entry.request for the
+        # upsert load mode. DELETE entries become rows with only id and LOAD_ACTION.
+        self.load_actions = load_actions
+        # output_model='star' moves codings, practitioners and organizations to dimension
+        # tables. Applied in this process, so the dimension cache spans all the bundles.
+        if output_model not in OUTPUT_MODELS:
+            raise ValueError(f"Unknown output model {output_model}")
+        self.star = (StarSchema(self.batch.schemas, load_actions)
+                     if output_model == 'star' else None)
+        # resolve_references tags the resourceType rows with the entry fullUrl, and the
+        # ReferenceIndex of this process resolves the reference columns across bundles.
+        # reference_index is the SQLite file persisting the index across runs.
+        self.resolve_references = resolve_references
+        self.references = (ReferenceIndex(reference_cache_size, reference_index)
+                           if resolve_references else None)
+        # Optional ResourceFilter. Entries of skipped resourceTypes are dropped before
+        # validation, the kept resources are projected on their fields before flattening.
+        self.resource_filter = resource_filter
+        # Bundles taken from the fhir queue whose rows are not in the storage queue yet,
+        # acknowledged to a durable fhir queue on flush
+        self._unacked = 0
+        # Dead letters of the resources that failed in transform_bundle(), taken by the
+        # caller (the main process for the worker processes)
+        self._failures = []
+        # Latest cache counters of every worker process, by process id
+        self._worker_stats = {}
+
+    def cache_stats(self) -> dict:
+        """Returns the flatten plan cache, model class cache and dimension cache counters.
+        With a worker pool, the plan and model class counters are the sums over the workers.
+        Input: None
+        Returns: Dictionary of counters"""
+        class_info = _resource_class.cache_info()
+        stats = {"plans": self.flattener.stats(),
+                 "model_classes": {"size": class_info.currsize, "hits": class_info.hits,
+                                   "misses": class_info.misses}}
+        if self._worker_stats:
+            workers = self._worker_stats.values()
+            stats["plans"] = _sum_counters(s["plans"] for s in workers)
+            stats["model_classes"] = _sum_counters(s["model_classes"] for s in workers)
+            stats["workers"] = len(self._worker_stats)
+        if self.star is not None:
+            stats["dimensions"] = self.star.stats()
+        if self.references is not None:
+            stats["references"] = self.references.stats()
+        return stats
+
+    def _fail(self, payload: dict, error, resource_type: str = None, resource_id: str = None):
+        """Keeps a failed entry or bundle as a dead letter, the rest of the bundle goes on"""
+        self._failures.append(dead_letter("transform", payload, error, resource_type,
+                                          resource_id))
+
+    def take_failures(self) -> list:
+        """Returns and forgets the dead letters of the bundles transformed so far"""
+        failures, self._failures = self._failures, []
+        return failures
+
+    def _worker_config(self) -> dict:
+        """Returns the keyword arguments for the ProcessFihr instances of the worker processes"""
+        return {"validation": self.validation, "sample_rate": self.sample_rate,
+                "validate_types": self.validate_types,
+                "plan_cache_size": self.flattener.plan_cache_size,
+                "load_actions": self.load_actions,
+                "resolve_references": self.resolve_references,
+                "resource_filter": self.resource_filter,
+                "dictionary_encoding": self.dictionary_encoding}
+
+    def _sample_bundle(self) -> bool:
+        """Tells if the next bundle is validated in 'sample' mode. Every 1/sample_rate-th
+        bundle is picked, which keeps the validated fraction exact and repeatable."""
+        self._sample_credit += self.sample_rate
+        if self._sample_credit >= 1:
+            self._sample_credit -= 1
+            return True
+        return False
+
+    def _filter_entries(self, entries: list) -> list:
+        """Returns the bundle entries of the resourceTypes kept by the resource filter"""
+        if self.resource_filter is None:
+            return entries
+        kept = self.resource_filter.filter_entries(entries)
+        if len(kept) < len(entries):
+            Metrics().inc("fhir_resources_skipped_total", len(entries) - len(kept),
+                          stage="transform")
+        return kept
+
+    def _entry_action(self, builder: ColumnarBatchBuilder, entry: dict):
+        """Resolves the load action of a bundle entry when load_actions is set. DELETE
+        entries are added to the builder right away.
+        Input: builder=Columnar builder of the bundle
+               entry=Bundle entry dictionary
+        Returns: Tuple (skip, action), skip is True when the entry has no resource to add"""
+        if not self.load_actions:
+            return False, None
+        action, target = load_action(entry)
+        if action == "delete":
+            builder.append(target[0], {"id": target[1], LOAD_ACTION: action})
+        return action in (None, "delete"), action
+
+    def _add_resource(self, builder: ColumnarBatchBuilder, resource_type: str, rsrc: dict,
+                      action: str = None, full_url: str = None):
+        """Flattens one resource and appends its rows to the resourceType and child tables
+        Input: builder=Columnar builder of the bundle
+               resource_type=resourceType of the resource
+               rsrc=Resource dictionary
+               action=LOAD_ACTION of the resourceType row, None when not tagged
+               full_url=fullUrl of the bundle entry
+        Returns: None"""
+        if self.resource_filter is not None:
+            rsrc = self.resource_filter.project(resource_type, rsrc)
+        flat_tables = self.flattener.flatten(resource_type, rsrc)
+        if action is not None:
+            flat_tables[resource_type][0][LOAD_ACTION] = action
+        if self.resolve_references:
+            flat_tables[resource_type][0][FULL_URL] = full_url
+        for table, rows in flat_tables.items():
+            for row in rows:
+                builder.append(table, row)
+
+    def _transform_raw_bundle(self, block_dict: dict, validate_all: bool = False) -> dict:
+        """Flattens the resources of a raw json bundle. Resources are validated with
+        fhir.resources only for sampled bundles and for validate_types. Invalid resources
+        are kept as dead letters.
+        Input: block_dict=Raw bundle json dict
+               validate_all=Validates every resource
+        Returns: Dictionary of table name (resourceType or child table) ->
+                 {column name: list of values} or None
+                 when the bundle has no 'entry' key"""
+        if "entry" not in block_dict:
+            self._fail({"bundle": block_dict}, "'entry' key missing in the fhil bundle")
+            return None
+        validate_all = validate_all or (self.validation == 'sample' and self._sample_bundle())
+        builder = ColumnarBatchBuilder(dictionary_encoding=self.dictionary_encoding)
+        for dict_res in self._filter_entries(block_dict["entry"]):
+            skip, action = self._entry_action(builder, dict_res)
+            if skip:
+                continue
+            rsrc = dict_res.get("resource") or {}
+            resource_type = rsrc.get("resourceType", "Resource")
+            try:
+                if validate_all or resource_type in self.validate_types:
+                    _resource_class(resource_type).parse_obj(rsrc)
+                self._add_resource(builder, resource_type, rsrc, action,
+                                   dict_res.get("fullUrl"))
+            except Exception as ex:
+                # Unknown resourceType, invalid resource or flattening error
+                self._fail({"entry": dict_res}, ex, resource_type, rsrc.get("id"))
+        return builder.to_columns()
+
+    def transform_bundle(self, fhil_block) -> dict:
+        """Parses each resourceType object of one bundle and flattens it into columnar form.
+        The method is CPU bound and does not touch the queues, so it can run in a worker process.
+        Input: fhil_block=Bundle model object or raw bundle json dict
+        Returns: Dictionary of table name (resourceType or child table) ->
+                 {column name: list of values} or None
+                 when the bundle has no 'entry' key"""
+        if isinstance(fhil_block, dict):
+            if self.validation != 'full':
+                return self._transform_raw_bundle(fhil_block)
+            from fhir.resources.R4B import construct_fhir_element
+            if isinstance(fhil_block.get("entry"), list):
+                # Skipped resourceTypes are not validated
+                fhil_block["entry"] = self._filter_entries(fhil_block["entry"])
+            try:
+                fhil_block = construct_fhir_element('Bundle', fhil_block)
+            except ValueError:
+                # One invalid resource fails the whole bundle, its entries are validated
+                # one by one so that only the invalid ones are dead lettered
+                return self._transform_raw_bundle(fhil_block, validate_all=True)
+        block_dict = fhil_block.dict()
+        if "entry" not in block_dict:
+            self._fail({"bundle": block_dict}, "'entry' key missing in the fhil bundle")
+            return None
+        builder = ColumnarBatchBuilder(dictionary_encoding=self.dictionary_encoding)
+        for dict_res in self._filter_entries(block_dict["entry"]):
+            # entry.request is followed by the upsert load mode, append mode inserts all
+            skip, action = self._entry_action(builder, dict_res)
+            if skip:
+                continue
+            rsrc = dict_res["resource"]
+            resource_type = rsrc["resourceType"]
+            try:
+                # Calling fhir.resources.R4B.<resourcetype>.<Resourcetype>.parsse_obj() method
+                # dynamically using importlib
+                resource_obj = _resource_class(resource_type).parse_obj(rsrc)
+                self._add_resource(builder, resource_type, resource_obj.dict(), action,
+                                   dict_res.get("fullUrl"))
+            except Exception as ex:
+                self._fail({"entry": dict_res}, ex, resource_type, rsrc.get("id"))
+        return builder.to_columns()
+
+    async def _flush(self):
+        """Builds one dataframe per resourceType from the accumulated batch and puts the
+        resulting dict in the storage queue.
+        Input: None
+        Returns: None"""
+        with Metrics().timer("fhir_flush_seconds"):
+            self.entity_df_dict = self.batch.flush()
+        if self.entity_df_dict:
+            await StorageQueue().enqueue(self.entity_df_dict)
+            logging.debug("Size of resultant df dict is %d", len(self.entity_df_dict))
+        await FhirQueue().ack(self._unacked)
+        self._unacked = 0
+        self._batch_started = None
+
+    def _flush_timeout(self) -> float:
+        """Returns the seconds left until the time window of the current batch closes,
+        None without time window or when no bundle is waiting to be flushed"""
+        if not self.flush_interval or self._batch_started is None:
+            return None
+        return max(0.0, self._batch_started + self.flush_interval - perf_counter())
+
+    async def _next_bundle(self, pending: deque):
+        """Waits for the next bundle of the fhir queue. When the time window of the batch
+        closes first, the bundles transformed so far are flushed.
+        Input: pending=Futures of the bundles in the worker pool
+        Returns: Bundle model object or json dict, None at the end of the queue"""
+        while True:
+            if pending and self._batch_started is None:
+                # Bundles still in the pool open the window of the next batch
+                self._batch_started = perf_counter()
+            timeout = self._flush_timeout()
+            try:
+                fhil_block = await FhirQueue().dequeue(timeout)
+            except asyncio.TimeoutError:
+                while pending:
+                    await self._enqueue_columns(*await pending.popleft())
+                await self._flush()
+                continue
+            if fhil_block is not None and self._batch_started is None:
+                self._batch_started = perf_counter()
+            return fhil_block
+
+    async def _enqueue_columns(self, columns_dict: dict, failures: list = (),
+                               worker_stats: tuple = None) -> bool:
+        """Adds a transformed bundle to the batch and flushes the batch to the storage queue
+        once the flush threshold is reached. The failed resources of the bundle are written
+        to the dead letter store.
+        Input: columns_dict=Output of transform_bundle()
+               failures=Dead letters of the bundle
+               worker_stats=Process id and cache counters of the worker that transformed it
+        Returns: False if the bundle could not be transformed, True otherwise"""
+        self._unacked += 1
+        if worker_stats is not None:
+            pid, stats = worker_stats
+            self._worker_stats[pid] = stats
+        DeadLetterStore().add_many(failures)
+        if columns_dict is None:
+            return False
+        if self.references is not None:
+            columns_dict = self.references.resolve_columns(columns_dict)
+        if self.star is not None:
+            columns_dict = self.star.apply(columns_dict)
+        metrics = Metrics()
+        for table, columns in columns_dict.items():
+            metrics.inc("fhir_rows_total", len(next(iter(columns.values()), ())), table=table)
+        self.batch.extend(columns_dict)
+        if self.batch.should_flush() or self._flush_timeout() == 0:
+            await self._flush()
+        return True
+
+    async def process_bundle(self):
         """Fetch fhir model objects from fhir queue, parses each resourceType 
         object to flattens it to transform in dataframe object. Finally put() in the storage queue.
+        With workers configured, bundles are transformed in parallel by worker processes and
+        results are put in the storage queue in the order the bundles were dequeued.
         Input: None
         Returns: Boolean value representing status"""
         return_val = False
         logging.info("Starting to get items from fhir queue")
-        while True:
-            # Wait for the first fhir bundle object to go in the queue
-            fhil_block = await FhirQueue().dequeue()
-            self.entity_df_dict = {}
-            if fhil_block is None:
-                  break
-            print(f"Transform task picking next object...Queue size {FhirQueue().queue_size()}")
-            block_dict = fhil_block.dict()
-            if "entry" not in block_dict:
-                 logging.error("'entry' key missing in the fhil bundle dictionary")
-                 return_val = False
-                 break
-            entry_dict = fhil_block.dict()["entry"]
-            for dict_res in entry_dict:
-                  rsrc = dict_res["resource"]
-                  #method = dict_res["request"]["method"]
-                  # Following logic is for the POST method i.e. insert new records in DB
-                  # PUT method is not implemented for this PoC.
-                  resource_type = rsrc["resourceType"]
-                  resource_obj = None
-                  try:
-                        # Calling fhir.resources.R4B.<resourcetype>.<Resourcetype>.parsse_obj() method
-                        # dynamically using importlib
-                        module = importlib.import_module("fhir.resources.R4B." +  resource_type.lower())
-                        class_ = getattr(module, resource_type)
-                        resource_obj = class_.parse_obj(rsrc)
-                        flat_data = self._flatten_obj(resource_obj.dict())
-                        if flat_data["resourceType"] == "Patient":
-                              logging.info(flat_data)
-                        # transform parsed object to dataframe
-                        df = pd.DataFrame([flat_data])
-                        if resource_type in  self.entity_df_dict:
-                              self.entity_df_dict[resource_type] = pd.concat([ self.entity_df_dict[resource_type], df], axis=0)
-                        else:
-                              self.entity_df_dict[resource_type] = df
-                        logging.debug("Size of %s table is %d", resource_type, len(self.entity_df_dict[resource_type]))
-                  except ModuleNotFoundError as ex:
-                       logging.error("No module found %s", str(ex))
-            await StorageQueue().enqueue( self.entity_df_dict)
-            logging.debug("Size of resultant df dict is %d", len(self.entity_df_dict))
-       
-            #logging.debug(f"Queue items to process {FhirQueue().queue_size()}")
+        pool = None
+        if self.workers > 0:
+            pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                       initargs=(self._worker_config(),))
+        # Futures of the bundles being transformed by the pool, oldest first. Bounded so
+        # that the pool cannot pull the whole fhir queue into memory.
+        pending = deque()
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                # Wait for the first fhir bundle object to go in the queue
+                fhil_block = await self._next_bundle(pending)
+                if fhil_block is None:
+                    break
+                logging.debug("Transform task picking next object...")
+                if pool is None:
+                    with Metrics().timer("fhir_transform_seconds", mode="inline"):
+                        columns_dict = self.transform_bundle(fhil_block)
+                    # A bundle that could not be transformed is dead lettered, the
+                    # following ones are still processed
+                    await self._enqueue_columns(columns_dict, self.take_failures())
+                    continue
+                future = loop.run_in_executor(pool, _transform_in_worker, fhil_block)
+                # Latency in the pool includes the wait for a free worker
+                future.add_done_callback(_observe_latency("fhir_transform_seconds",
+                                                          perf_counter(), mode="pool"))
+                pending.append(future)
+                if len(pending) >= 2 * self.workers:
+                    await self._enqueue_columns(*await pending.popleft())
+            while pending:
+                await self._enqueue_columns(*await pending.popleft())
+            await self._flush()
+        finally:
+            if pool is not None:
+                pool.shutdown()
+            if self.references is not None:
+                self.references.close()
         return_val = FhirQueue().queue_size() == 0
+        logging.info("Transform cache stats: %s", self.cache_stats())
         logging.info("Processed all the fhir queue items.")
         await StorageQueue().enqueue( None)
-        return return_val
\ No newline at end of file
+        return return_val
@@ -0,0 +1,176 @@
+"""ReferenceIndex resolves the references between resources across bundles and files. The
+fullUrl (urn:uuid:...) and the business identifiers (Type?identifier=system|value) of every
+transformed resource are indexed with the resourceType and id they stand for, and every
+reference column (subject_reference, participant individual_reference...) gets resolved
+<column>_type and <column>_id columns, so that joins need no string parsing downstream.
+The index keeps the most recently used keys in memory and spills the others to a SQLite
+file, which persists the index across runs when a path is given."""
+import logging
+import os
+import sqlite3
+import tempfile
+from collections import OrderedDict
+from transform_fhir_records.flattener import SEPARATOR, RESOURCE_ID
+
+# Column of the resourceType rows holding the fullUrl of the bundle entry while the index
+# is built. Not stored in the tables.
+FULL_URL = '_full_url'
+REFERENCE = 'reference'
+IDENTIFIER = 'identifier'
+
+def identifier_key(resource_type: str, system, value) -> str:
+    """Returns the conditional reference of a resource identifier,
+    Type?identifier=system|value or Type?identifier=value without system"""
+    token = value if system is None else f"{system}|{value}"
+    return f"{resource_type}?{IDENTIFIER}={token}"
+
+def literal_reference(reference: str) -> tuple:
+    """Parses a relative (Type/id) or absolute (<base>/Type/id, <base>/Type/id/_history/1)
+    literal reference
+    Returns: Tuple of resourceType and id, None for other references"""
+    if reference.startswith(('urn:', '#')) or '?' in reference:
+        return None
+    parts = reference.rstrip('/').split('/')
+    if len(parts) >= 4 and parts[-2] == '_history':
+        parts = parts[:-2]
+    if len(parts) < 2 or not parts[-2][:1].isupper():
+        return None
+    return parts[-2], parts[-1]
+
+class ReferenceIndex:
+    """LRU of key (fullUrl or conditional reference) -> (resourceType, id) with at most
+    capacity entries in memory. Evicted entries are written to the spill database, a
+    temporary file unless path is given, and promoted back on lookup."""
+    def __init__(self, capacity: int = 100000, path: str = None) -> None:
+        if capacity < 1:
+            raise ValueError("Reference index capacity must be at least 1")
+        self.capacity = capacity
+        self.path = path
+        self._lru = OrderedDict()
+        self._con = None
+        self._spill_path = None
+        self.hits = 0
+        self.misses = 0
+        self.spilled = 0
+        self.resolved = 0
+        self.unresolved = 0
+
+    def stats(self) -> dict:
+        """Returns the index counters"""
+        return {"size": len(self._lru), "hits": self.hits, "misses": self.misses,
+                "spilled": self.spilled, "resolved": self.resolved,
+                "unresolved": self.unresolved}
+
+    def _connection(self) -> sqlite3.Connection:
+        """Opens the spill database on first use"""
+        if self._con is None:
+            if self.path is None:
+                fd, self._spill_path = tempfile.mkstemp(prefix='fhir_references_',
+                                                        suffix='.db')
+                os.close(fd)
+            self._con = sqlite3.connect(self.path or self._spill_path, isolation_level=None)
+            self._con.execute("CREATE TABLE IF NOT EXISTS reference_index ("
+                              "key TEXT PRIMARY KEY, resource_type TEXT, resource_id TEXT)")
+        return self._con
+
+    def _spill(self, items: list):
+        """Writes evicted (key, (resourceType, id)) items to the spill database"""
+        if items:
+            self._connection().executemany(
+                "INSERT OR REPLACE INTO reference_index VALUES (?, ?, ?)",
+                [(key, target[0], target[1]) for key, target in items])
+            self.spilled += len(items)
+
+    def put_many(self, items: dict):
+        """Indexes resources, evicting the least recently used keys beyond capacity
+        Input: items=Dictionary of key -> (resourceType, id)
+        Returns: None"""
+        lru = self._lru
+        for key, target in items.items():
+            lru[key] = target
+            lru.move_to_end(key)
+        evicted = []
+        while len(lru) > self.capacity:
+            evicted.append(lru.popitem(last=False))
+        self._spill(evicted)
+
+    def get(self, key: str) -> tuple:
+        """Returns the (resourceType, id) of an indexed key, None when unknown"""
+        target = self._lru.get(key)
+        if target is not None:
+            self._lru.move_to_end(key)
+            self.hits += 1
+            return target
+        if self.spilled or (self.path is not None and os.path.exists(self.path)):
+            row = self._connection().execute(
+                "SELECT resource_type, resource_id FROM reference_index WHERE key = ?",
+                (key,)).fetchone()
+            if row is not None:
+                self.hits += 1
+                self.put_many({key: (row[0], row[1])})
+                return row[0], row[1]
+        self.misses += 1
+        return None
+
+    def resolve(self, reference) -> tuple:
+        """Resolves a literal, fullUrl or conditional reference
+        Input: reference=Reference string
+        Returns: Tuple of resourceType and id, None when unresolved"""
+        if not isinstance(reference, str) or reference.startswith('#'):
+            return None
+        target = literal_reference(reference)
+        if target is None:
+            target = self.get(reference)
+        if target is None:
+            self.unresolved += 1
+        else:
+            self.resolved += 1
+        return target
+
+    def index_columns(self, columns_dict: dict):
+        """Indexes the fullUrl and identifiers of the resources of a bundle and drops the
+        FULL_URL columns
+        Input: columns_dict=Output of ProcessFihr.transform_bundle()
+        Returns: None"""
+        items = {}
+        for table, columns in columns_dict.items():
+            if SEPARATOR not in table:
+                full_urls = columns.pop(FULL_URL, None)
+                if full_urls is not None:
+                    items.update((url, (table, rid)) for url, rid in zip(full_urls, columns["id"])
+                                 if url is not None and rid is not None)
+                continue
+            resource_type = table.split(SEPARATOR, 1)[0]
+            if table == resource_type + SEPARATOR + IDENTIFIER and "value" in columns:
+                systems = columns.get("system") or [None] * len(columns["value"])
+                items.update((identifier_key(resource_type, system, value), (resource_type, rid))
+                             for system, value, rid in zip(systems, columns["value"],
+                                                           columns[RESOURCE_ID])
+                             if value is not None)
+        self.put_many(items)
+
+    def resolve_columns(self, columns_dict: dict) -> dict:
+        """Indexes a bundle, then adds the resolved <column>_type and <column>_id columns of
+        every reference column, in place
+        Input: columns_dict=Output of ProcessFihr.transform_bundle()
+        Returns: columns_dict"""
+        self.index_columns(columns_dict)
+        for columns in columns_dict.values():
+            for col in [c for c in columns
+                        if c == REFERENCE or c.endswith(SEPARATOR + REFERENCE)]:
+                targets = [self.resolve(reference) for reference in columns[col]]
+                columns[col + SEPARATOR + 'type'] = [t and t[0] for t in targets]
+                columns[col + SEPARATOR + 'id'] = [t and t[1] for t in targets]
+        return columns_dict
+
+    def close(self):
+        """Writes the in-memory keys to a persistent index and removes a temporary one"""
+        if self.path is not None and self._lru:
+            self._spill(list(self._lru.items()))
+        if self._con is not None:
+            self._con.close()
+            self._con = None
+        if self._spill_path is not None:
+            os.remove(self._spill_path)
+            self._spill_path = None
+        logging.info("Reference index stats: %s", self.stats())
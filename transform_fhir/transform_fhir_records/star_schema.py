@@ -0,0 +1,173 @@
+"""StarSchema reshapes the flattened tables of a bundle into a star schema. Codings
+(SNOMED, LOINC, RxNorm...) and the Practitioner and Organization references are moved to
+deduplicated dimension tables (DimCoding, DimPractitioner, DimOrganization) keyed by an
+integer surrogate key, and the resourceType (fact) tables and their child tables keep only
+the keys in *_sk columns. The <resourceType>_..._coding child tables become bridge tables
+of coding_sk, and the parent row of every CodeableConcept gets the key of its first coding.
+Surrogate keys are a hash of the natural key, so that worker processes, shards and later
+runs compute the same key without sharing state."""
+import hashlib
+from transform_fhir_records.flattener import (SEPARATOR, RESOURCE_ID, PARENT_KEY, ROW_KEY,
+                                              LOAD_ACTION, SchemaRegistry)
+
+OUTPUT_MODELS = ('flat', 'star')
+DIM_CODING = 'DimCoding'
+DIM_PRACTITIONER = 'DimPractitioner'
+DIM_ORGANIZATION = 'DimOrganization'
+# Dimension of the references per referenced resourceType
+REFERENCE_DIMENSIONS = {'Practitioner': DIM_PRACTITIONER, 'Organization': DIM_ORGANIZATION}
+# Members of a Coding moved to DimCoding, (system, code) is its natural key
+CODING_COLUMNS = ('system', 'code', 'display', 'version')
+CODING_SUFFIX = SEPARATOR + 'coding'
+REFERENCE = 'reference'
+DISPLAY = 'display'
+# Suffix of the surrogate key columns of the fact and bridge tables
+KEY_SUFFIX = SEPARATOR + 'sk'
+
+def surrogate_key(dimension: str, *natural_key) -> int:
+    """Returns the surrogate key of a dimension member, a positive 63 bit integer
+    Input: dimension=Dimension table name
+           natural_key=Values identifying the member
+    Returns: Integer key, the same in every process and run"""
+    text = "\x1f".join([dimension] + ["" if part is None else str(part) for part in natural_key])
+    digest = hashlib.blake2b(text.encode('UTF-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') >> 1
+
+def referenced_type(reference) -> str:
+    """Returns the resourceType of a literal (Type/id, <base>/Type/id) or conditional
+    (Type?identifier=...) reference, None for urn:uuid, contained and other references"""
+    if not isinstance(reference, str) or reference.startswith(('urn:', '#')):
+        return None
+    path, conditional, _ = reference.partition('?')
+    parts = path.rstrip('/').split('/')
+    if conditional:
+        return parts[-1]
+    return parts[-2] if len(parts) >= 2 else None
+
+class StarSchema:
+    """StarSchema keeps the surrogate keys of the dimension members seen by this process,
+    across bundles, and adds a dimension row to the output only the first time a member is
+    seen. With load_actions the dimension rows are tagged 'insert', so that the upsert
+    loader skips the members stored by other processes or earlier runs."""
+    def __init__(self, schemas: SchemaRegistry = None, load_actions: bool = False) -> None:
+        # Registry of the batch builder, the key columns are declared as integers
+        self.schemas = schemas if schemas is not None else SchemaRegistry()
+        self.load_actions = load_actions
+        # (dimension, natural key) -> surrogate key
+        self._keys = {}
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> dict:
+        """Returns the dimension cache counters"""
+        return {"size": len(self._keys), "hits": self.hits, "misses": self.misses}
+
+    def _lookup(self, dimension: str, natural_key: tuple, attributes: dict, dims: dict) -> int:
+        """Returns the surrogate key of a member, adding its row to dims when it is new"""
+        key = self._keys.get((dimension, natural_key))
+        if key is not None:
+            self.hits += 1
+            return key
+        self.misses += 1
+        key = self._keys[(dimension, natural_key)] = surrogate_key(dimension, *natural_key)
+        row = {"id": key, **attributes}
+        if self.load_actions:
+            row[LOAD_ACTION] = 'insert'
+        dims.setdefault(dimension, []).append(row)
+        return key
+
+    def _declare(self, table: str, col: str):
+        self.schemas.declare(table, col, 'integer')
+
+    def apply(self, columns_dict: dict) -> dict:
+        """Reshapes the tables of a bundle, in place
+        Input: columns_dict=Output of ProcessFihr.transform_bundle(), {table: {col: values}}
+        Returns: columns_dict with the key columns and the new dimension rows"""
+        dims = {}
+        for table in [t for t in columns_dict if t.endswith(CODING_SUFFIX)]:
+            self._codings(columns_dict, table, dims)
+        for table, columns in columns_dict.items():
+            self._references(table, columns, dims)
+        for dimension, rows in dims.items():
+            cols = dict.fromkeys(col for row in rows for col in row)
+            columns_dict[dimension] = {col: [row.get(col) for row in rows] for col in cols}
+            self._declare(dimension, "id")
+        return columns_dict
+
+    def _codings(self, columns_dict: dict, table: str, dims: dict):
+        """Turns a coding child table into a bridge table and keys its parent rows"""
+        columns = columns_dict[table]
+        if "system" not in columns and "code" not in columns:
+            return
+        count = len(columns[RESOURCE_ID])
+        members = [columns.pop(col, None) or [None] * count for col in CODING_COLUMNS]
+        keys = []
+        for system, code, display, version in zip(*members):
+            if system is None and code is None:
+                keys.append(None)
+                continue
+            keys.append(self._lookup(DIM_CODING, (system, code),
+                                     {"system": system, "code": code, "display": display,
+                                      "version": version}, dims))
+        columns["coding" + KEY_SUFFIX] = keys
+        self._declare(table, "coding" + KEY_SUFFIX)
+        if count:
+            self._key_parent(columns_dict, table, columns, keys)
+
+    def _key_parent(self, columns_dict: dict, table: str, columns: dict, keys: list):
+        """Adds the key of the first coding of every CodeableConcept to its parent row"""
+        if columns[PARENT_KEY][0] is None:
+            # Child rows of the resourceType row, matched on the resource id
+            parent = table.split(SEPARATOR, 1)[0]
+            parent_ids = columns_dict.get(parent, {}).get("id", [])
+            links = columns[RESOURCE_ID]
+        else:
+            # Child rows of another child table, the longest table name prefix
+            parents = [t for t in columns_dict
+                       if t != table and table.startswith(t + SEPARATOR)
+                       and SEPARATOR in t and ROW_KEY in columns_dict[t]]
+            if not parents:
+                return
+            parent = max(parents, key=len)
+            parent_ids = list(zip(columns_dict[parent][RESOURCE_ID],
+                                  columns_dict[parent][ROW_KEY]))
+            links = list(zip(columns[RESOURCE_ID], columns[PARENT_KEY]))
+        if not parent_ids:
+            return
+        first = {}
+        for link, key in zip(links, keys):
+            if key is not None:
+                first.setdefault(link, key)
+        col = table[len(parent) + 1:] + KEY_SUFFIX
+        columns_dict[parent][col] = [first.get(link) for link in parent_ids]
+        self._declare(parent, col)
+
+    def _references(self, table: str, columns: dict, dims: dict):
+        """Replaces the Practitioner and Organization references of a table by keys"""
+        for col in [c for c in columns if c == REFERENCE or c.endswith(SEPARATOR + REFERENCE)]:
+            prefix = col[:-len(REFERENCE)]
+            references = columns[col]
+            displays = columns.get(prefix + DISPLAY)
+            key_cols = {}
+            for i, reference in enumerate(references):
+                dimension = REFERENCE_DIMENSIONS.get(referenced_type(reference))
+                if dimension is None:
+                    continue
+                display = displays[i] if displays is not None else None
+                key = self._lookup(dimension, (reference,),
+                                   {REFERENCE: reference, DISPLAY: display}, dims)
+                if dimension not in key_cols:
+                    key_cols[dimension] = [None] * len(references)
+                key_cols[dimension][i] = key
+                references[i] = None
+                if displays is not None:
+                    displays[i] = None
+            for dimension, keys in key_cols.items():
+                # e.g. serviceProvider_organization_sk, participant individual_practitioner_sk
+                key_col = prefix + dimension[len('Dim'):].lower() + KEY_SUFFIX
+                columns[key_col] = keys
+                self._declare(table, key_col)
+            # The reference columns are dropped once every value moved to a dimension
+            for moved in (col, prefix + DISPLAY):
+                if key_cols and moved in columns and all(v is None for v in columns[moved]):
+                    del columns[moved]